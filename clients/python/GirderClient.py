@@ -1,3 +1,4 @@
+import hashlib
 import json
 import requests
 import os
@@ -192,7 +193,8 @@ class GirderClient(object):
     def uploadFileToItem(self, itemId, filepath):
         """
         Uploads a file to an item. Currently only supports uploading in a
-        single chunk, so files larger than 64 MB will raise an exception.
+        single chunk, so files larger than 64 MB will raise an exception. If
+        the server already has the file's contents, they are not sent again.
         """
         data = None
 
@@ -213,12 +215,16 @@ class GirderClient(object):
             'parentType': 'item',
             'parentId': itemId,
             'name': filename,
-            'size': datalen
+            'size': datalen,
+            'sha512': hashlib.sha512(data).hexdigest()
         }
 
         obj = self.sendRestRequest('POST', 'file', params)
 
-        if '_id' in obj:
+        if 'itemId' in obj:
+            # The server already had the data, so the file was created
+            return obj['_id']
+        elif '_id' in obj:
             uploadId = obj['_id']
         else:
             raise Exception('After creating an upload token, expected an object'
@@ -230,12 +236,11 @@ class GirderClient(object):
             'uploadId': uploadId
         }
 
-        filedata = {
-            'chunk': data
-        }
-
-        upResult = requests.post(self.urlBase + 'file/chunk', params=parameters,
-                                 files=filedata)
+        # Send the chunk as the raw request body so that the server can
+        # stream it into the assetstore
+        upResult = requests.post(
+            self.urlBase + 'file/chunk', params=parameters, data=data,
+            headers={'Content-Type': 'application/octet-stream'})
         obj = upResult.json()
 
         if '_id' in obj:
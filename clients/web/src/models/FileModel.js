@@ -155,19 +155,19 @@ girder.models.FileModel = girder.Model.extend({
         var blob = file[sliceFn](this.startByte, endByte);
         var model = this;
 
-        var fd = new FormData();
-        fd.append('offset', this.startByte);
-        fd.append('uploadId', uploadId);
-        fd.append('chunk', blob);
-
         girder._uploadId = uploadId;
 
+        // The chunk is sent as the raw request body so that the server can
+        // stream it into the assetstore.
         girder.restRequest({
-            path: 'file/chunk',
+            path: 'file/chunk?' + $.param({
+                offset: this.startByte,
+                uploadId: uploadId
+            }),
             type: 'POST',
             dataType: 'json',
-            data: fd,
-            contentType: false,
+            data: blob,
+            contentType: 'application/octet-stream',
             processData: false,
             success: function () {
                 model.trigger('g:upload.chunkSent', {
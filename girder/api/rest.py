@@ -17,6 +17,8 @@
 #  limitations under the License.
 ###############################################################################
 
+import base64
+import bson.json_util
 import cherrypy
 import collections
 import datetime
@@ -30,10 +32,18 @@ import types
 from . import docs
 from girder import events, logger
 from girder.constants import SettingKey, TerminalColor, TokenScope
-from girder.models.model_base import AccessException, ValidationException
+from girder.models.model_base import AccessException, ValidationException, \
+    identityMap
 from girder.utility.model_importer import ModelImporter
 from girder.utility import config
 
+# The sort fields that lists may be paged through with cursors. The next page
+# is found by comparing with the sort values of the last document, and a
+# missing value, or one of another type, compares with nothing, so these are
+# only fields that the listed documents always have with a single type.
+CURSOR_SORT_FIELDS = frozenset((
+    '_id', 'name', 'lowerName', 'created', 'login', 'firstName', 'lastName'))
+
 
 def _cacheAuthUser(fun):
     """
@@ -236,10 +246,14 @@ def endpoint(fun):
 
     If you want a streamed response, simply return a generator function
     from the inner method.
+
+    Model documents loaded while the underlying method runs are cached in a
+    request-scoped identity map, which is discarded when it returns.
     """
     @functools.wraps(fun)
     def endpointDecorator(self, *args, **kwargs):
         _setCommonCORSHeaders()
+        identityMap.begin()
         try:
             val = fun(self, args, kwargs)
 
@@ -282,6 +296,8 @@ def endpoint(fun):
             if curConfig['server']['mode'] != 'production':
                 # Unless we are in production mode, send a traceback too
                 val['trace'] = traceback.extract_tb(tb)
+        finally:
+            identityMap.end()
 
         return _createResponse(val)
     return endpointDecorator
@@ -410,6 +426,26 @@ class RestException(Exception):
         Exception.__init__(self, message)
 
 
+_RouteEntry = collections.namedtuple('_RouteEntry', (
+    'route', 'handler', 'wildcards', 'eventPrefix', 'beforeEvent',
+    'afterEvent'))
+
+
+class _RouteNode(object):
+    """
+    A node in the per-method trie of routes of a Resource. Each node has a
+    child for every literal token that can follow it and at most one child for
+    a wildcard token. Routes that end at this node are kept in registration
+    order; only the first one is ever matched.
+    """
+    __slots__ = ('literals', 'wildcard', 'routes')
+
+    def __init__(self):
+        self.literals = {}
+        self.wildcard = None
+        self.routes = []
+
+
 class Resource(ModelImporter):
     """
     All REST resources should inherit from this class, which provides utilities
@@ -437,17 +473,17 @@ class Resource(ModelImporter):
         :param resource: The name of the resource at the root of this route.
         """
         if not hasattr(self, '_routes'):
-            self._routes = collections.defaultdict(
-                lambda: collections.defaultdict(list))
-
-        # Insertion sort to maintain routes in required order.
-        nLengthRoutes = self._routes[method.lower()][len(route)]
-        for i in xrange(0, len(nLengthRoutes)):
-            if self._shouldInsertRoute(route, nLengthRoutes[i][0]):
-                nLengthRoutes.insert(i, (route, handler))
-                break
-        else:
-            nLengthRoutes.append((route, handler))
+            self._routes = {}
+
+        node = self._routes.setdefault(method.lower(), _RouteNode())
+        for token in route:
+            if token[0] == ':':
+                if node.wildcard is None:
+                    node.wildcard = _RouteNode()
+                node = node.wildcard
+            else:
+                node = node.literals.setdefault(token, _RouteNode())
+        node.routes.append(self._routeEntry(method, route, handler))
 
         # Now handle the api doc if the handler has any attached
         if resource is None and hasattr(self, 'resourceName'):
@@ -490,11 +526,19 @@ class Resource(ModelImporter):
         """
         if not hasattr(self, '_routes'):
             return
-        nLengthRoutes = self._routes[method.lower()][len(route)]
-        for i in xrange(0, len(nLengthRoutes)):
-            if nLengthRoutes[i][0] == route:
-                del nLengthRoutes[i]
+        node = self._routes.get(method.lower())
+        for token in route:
+            if node is None:
                 break
+            if token[0] == ':':
+                node = node.wildcard
+            else:
+                node = node.literals.get(token)
+        if node is not None:
+            for i in xrange(0, len(node.routes)):
+                if node.routes[i].route == route:
+                    del node.routes[i]
+                    break
         # Remove the api doc
         if resource is None and hasattr(self, 'resourceName'):
             resource = self.resourceName
@@ -506,16 +550,47 @@ class Resource(ModelImporter):
                     resource=resource, route=route, method=method,
                     info=handler.description.asDict(), handler=handler)
 
-    def _shouldInsertRoute(self, a, b):
+    def _routeEntry(self, method, route, handler):
         """
-        Return bool representing whether route a should go before b. Checks by
-        comparing each token in order and making sure routes with literals in
-        forward positions come before routes with wildcards in those positions.
+        Build the trie entry for a route, precomputing everything about it that
+        does not depend on the request, including the names of the events
+        fired by handleRoute.
         """
-        for i in xrange(0, len(a)):
-            if a[i][0] != ':' and b[i][0] == ':':
-                return True
-        return False
+        if hasattr(self, 'resourceName'):
+            resource = self.resourceName
+        else:
+            resource = handler.__module__.rsplit('.', 1)[-1]
+
+        routeStr = '/'.join((resource, '/'.join(route))).rstrip('/')
+        eventPrefix = '.'.join(('rest', method.lower(), routeStr))
+        wildcards = tuple((i, token[1:]) for i, token in enumerate(route)
+                          if token[0] == ':')
+
+        return _RouteEntry(
+            route=route, handler=handler, wildcards=wildcards,
+            eventPrefix=eventPrefix, beforeEvent=eventPrefix + '.before',
+            afterEvent=eventPrefix + '.after')
+
+    def _matchTrie(self, node, path, depth=0):
+        """
+        Find the route entry matching the requested path in the trie rooted at
+        the given node, or None if there is no match. Literal tokens take
+        precedence over wildcards at each position; if the literal branch has
+        no match further along the path, the wildcard branch is tried.
+        """
+        if depth == len(path):
+            return node.routes[0] if node.routes else None
+
+        child = node.literals.get(path[depth])
+        if child is not None:
+            entry = self._matchTrie(child, path, depth + 1)
+            if entry is not None:
+                return entry
+
+        if node.wildcard is not None:
+            return self._matchTrie(node.wildcard, path, depth + 1)
+
+        return None
 
     def handleRoute(self, method, path, params):
         """
@@ -556,64 +631,36 @@ class Resource(ModelImporter):
 
         method = method.lower()
 
-        for route, handler in self._routes[method][len(path)]:
-            kwargs = self._matchRoute(path, route)
-            if kwargs is not False:
-                kwargs['params'] = params
-                # Add before call for the API method. Listeners can return
-                # their own responses by calling preventDefault() and
-                # adding a response on the event.
-
-                if hasattr(self, 'resourceName'):
-                    resource = self.resourceName
-                else:
-                    resource = handler.__module__.rsplit('.', 1)[-1]
-
-                routeStr = '/'.join((resource, '/'.join(route))).rstrip('/')
-                eventPrefix = '.'.join(('rest', method, routeStr))
-
-                event = events.trigger('.'.join((eventPrefix, 'before')),
-                                       kwargs)
-                if event.defaultPrevented and len(event.responses) > 0:
-                    val = event.responses[0]
-                else:
-                    self._defaultAccess(handler)
-                    val = handler(**kwargs)
-
-                # Fire the after-call event that has a chance to augment the
-                # return value of the API method that was called. You can
-                # reassign the return value completely by adding a response to
-                # the event and calling preventDefault() on it.
-                kwargs['returnVal'] = val
-                event = events.trigger('.'.join((eventPrefix, 'after')), kwargs)
-                if event.defaultPrevented and len(event.responses) > 0:
-                    val = event.responses[0]
-
-                return val
-
-        raise RestException('No matching route for "{} {}"'.format(
-            method.upper(), '/'.join(path)))
+        root = self._routes.get(method)
+        entry = self._matchTrie(root, path) if root is not None else None
+        if entry is None:
+            raise RestException('No matching route for "{} {}"'.format(
+                method.upper(), '/'.join(path)))
+
+        kwargs = {name: path[i] for i, name in entry.wildcards}
+        kwargs['params'] = params
+        identityMap.endpoint = entry.eventPrefix
+
+        # Add before call for the API method. Listeners can return
+        # their own responses by calling preventDefault() and
+        # adding a response on the event.
+        event = events.trigger(entry.beforeEvent, kwargs)
+        if event.defaultPrevented and len(event.responses) > 0:
+            val = event.responses[0]
+        else:
+            self._defaultAccess(entry.handler)
+            val = entry.handler(**kwargs)
 
-    def _matchRoute(self, path, route):
-        """
-        Helper function that attempts to match the requested path with a
-        given route specification. Returns False if the requested path does
-        not match the route. If it does match, this will return the dict of
-        kwargs that should be passed to the underlying handler, based on the
-        wildcard tokens of the route.
+        # Fire the after-call event that has a chance to augment the
+        # return value of the API method that was called. You can
+        # reassign the return value completely by adding a response to
+        # the event and calling preventDefault() on it.
+        kwargs['returnVal'] = val
+        event = events.trigger(entry.afterEvent, kwargs)
+        if event.defaultPrevented and len(event.responses) > 0:
+            val = event.responses[0]
 
-        :param path: The requested path.
-        :type path: list
-        :param route: The route specification to match against.
-        :type route: list
-        """
-        wildcards = {}
-        for i in range(0, len(route)):
-            if route[i][0] == ':':  # Wildcard token
-                wildcards[route[i][1:]] = path[i]
-            elif route[i] != path[i]:  # Exact match token
-                return False
-        return wildcards
+        return val
 
     def requireParams(self, required, provided):
         """
@@ -683,6 +730,10 @@ class Resource(ModelImporter):
             set this to choose a default sort field. If None, the results will
             be returned unsorted.
         :type defaultSortField: str or None
+
+        When sorting by a field other than _id, _id is appended to the sort as
+        a tiebreaker so that the order is total, which is required for paging
+        with getPagingCursor.
         """
         offset = int(params.get('offset', 0))
         limit = int(params.get('limit', 50))
@@ -695,8 +746,74 @@ class Resource(ModelImporter):
         else:
             sort = None
 
+        if sort is not None and sort[0][0] != '_id':
+            sort.append(('_id', sortdir))
+
         return limit, offset, sort
 
+    def getPagingCursor(self, params, sort):
+        """
+        Pass the URL parameters into this function to support keyset
+        pagination of a list of resources. If the client passed a 'cursor'
+        parameter, which is the opaque value of the Girder-Next-Cursor header
+        of the previous page, this returns the sort key values of the last
+        document on that page. These should be passed as the 'after' argument
+        of the model methods that are finding the resources, which then return
+        the next page without skipping over the preceding documents.
+
+        :param params: The URL query parameters.
+        :type params: dict
+        :param sort: The sort returned by getPagingParameters.
+        :returns: The list of sort key values to page after, or None.
+        """
+        if not params.get('cursor'):
+            return None
+
+        try:
+            token = bson.json_util.loads(
+                base64.urlsafe_b64decode(str(params['cursor'])))
+            tokenSort = [tuple(s) for s in token['sort']]
+            after = token['after']
+        except (TypeError, ValueError, KeyError):
+            raise RestException('Invalid cursor.')
+
+        if sort is None or tokenSort != list(sort):
+            raise RestException(
+                'The cursor does not match the requested sort order.')
+
+        return after
+
+    def setNextCursor(self, docs, sort, limit):
+        """
+        Set the Girder-Next-Cursor response header to the cursor for the page
+        following this one. The header is omitted if this is the last page.
+        It is also omitted when sorting by a field that is not in
+        CURSOR_SORT_FIELDS, in which case offset paging must be used.
+        This must be called with the documents as returned by the model, before
+        they are filtered, so that the sort fields are present.
+
+        :param docs: The documents in the current page.
+        :type docs: list
+        :param sort: The sort returned by getPagingParameters.
+        :param limit: The page size.
+        :type limit: int
+        """
+        if sort is None or not limit or len(docs) < limit:
+            return
+
+        if any(field not in CURSOR_SORT_FIELDS for field, _ in sort):
+            return
+
+        after = [docs[-1].get(field) for field, _ in sort]
+        if None in after:
+            return
+
+        cherrypy.response.headers['Girder-Next-Cursor'] = \
+            base64.urlsafe_b64encode(bson.json_util.dumps({
+                'sort': sort,
+                'after': after
+            }))
+
     def ensureTokenScopes(self, scope):
         """
         Ensure that the token passed to this request is authorized for the
@@ -755,12 +872,9 @@ class Resource(ModelImporter):
         if not self._routes:
             raise Exception('No routes defined for resource')
         allowedMethods = ['OPTIONS']
-        for routeMethod in self._routes:
-            for route, handler in self._routes[routeMethod][len(path)]:
-                kwargs = self._matchRoute(path, route)
-                if kwargs is not False:
-                    allowedMethods.append(routeMethod.upper())
-                    break
+        for routeMethod, root in self._routes.iteritems():
+            if self._matchTrie(root, path) is not None:
+                allowedMethods.append(routeMethod.upper())
         # Restrict this further if there is a user setting
         restrictMethods = self.model('setting').get(
             SettingKey.CORS_ALLOW_METHODS)
@@ -21,6 +21,8 @@ from ..describe import Description
 from ..rest import Resource, RestException, loadmodel
 from girder.constants import AssetstoreType
 from girder.api import access
+from girder.utility import assetstore_utilities
+from girder.utility.progress import ProgressContext
 
 
 class Assetstore(Resource):
@@ -32,6 +34,8 @@ class Assetstore(Resource):
         self.route('GET', (), self.find)
         self.route('POST', (), self.createAssetstore)
         self.route('PUT', (':id',), self.updateAssetstore)
+        self.route('POST', (':id', 'migrate'), self.migrateAssetstore)
+        self.route('POST', (':id', 'import'), self.importData)
         self.route('DELETE', (':id',), self.deleteAssetstore)
 
     @access.admin
@@ -170,6 +174,96 @@ class Assetstore(Resource):
         .errorResponse()
         .errorResponse('You are not an administrator.', 403))
 
+    @access.admin
+    @loadmodel(model='assetstore')
+    def migrateAssetstore(self, assetstore, params):
+        self.requireParams('targetId', params)
+        target = self.model('assetstore').load(params['targetId'])
+        if target is None:
+            raise RestException('Invalid target assetstore ID.')
+        try:
+            workers = int(params.get('workers', 4))
+        except ValueError:
+            raise RestException('Workers must be an integer.')
+        removeSource = self.boolParam('removeSource', params, default=False)
+        progress = self.boolParam('progress', params, default=False)
+
+        with ProgressContext(progress, user=self.getCurrentUser(),
+                             title='Migrating assetstore {}'.format(
+                                 assetstore['name'])) as ctx:
+            return self.model('assetstore').migrate(
+                assetstore, target, workers=workers,
+                removeSource=removeSource, progress=ctx)
+    migrateAssetstore.description = (
+        Description('Move the data of all files in an assetstore into '
+                    'another assetstore.')
+        .notes('You must be an administrator to call this. Each file is '
+               'switched to the target assetstore once its data has been '
+               'copied and verified. Files that fail are left where they '
+               'are; calling this again moves only the files still in the '
+               'source assetstore, so an interrupted migration can be '
+               'resumed. Returns the number of files moved, their total '
+               'size, and the number of files that failed.')
+        .param('id', 'The ID of the source assetstore.', paramType='path')
+        .param('targetId', 'The ID of the target assetstore.')
+        .param('workers', 'The number of files to move at once (default=4).',
+               required=False, dataType='integer')
+        .param('removeSource', 'Whether to delete the data of each moved '
+               'file from the source assetstore (default=false).',
+               required=False, dataType='boolean')
+        .param('progress', 'Whether to record progress on this task '
+               '(default=false).', required=False, dataType='boolean')
+        .errorResponse()
+        .errorResponse('You are not an administrator.', 403))
+
+    @access.admin
+    @loadmodel(model='assetstore')
+    def importData(self, assetstore, params):
+        self.requireParams(('importPath', 'destinationId'), params)
+        if assetstore['type'] != AssetstoreType.FILESYSTEM:
+            raise RestException(
+                'Only filesystem assetstores support importing data.')
+        parentType = params.get('destinationType', 'folder')
+        if parentType not in ('folder', 'user', 'collection'):
+            raise RestException('Invalid destination type.')
+        parent = self.model(parentType).load(params['destinationId'],
+                                             force=True)
+        if parent is None:
+            raise RestException('Invalid destination ID.')
+        progress = self.boolParam('progress', params, default=False)
+        user = self.getCurrentUser()
+
+        adapter = assetstore_utilities.getAssetstoreAdapter(assetstore)
+        with ProgressContext(progress, user=user,
+                             title='Importing {}'.format(
+                                 params['importPath'])) as ctx:
+            return adapter.importData(
+                parent, parentType, {'importPath': params['importPath']},
+                progress=ctx, user=user)
+    importData.description = (
+        Description('Import a directory on the server\'s disk into the '
+                    'assetstore, without copying its data.')
+        .notes('You must be an administrator to call this. Each '
+               'subdirectory becomes a folder, and each file an item. The '
+               'imported files are read in place and are never deleted by '
+               'the server. Calling this again for the same directory adds '
+               'new files and updates changed ones. Checksums are computed '
+               'in the background. Returns the number of folders and files '
+               'created, and of files updated or unchanged.')
+        .param('id', 'The ID of the filesystem assetstore.', paramType='path')
+        .param('importPath', 'The absolute path of the directory on the '
+               'server to import.')
+        .param('destinationId', 'The ID of the folder, user or collection '
+               'to import into.')
+        .param('destinationType', 'The type of the destination: folder, '
+               'user or collection (default=folder). Files directly under '
+               'the import path are only imported into a folder.',
+               required=False)
+        .param('progress', 'Whether to record progress on this task '
+               '(default=false).', required=False, dataType='boolean')
+        .errorResponse()
+        .errorResponse('You are not an administrator.', 403))
+
     @access.admin
     @loadmodel(model='assetstore')
     def deleteAssetstore(self, assetstore, params):
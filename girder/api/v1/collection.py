@@ -47,8 +47,11 @@ class Collection(Resource):
                     self.model('collection').textSearch(
                         params['text'], user=user, limit=limit, offset=offset)]
 
-        cols = self.model('collection').list(user=user, offset=offset,
-                                             limit=limit, sort=sort)
+        cols = list(self.model('collection').list(
+            user=user, offset=offset, limit=limit, sort=sort,
+            after=self.getPagingCursor(params, sort)))
+        self.setNextCursor(cols, sort, limit)
+
         return [self.model('collection').filter(c, user) for c in cols]
     find.description = (
         Description('List or search for collections.')
@@ -62,7 +65,10 @@ class Collection(Resource):
         .param('sort', "Field to sort the result list by (default=name)",
                required=False)
         .param('sortdir', "1 for ascending, -1 for descending (default=1)",
-               required=False, dataType='int'))
+               required=False, dataType='int')
+        .param('cursor', 'Return the page after the one whose '
+               'Girder-Next-Cursor response header had this value.',
+               required=False))
 
     @access.admin
     def createCollection(self, params):
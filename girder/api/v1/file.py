@@ -27,6 +27,26 @@ from girder.models.model_base import AccessException
 from girder.api import access
 
 
+class RequestBodyChunk(object):
+    """
+    Presents the unparsed body of a request as a file-like chunk, so that it
+    can be streamed into the assetstore without first being spooled to a
+    temporary file.
+
+    :param body: The request body.
+    :type body: cherrypy._cpreqbody.RequestBody
+    """
+    def __init__(self, body):
+        self.body = body
+        self.length = body.length
+
+    def read(self, size=None):
+        return self.body.read(size)
+
+    def close(self):
+        pass
+
+
 class File(Resource):
     """
     API Endpoint for files. Includes utilities for uploading and downloading
@@ -51,7 +71,9 @@ class File(Resource):
         to initialize the upload. This creates the temporary record of the
         forthcoming upload that will be passed in chunks to the readChunk
         method. If you pass a "linkUrl" parameter, it will make a link file
-        in the designated parent.
+        in the designated parent. If you pass a "sha512" parameter and the
+        data is already stored in the current assetstore, the file is created
+        immediately and no upload is needed.
         """
         self.requireParams(('name', 'parentId', 'parentType'), params)
         user = self.getCurrentUser()
@@ -71,10 +93,18 @@ class File(Resource):
                 parentType=parentType, creator=user)
         else:
             self.requireParams('size', params)
+            if 'sha512' in params:
+                file = self.model('upload').createFileFromHash(
+                    user=user, name=params['name'], parentType=parentType,
+                    parent=parent, size=int(params['size']),
+                    mimeType=mimeType, sha512=params['sha512'])
+                if file is not None:
+                    return file
             try:
                 upload = self.model('upload').createUpload(
                     user=user, name=params['name'], parentType=parentType,
-                    parent=parent, size=int(params['size']), mimeType=mimeType)
+                    parent=parent, size=int(params['size']), mimeType=mimeType,
+                    parallel=self.boolParam('parallel', params, False))
             except OSError as exc:
                 if exc[0] in (errno.EACCES,):
                     raise Exception('Failed to create upload.')
@@ -94,7 +124,17 @@ class File(Resource):
         .param('mimeType', 'The MIME type of the file.', required=False)
         .param('linkUrl', 'If this is a link file, pass its URL instead'
                'of size and mimeType using this parameter.', required=False)
+        .param('parallel', 'Whether the chunks of this upload may be sent '
+               'out of order and concurrently.', dataType='boolean',
+               required=False)
+        .param('sha512', 'The SHA-512 checksum of the file, as hex. If the '
+               'server already has this data, the file is created without '
+               'uploading it.', required=False)
+        .notes('When a sha512 is given and the data does not need to be '
+               'uploaded, the new file is returned instead of an upload.')
         .errorResponse()
+        .errorResponse('Invalid SHA-512 checksum.')
+        .errorResponse('This assetstore does not support parallel uploads.')
         .errorResponse('Write access was denied on the parent folder.', 403)
         .errorResponse('Failed to create upload.', 500))
 
@@ -150,6 +190,8 @@ class File(Resource):
     requestOffset.description = (
         Description('Request required offset before resuming an upload.')
         .param('uploadId', 'The ID of the upload record.')
+        .notes('For parallel uploads, the response also lists the missing '
+               'byte ranges as [start, end) pairs.')
         .errorResponse("The ID was invalid, or the offset did not match the "
                        "server's record."))
 
@@ -161,9 +203,24 @@ class File(Resource):
         must remain logged in when passing each chunk, to authenticate that
         the writer of the chunk is the same as the person who initiated the
         upload. The passed offset is a verification mechanism for ensuring the
-        server and client agree on the number of bytes sent/received.
+        server and client agree on the number of bytes sent/received. For
+        parallel uploads, chunks may be sent in any order and the offset says
+        where each chunk belongs. The chunk may be sent either as the "chunk"
+        field of a multipart form, or as the whole request body with the
+        application/octet-stream content type and the other parameters in the
+        query string, in which case it is streamed straight into the
+        assetstore.
         """
-        self.requireParams(('offset', 'uploadId', 'chunk'), params)
+        self.requireParams(('offset', 'uploadId'), params)
+        if 'chunk' in params:
+            chunk = params['chunk']
+            if type(chunk) == cherrypy._cpreqbody.Part:
+                chunk = chunk.file
+        elif cherrypy.request.headers.get('Content-Type', '').split(';')[
+                0].strip().lower() == 'application/octet-stream':
+            chunk = RequestBodyChunk(cherrypy.request.body)
+        else:
+            raise RestException('Parameter "chunk" is required.')
         user = self.getCurrentUser()
 
         if not user:
@@ -171,34 +228,42 @@ class File(Resource):
 
         upload = self.model('upload').load(params['uploadId'], exc=True)
         offset = int(params['offset'])
-        chunk = params['chunk']
 
         if upload['userId'] != user['_id']:
             raise AccessException('You did not initiate this upload.')
 
-        if upload['received'] != offset:
+        if 'ranges' in upload:
+            if offset < 0 or offset > upload['size']:
+                raise RestException(
+                    'Offset {} is outside of the upload.'.format(offset))
+        elif upload['received'] != offset:
             raise RestException(
                 'Server has received {} bytes, but client sent offset {}.'
                 .format(upload['received'], offset))
         try:
-            if type(chunk) == cherrypy._cpreqbody.Part:
-                return self.model('upload').handleChunk(upload, chunk.file)
-            else:
-                return self.model('upload').handleChunk(upload, chunk)
+            return self.model('upload').handleChunk(upload, chunk, offset)
         except IOError as exc:
             if exc[0] in (errno.EACCES,):
                 raise Exception('Failed to store upload.')
             raise
     readChunk.description = (
-        Description('Upload a chunk of a file with multipart/form-data.')
+        Description('Upload a chunk of a file.')
         .consumes('multipart/form-data')
+        .consumes('application/octet-stream')
         .param('uploadId', 'The ID of the upload record.', paramType='form')
         .param('offset', 'Offset of the chunk in the file.', dataType='integer',
                paramType='form')
         .param('chunk', 'The actual bytes of the chunk. For external upload '
                'behaviors, this may be set to an opaque string that will be '
                'handled by the assetstore adapter.',
-               dataType='File', paramType='body')
+               dataType='File', paramType='body', required=False)
+        .notes('Instead of a multipart form, the chunk may be sent as the '
+               'request body with Content-Type application/octet-stream, '
+               'passing uploadId and offset in the query string. This avoids '
+               'spooling the chunk on the server before it is stored.  For '
+               'parallel uploads, the chunk that completes the file returns '
+               'the file document; all other chunks return the upload '
+               'document.')
         .errorResponse('ID was invalid.')
         .errorResponse('Received too many bytes.')
         .errorResponse('Chunk is smaller than the minimum size.')
@@ -222,8 +287,13 @@ class File(Resource):
         .param('id', 'The ID of the file.', paramType='path')
         .param('offset', 'Start downloading at this offset in bytes within '
                'the file.', dataType='integer', required=False)
+        .notes('Byte ranges may also be requested with the Range header, '
+               'including multiple ranges.  The ETag and Last-Modified '
+               'response headers can be used in conditional requests '
+               '(If-None-Match, If-Modified-Since and If-Range).')
         .errorResponse('ID was invalid.')
-        .errorResponse('Read access was denied on the parent folder.', 403))
+        .errorResponse('Read access was denied on the parent folder.', 403)
+        .errorResponse('The requested range could not be satisfied.', 416))
 
     @access.public
     def downloadWithName(self, id, name, params):
@@ -280,7 +350,8 @@ class File(Resource):
 
         # Create a new upload record into the existing file
         upload = self.model('upload').createUploadToFile(
-            file=file, user=self.getCurrentUser(), size=int(params['size']))
+            file=file, user=self.getCurrentUser(), size=int(params['size']),
+            parallel=self.boolParam('parallel', params, False))
 
         if upload['size'] > 0:
             return upload
@@ -290,5 +361,8 @@ class File(Resource):
         Description('Change the contents of an existing file.')
         .param('id', 'The ID of the file.', paramType='path')
         .param('size', 'Size in bytes of the new file.', dataType='integer')
+        .param('parallel', 'Whether the chunks of this upload may be sent '
+               'out of order and concurrently.', dataType='boolean',
+               required=False)
         .notes('After calling this, send the chunks just like you would with a '
                'normal file upload.'))
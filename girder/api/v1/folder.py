@@ -22,8 +22,8 @@ import json
 
 from ..describe import Description
 from ..rest import Resource, RestException, loadmodel
-from ...constants import AccessType
-from girder.utility import ziputil
+from ...constants import AccessType, ArchiveFormat
+from girder.utility import range_utils, tarutil, ziputil
 from girder.utility.progress import ProgressContext
 from girder.api import access
 
@@ -62,6 +62,7 @@ class Folder(Resource):
         :param offset: Offset into the results, default=0.
         :param sort: The field to sort by, default=lowerName.
         :param sortdir: 1 for ascending, -1 for descending, default=1.
+        :param cursor: Cursor for the next page when listing by parent.
         """
         limit, offset, sort = self.getPagingParameters(params, 'lowerName')
         user = self.getCurrentUser()
@@ -82,10 +83,14 @@ class Folder(Resource):
                     '$search': params['text']
                 }
 
-            return [self.model('folder').filter(folder, user) for folder in
-                    self.model('folder').childFolders(
-                        parentType=parentType, parent=parent, user=user,
-                        offset=offset, limit=limit, sort=sort, filters=filters)]
+            folders = list(self.model('folder').childFolders(
+                parentType=parentType, parent=parent, user=user, offset=offset,
+                limit=limit, sort=sort, filters=filters,
+                after=self.getPagingCursor(params, sort)))
+            self.setNextCursor(folders, sort, limit)
+
+            return [self.model('folder').filter(folder, user)
+                    for folder in folders]
         elif 'text' in params:
             return [self.model('folder').filter(folder, user) for folder in
                     self.model('folder').textSearch(
@@ -108,6 +113,9 @@ class Folder(Resource):
                required=False)
         .param('sortdir', "1 for ascending, -1 for descending (default=1)",
                required=False, dataType='int')
+        .param('cursor', 'Return the page after the one whose '
+               'Girder-Next-Cursor response header had this value.',
+               required=False)
         .errorResponse()
         .errorResponse('Read access was denied on the parent resource.', 403))
 
@@ -116,25 +124,52 @@ class Folder(Resource):
     def downloadFolder(self, folder, params):
         """
         Returns a generator function that will be used to stream out a zip
-        file containing this folder's contents, filtered by permissions.
+        or tar file containing this folder's contents, filtered by
+        permissions. If the CRC-32 of every file is known, a zip archive is
+        laid out in advance so that its length is sent and byte ranges of it
+        can be requested.
         """
-        cherrypy.response.headers['Content-Type'] = 'application/zip'
+        format = params.get('format') or ArchiveFormat.ZIP
+        if format not in ArchiveFormat.CONTENT_TYPES:
+            raise RestException('Unsupported format.')
+        cherrypy.response.headers['Content-Type'] = \
+            ArchiveFormat.CONTENT_TYPES[format]
         cherrypy.response.headers['Content-Disposition'] = \
-            u'attachment; filename="{}{}"'.format(folder['name'], '.zip')
+            u'attachment; filename="{}.{}"'.format(folder['name'], format)
 
         user = self.getCurrentUser()
+        if format != ArchiveFormat.ZIP:
+            length, stream = tarutil.download(self.model('folder').fileList(
+                folder, user=user, subpath=False, data=False),
+                folder['name'], compress=format == ArchiveFormat.TAR_GZ)
+            if length is not None:
+                cherrypy.response.headers['Content-Length'] = length
+            return stream
+        archive = ziputil.storedArchive(self.model('folder').fileList(
+            folder, user=user, subpath=False, data=False), folder['name'])
+        if archive is not None:
+            return range_utils.sendEntity(
+                archive.size, archive.etag, None, 'application/zip',
+                archive.stream)
 
         def stream():
-            zip = ziputil.ZipGenerator(folder['name'])
-            for (path, file) in self.model('folder').fileList(
-                    folder, user=user, subpath=False):
-                for data in zip.addFile(file, path):
-                    yield data
+            zip = ziputil.fromConfig(folder['name'])
+            for data in zip.addFiles(self.model('folder').fileList(
+                    folder, user=user, subpath=False)):
+                yield data
             yield zip.footer()
         return stream
     downloadFolder.description = (
-        Description('Download an entire folder as a zip archive.')
+        Description('Download an entire folder as an archive.')
+        .notes('When the checksums of all of the files are known, zip '
+               'archives are uncompressed, their Content-Length is sent, and '
+               'Range requests are honored, so downloads can be resumed. With '
+               'format=tar, the Content-Length is always sent; it is not sent '
+               'with format=tar.gz.')
         .param('id', 'The ID of the folder.', paramType='path')
+        .param('format', 'The archive format: zip, tar or tar.gz '
+               '(default=zip).', required=False)
+        .errorResponse('Unsupported format.')
         .errorResponse('ID was invalid.')
         .errorResponse('Read access was denied for the folder.', 403))
 
@@ -67,8 +67,10 @@ class Group(Resource):
                     {'name': params['text']}, offset=offset, limit=limit,
                     sort=sort)
         else:
-            groupList = self.model('group').list(user=user, offset=offset,
-                                                 limit=limit, sort=sort)
+            groupList = list(self.model('group').list(
+                user=user, offset=offset, limit=limit, sort=sort,
+                after=self.getPagingCursor(params, sort)))
+            self.setNextCursor(groupList, sort, limit)
         return [self.model('group').filter(group, user) for group in groupList]
     find.description = (
         Description('Search for groups or list all groups.')
@@ -84,6 +86,9 @@ class Group(Resource):
                required=False, dataType='int')
         .param('exact', 'If true, only return exact name matches.  This is '
                'case senstive.', required=False, dataType='boolean')
+        .param('cursor', 'Return the page after the one whose '
+               'Girder-Next-Cursor response header had this value.',
+               required=False)
         .errorResponse())
 
     @access.user
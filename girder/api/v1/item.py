@@ -22,8 +22,8 @@ import json
 
 from ..describe import Description
 from ..rest import Resource, RestException, loadmodel
-from girder.utility import ziputil
-from girder.constants import AccessType
+from girder.utility import range_utils, tarutil, ziputil
+from girder.constants import AccessType, ArchiveFormat
 from girder.api import access
 
 
@@ -61,6 +61,7 @@ class Item(Resource):
         :param offset: Offset into the results, default=0.
         :param sort: The field to sort by, default=lowerName.
         :param sortdir: 1 for ascending, -1 for descending, default=1.
+        :param cursor: Cursor for the next page when listing by folder.
         """
         limit, offset, sort = self.getPagingParameters(params, 'lowerName')
         user = self.getCurrentUser()
@@ -73,10 +74,12 @@ class Item(Resource):
                 filters['$text'] = {
                     '$search': params['text']
                 }
-            return [self.model('item').filter(item) for item in
-                    self.model('folder').childItems(
-                        folder=folder, limit=limit, offset=offset, sort=sort,
-                        filters=filters)]
+            items = list(self.model('folder').childItems(
+                folder=folder, limit=limit, offset=offset, sort=sort,
+                filters=filters, after=self.getPagingCursor(params, sort)))
+            self.setNextCursor(items, sort, limit)
+
+            return [self.model('item').filter(item) for item in items]
         elif 'text' in params:
             return [self.model('item').filter(item) for item in
                     self.model('item').textSearch(
@@ -99,6 +102,9 @@ class Item(Resource):
                required=False)
         .param('sortdir', "1 for ascending, -1 for descending (default=1)",
                required=False, dataType='int')
+        .param('cursor', 'Return the page after the one whose '
+               'Girder-Next-Cursor response header had this value.',
+               required=False)
         .errorResponse()
         .errorResponse('Read access was denied on the parent folder.', 403))
 
@@ -204,17 +210,32 @@ class Item(Resource):
         .errorResponse('Metadata key name was invalid.')
         .errorResponse('Write access was denied for the item.', 403))
 
-    def _downloadMultifileItem(self, item, user):
-        cherrypy.response.headers['Content-Type'] = 'application/zip'
+    def _downloadMultifileItem(self, item, user, format=ArchiveFormat.ZIP):
+        cherrypy.response.headers['Content-Type'] = \
+            ArchiveFormat.CONTENT_TYPES[format]
         cherrypy.response.headers['Content-Disposition'] =\
-            u'attachment; filename="{}{}"'.format(item['name'], '.zip')
+            u'attachment; filename="{}.{}"'.format(item['name'], format)
+
+        if format != ArchiveFormat.ZIP:
+            length, stream = tarutil.download(self.model('item').fileList(
+                item, subpath=False, data=False), item['name'],
+                compress=format == ArchiveFormat.TAR_GZ)
+            if length is not None:
+                cherrypy.response.headers['Content-Length'] = length
+            return stream
+
+        archive = ziputil.storedArchive(self.model('item').fileList(
+            item, subpath=False, data=False), item['name'])
+        if archive is not None:
+            return range_utils.sendEntity(
+                archive.size, archive.etag, None, 'application/zip',
+                archive.stream)
 
         def stream():
-            zip = ziputil.ZipGenerator(item['name'])
-            for (path, file) in self.model('item').fileList(item,
-                                                            subpath=False):
-                for data in zip.addFile(file, path):
-                    yield data
+            zip = ziputil.fromConfig(item['name'])
+            for data in zip.addFiles(self.model('item').fileList(
+                    item, subpath=False)):
+                yield data
             yield zip.footer()
         return stream
 
@@ -250,19 +271,20 @@ class Item(Resource):
         files = [file for file in self.model('item').childFiles(
                  item=item, limit=2)]
         format = params.get('format', '')
-        if format not in (None, '', 'zip'):
+        if format and format not in ArchiveFormat.CONTENT_TYPES:
             raise RestException('Unsupported format.')
-        if len(files) == 1 and format != 'zip':
+        if len(files) == 1 and not format:
             return self.model('file').download(files[0], offset)
         else:
-            return self._downloadMultifileItem(item, user)
+            return self._downloadMultifileItem(
+                item, user, format or ArchiveFormat.ZIP)
     download.description = (
         Description('Download the contents of an item.')
         .param('id', 'The ID of the item.', paramType='path')
         .param('format', 'If unspecified, items with one file are downloaded '
                'as that file, and other items are downloaded as a zip '
-               'archive.  If \'zip\', a zip archive is always sent',
-               required=False)
+               'archive.  If \'zip\', \'tar\' or \'tar.gz\', an archive in '
+               'that format is always sent', required=False)
         .errorResponse('ID was invalid.')
         .errorResponse('Read access was denied for the item.', 403))
 
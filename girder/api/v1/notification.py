@@ -24,13 +24,12 @@ import time
 from ..describe import Description
 from ..rest import Resource
 from girder.api import access
+from girder.utility.notification_broker import broker
 
 # If no timeout param is passed to stream, we default to this value
 DEFAULT_STREAM_TIMEOUT = 300
-# When new events are seen, we will poll at the minimum interval
-MIN_POLL_INTERVAL = 0.5
-# The interval increases when no new events are seen, capping at this value
-MAX_POLL_INTERVAL = 2
+# How often a waiting stream wakes to check whether the server is stopping
+WAKE_INTERVAL = 1
 
 
 def sseMessage(event):
@@ -65,21 +64,32 @@ class Notification(Resource):
         timeout = int(params.get('timeout', DEFAULT_STREAM_TIMEOUT))
 
         def streamGen():
-            lastUpdate = None
-            start = time.time()
-            wait = MIN_POLL_INTERVAL
-            while time.time() - start < timeout and\
-                    cherrypy.engine.state == cherrypy.engine.states.STARTED:
-                wait = min(wait + MIN_POLL_INTERVAL, MAX_POLL_INTERVAL)
+            # Subscribe before reading outstanding notifications so that
+            # nothing saved in between is missed; duplicates are skipped.
+            with broker.subscribe(user, token) as sub:
+                sent = {}
+
+                def shouldSend(event):
+                    last = sent.get(event['_id'])
+                    if last is not None and last >= event['updated']:
+                        return False
+                    sent[event['_id']] = event['updated']
+                    return True
+
                 for event in self.model('notification').get(
-                        user, lastUpdate, token=token):
-                    if lastUpdate is None or event['updated'] > lastUpdate:
-                        lastUpdate = event['updated']
-                    wait = MIN_POLL_INTERVAL
-                    start = time.time()
-                    yield sseMessage(event)
-
-                time.sleep(wait)
+                        user, token=token):
+                    if shouldSend(event):
+                        yield sseMessage(event)
+
+                start = time.time()
+                while cherrypy.engine.state == cherrypy.engine.states.STARTED:
+                    remaining = timeout - (time.time() - start)
+                    if remaining <= 0:
+                        break
+                    event = sub.get(min(remaining, WAKE_INTERVAL))
+                    if event is not None and shouldSend(event):
+                        start = time.time()
+                        yield sseMessage(event)
         return streamGen
     stream.description = (
         Description('Stream notifications for a given user via the SSE '
@@ -87,8 +97,8 @@ class Notification(Resource):
         .notes('This uses long-polling to keep the connection open for '
                'several minutes at a time (or longer) and should be requested '
                'with an EventSource object or other SSE-capable client. '
-               '<p>Notifications are returned within a few seconds of when '
-               'they occur.  When no notication occurs for the timeout '
+               '<p>Notifications are pushed to the stream as soon as they '
+               'occur.  When no notication occurs for the timeout '
                'duration, the stream is closed. '
                '<p>This connection can stay open indefinitely long.')
         .param('timeout', 'The duration without a notification before the '
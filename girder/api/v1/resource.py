@@ -22,10 +22,10 @@ import json
 
 from ..describe import Description
 from ..rest import Resource as BaseResource, RestException
-from girder.constants import AccessType
+from girder.constants import AccessType, ArchiveFormat
 from girder.api import access
 from girder.models.model_base import AccessControlledModel
-from girder.utility import ziputil
+from girder.utility import range_utils, tarutil, ziputil
 from girder.utility.progress import ProgressContext
 
 
@@ -142,11 +142,14 @@ class Resource(BaseResource):
     def download(self, params):
         """
         Returns a generator function that will be used to stream out a zip
-        file containing the listed resource's contents, filtered by
+        or tar file containing the listed resource's contents, filtered by
         permissions.
         """
         user = self.getCurrentUser()
         resources = self._validateResourceSet(params)
+        format = params.get('format') or ArchiveFormat.ZIP
+        if format not in ArchiveFormat.CONTENT_TYPES:
+            raise RestException('Unsupported format.')
         # Check that all the resources are valid, so we don't download the zip
         # file if it would throw an error.
         for kind in resources:
@@ -156,31 +159,55 @@ class Resource(BaseResource):
                     raise RestException('Resource %s %s not found.' %
                                         (kind, id))
         metadata = self.boolParam('includeMetadata', params, default=False)
-        cherrypy.response.headers['Content-Type'] = 'application/zip'
+        cherrypy.response.headers['Content-Type'] = \
+            ArchiveFormat.CONTENT_TYPES[format]
         cherrypy.response.headers['Content-Disposition'] = \
-            'attachment; filename="Resources.zip"'
+            'attachment; filename="Resources.{}"'.format(format)
 
-        def stream():
-            zip = ziputil.ZipGenerator()
+        def fileList(data=True):
             for kind in resources:
                 model = self.model(kind)
                 for id in resources[kind]:
                     doc = model.load(id=id, user=user, level=AccessType.READ)
                     for (path, file) in model.fileList(
                             doc=doc, user=user, includeMetadata=metadata,
-                            subpath=True):
-                        for data in zip.addFile(file, path):
-                            yield data
+                            subpath=True, data=data):
+                        yield (path, file)
+
+        if format != ArchiveFormat.ZIP:
+            length, stream = tarutil.download(
+                fileList(data=False), compress=format == ArchiveFormat.TAR_GZ)
+            if length is not None:
+                cherrypy.response.headers['Content-Length'] = length
+            return stream
+        archive = ziputil.storedArchive(fileList(data=False))
+        if archive is not None:
+            return range_utils.sendEntity(
+                archive.size, archive.etag, None, 'application/zip',
+                archive.stream)
+
+        def stream():
+            zip = ziputil.fromConfig()
+            for data in zip.addFiles(fileList()):
+                yield data
             yield zip.footer()
         return stream
     download.description = (
         Description('Download a set of items, folders, collections, and users '
-                    'as a zip archive.')
+                    'as an archive.')
+        .notes('When the checksums of all of the files are known, zip '
+               'archives are uncompressed, their Content-Length is sent, and '
+               'Range requests are honored, so downloads can be resumed. With '
+               'format=tar, the Content-Length is always sent; it is not sent '
+               'with format=tar.gz.')
         .param('resources', 'A JSON-encoded list of types to download.  Each '
                'type is a list of ids.  For example: {"item": [(item id 1), '
                '(item id 2)], "folder": [(folder id 1)]}.')
         .param('includeMetadata', 'Include any metadata in json files in the '
                'archive.', required=False, dataType='boolean')
+        .param('format', 'The archive format: zip, tar or tar.gz '
+               '(default=zip).', required=False)
+        .errorResponse('Unsupported format.')
         .errorResponse('Unsupport or unknown resource type.')
         .errorResponse('Invalid resources format.')
         .errorResponse('No resources specified.')
@@ -22,8 +22,10 @@ import datetime
 import errno
 import json
 
+from girder import events
 from girder.api import access
-from girder.utility import plugin_utilities
+from girder.models.model_base import getIdentityMapStats
+from girder.utility import download_cache, plugin_utilities
 from girder.constants import SettingKey, VERSION
 from ..describe import API_VERSION, Description
 from ..rest import Resource, RestException
@@ -39,6 +41,9 @@ class System(Resource):
         self.resourceName = 'system'
         self.route('DELETE', ('setting',), self.unsetSetting)
         self.route('GET', ('version',), self.getVersion)
+        self.route('GET', ('identity_map',), self.getIdentityMapStats)
+        self.route('GET', ('event_stats',), self.getEventStats)
+        self.route('GET', ('download_cache',), self.getDownloadCacheStats)
         self.route('GET', ('setting',), self.getSetting)
         self.route('GET', ('plugins',), self.getPlugins)
         self.route('PUT', ('setting',), self.setSetting)
@@ -154,6 +159,39 @@ class System(Resource):
     getVersion.description = Description(
         'Get the version information for this server.')
 
+    @access.admin
+    def getIdentityMapStats(self, params):
+        return getIdentityMapStats()
+    getIdentityMapStats.description = (
+        Description('Get the identity map hit and miss counts per endpoint.')
+        .notes('Must be a system administrator to call this. Each hit is a '
+               'database round trip that was avoided by reusing a document '
+               'already loaded during the same request.')
+        .errorResponse('You are not a system administrator.', 403))
+
+    @access.admin
+    def getEventStats(self, params):
+        return {
+            'handlers': events.getStats(),
+            'async': events.daemon.getStats()
+        }
+    getEventStats.description = (
+        Description('Get the call counts and time spent in each event handler.')
+        .notes('Must be a system administrator to call this. Only events '
+               'with bound handlers are counted. The "async" key holds the '
+               'queue depth and latency of asynchronous events.')
+        .errorResponse('You are not a system administrator.', 403))
+
+    @access.admin
+    def getDownloadCacheStats(self, params):
+        return download_cache.getStats()
+    getDownloadCacheStats.description = (
+        Description('Get the size and hit, miss and eviction counts of the '
+                    'download cache.')
+        .notes('Must be a system administrator to call this. If no download '
+               'cache is configured, only "enabled" is returned, as false.')
+        .errorResponse('You are not a system administrator.', 403))
+
     @access.admin
     def enablePlugins(self, params):
         self.requireParams('plugins', params)
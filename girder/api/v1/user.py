@@ -56,14 +56,18 @@ class User(Resource):
         :param offset: Offset into the results, default=0.
         :param sort: The field to sort by, default=name.
         :param sortdir: 1 for ascending, -1 for descending, default=1.
+        :param cursor: Cursor for the next page when not searching.
         """
         limit, offset, sort = self.getPagingParameters(params, 'lastName')
         currentUser = self.getCurrentUser()
 
-        return [self.model('user').filter(user, currentUser)
-                for user in self.model('user').search(
-                    text=params.get('text'), user=currentUser,
-                    offset=offset, limit=limit, sort=sort)]
+        users = list(self.model('user').search(
+            text=params.get('text'), user=currentUser, offset=offset,
+            limit=limit, sort=sort, after=self.getPagingCursor(params, sort)))
+        if 'text' not in params:
+            self.setNextCursor(users, sort, limit)
+
+        return [self.model('user').filter(user, currentUser) for user in users]
     find.description = (
         Description('List or search for users.')
         .responseClass('User')
@@ -76,7 +80,10 @@ class User(Resource):
         .param('sort', "Field to sort the user list by (default=lastName)",
                required=False)
         .param('sortdir', "1 for ascending, -1 for descending (default=1)",
-               required=False, dataType='int'))
+               required=False, dataType='int')
+        .param('cursor', 'Return the page after the one whose '
+               'Girder-Next-Cursor response header had this value.',
+               required=False))
 
     @access.public
     @loadmodel(map={'id': 'userToGet'}, model='user', level=AccessType.READ)
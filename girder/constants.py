@@ -96,6 +96,22 @@ class AssetstoreType:
     S3 = 2
 
 
+class ArchiveFormat:
+    """
+    Formats that folders, items and resources can be downloaded as, and the
+    content type of each.
+    """
+    ZIP = 'zip'
+    TAR = 'tar'
+    TAR_GZ = 'tar.gz'
+
+    CONTENT_TYPES = {
+        ZIP: 'application/zip',
+        TAR: 'application/x-tar',
+        TAR_GZ: 'application/gzip'
+    }
+
+
 class AccessType:
     """
     Represents the level of access granted to a user or group on an
@@ -130,6 +146,7 @@ class SettingKey:
     CORS_ALLOW_ORIGIN = 'core.cors.allow_origin'
     CORS_ALLOW_METHODS = 'core.cors.allow_methods'
     CORS_ALLOW_HEADERS = 'core.cors.allow_headers'
+    ANCESTORS_COMPLETE = 'core.ancestors_complete'
 
 
 class SettingDefault:
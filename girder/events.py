@@ -39,14 +39,24 @@ For obvious reasons, the asynchronous method does not return a value to the
 caller. Instead, the caller may optionally pass the callback argument as a
 function to be called when the task is finished. That callback function will
 receive the Event object as its only argument.
+
+Handlers are called in order of decreasing priority, which may be passed to
+bind(), and then in the order they were bound. The number of times each event
+and each of its handlers is called, and the time spent in them, is recorded
+and can be retrieved with getStats().
 """
 
+import collections
+import copy
+import itertools
 import Queue
 import threading
+import time
 import types
 
 from .constants import TerminalColor
 from girder import logger
+from girder.utility import config
 
 
 class Event(object):
@@ -106,37 +116,156 @@ class Event(object):
         self.responses.append(response)
 
 
-class AsyncEventsThread(threading.Thread):
+class _NoListenersEvent(Event):
     """
-    This class is used to execute the pipeline for events asynchronously.
-    This should not be invoked directly by callers; instead, they should use
-    girder.events.daemon.trigger().
+    The shared result of triggering an event that has no listeners bound. It
+    has no name or info, and no effect can be had on it, so that no object
+    needs to be allocated for the many events that nobody is listening to.
     """
+    __slots__ = ()
+
     def __init__(self):
-        threading.Thread.__init__(self)
-        self.daemon = True
-        self.terminate = False
-        self.eventQueue = Queue.Queue()
+        Event.__init__(self, None, None)
+        self.responses = ()
 
-    def run(self):
+    def preventDefault(self):
+        return self
+
+    def stopPropagation(self):
+        return self
+
+    def addResponse(self, response):
+        pass
+
+
+class AsyncEventsExecutor(object):
+    """
+    This class is used to execute the pipeline for events asynchronously on a
+    pool of worker threads. This should not be invoked directly by callers;
+    instead, they should use girder.events.daemon.trigger().
+
+    The pool is configured by the [events] section of the config file:
+
+    * ``workers``: the number of worker threads.
+    * ``queue_size``: the maximum number of events waiting to be handled.
+    * ``full_policy``: what trigger() does when the queue is full. "block"
+      waits for room in the queue, "drop" discards the event, and "inline"
+      handles it in the calling thread. Until the workers are started, a
+      full queue is always handled inline so that callers can't deadlock.
+    * ``concurrency``: a dict mapping event names to the maximum number of
+      those events that may be handled at the same time. Events over the
+      limit wait without occupying a worker.
+    * ``drain_timeout``: the number of seconds stop() waits for pending events
+      to be handled.
+    """
+    BLOCK = 'block'
+    DROP = 'drop'
+    INLINE = 'inline'
+
+    _stop = object()
+
+    def __init__(self, workers=None, queueSize=None, fullPolicy=None,
+                 concurrency=None, drainTimeout=None):
+        conf = config.getConfig().get('events', {})
+        self.workers = workers or int(conf.get('workers', 4))
+        self.fullPolicy = fullPolicy or conf.get('full_policy', self.BLOCK)
+        self.concurrency = dict(concurrency or conf.get('concurrency', {}))
+        if drainTimeout is None:
+            drainTimeout = float(conf.get('drain_timeout', 30))
+        self.drainTimeout = drainTimeout
+        self.eventQueue = Queue.Queue(
+            queueSize or int(conf.get('queue_size', 1000)))
+
+        if self.fullPolicy not in (self.BLOCK, self.DROP, self.INLINE):
+            raise Exception('Invalid events full_policy: {}'.format(
+                self.fullPolicy))
+
+        self._threads = []
+        self._cond = threading.Condition()
+        self._outstanding = 0
+        self._running = collections.defaultdict(int)
+        self._deferred = collections.defaultdict(collections.deque)
+        self._counts = collections.defaultdict(int)
+        self._latency = {}
+
+    def start(self):
         """
-        Loops over all queued events. If the queue is empty, this thread gets
-        put to sleep until someone calls trigger() on it with a new event to
-        dispatch.
+        Start the worker threads. Events that were queued before this is
+        called will then be handled.
         """
-        print TerminalColor.info('Started asynchronous event manager thread.')
+        if self._threads:
+            return
 
-        while not self.terminate:
-            eventName, info, callback = self.eventQueue.get(block=True)
-            try:
-                event = trigger(eventName, info)
-                if isinstance(callback, types.FunctionType):
-                    callback(event)
-            except:
-                logger.exception('In handler for event "{}":'.format(eventName))
-                pass  # Must continue the event loop even if handler failed
+        for i in xrange(self.workers):
+            thread = threading.Thread(target=self.run,
+                                      name='girder-events-{}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
 
-        print TerminalColor.info('Stopped asynchronous event manager thread.')
+        print TerminalColor.info(
+            'Started {} asynchronous event worker threads.'.format(
+                self.workers))
+
+    def run(self):
+        """
+        Loops over all queued events. If the queue is empty, this worker gets
+        put to sleep until someone calls trigger() with a new event to
+        dispatch.
+        """
+        while True:
+            item = self.eventQueue.get(block=True)
+            if item is self._stop:
+                break
+
+            eventName = item[0]
+            with self._cond:
+                limit = self.concurrency.get(eventName)
+                if limit is not None and self._running[eventName] >= limit:
+                    self._deferred[eventName].append(item)
+                    continue
+                self._running[eventName] += 1
+
+            # Once a handler finishes, run any events of the same name that
+            # were deferred because of the concurrency limit.
+            while item is not None:
+                self._handle(item)
+                with self._cond:
+                    if self._deferred[eventName]:
+                        item = self._deferred[eventName].popleft()
+                    else:
+                        item = None
+                        self._running[eventName] -= 1
+
+    def _handle(self, item):
+        eventName, info, callback, queued = item
+        start = time.time()
+        try:
+            event = trigger(eventName, info)
+            if isinstance(callback, types.FunctionType):
+                if event is _noListeners:
+                    event = Event(eventName, info)
+                callback(event)
+        except:
+            logger.exception('In handler for event "{}":'.format(eventName))
+            pass  # Must continue the event loop even if handler failed
+        finally:
+            end = time.time()
+            with self._cond:
+                latency = self._latency.get(eventName)
+                if latency is None:
+                    latency = self._latency[eventName] = {
+                        'count': 0,
+                        'waitSeconds': 0.0,
+                        'handleSeconds': 0.0
+                    }
+                latency['count'] += 1
+                latency['waitSeconds'] += start - queued
+                latency['handleSeconds'] += end - start
+
+                self._counts['handled'] += 1
+                self._outstanding -= 1
+                self._cond.notify_all()
 
     def trigger(self, eventName, info=None, callback=None):
         """
@@ -144,18 +273,124 @@ class AsyncEventsThread(threading.Thread):
 
         :param eventName: The event name to pass to the girder.events.trigger
         :param info: The info object to pass to girder.events.trigger
+        :param callback: A function to call with the Event once it has been
+                         handled.
         """
-        self.eventQueue.put((eventName, info, callback))
+        item = (eventName, info, callback, time.time())
+        with self._cond:
+            self._outstanding += 1
+
+        policy = self.fullPolicy if self._threads else self.INLINE
+        try:
+            self.eventQueue.put(item, block=(policy == self.BLOCK))
+            return
+        except Queue.Full:
+            pass
+
+        if policy == self.DROP:
+            logger.warning(
+                'Asynchronous event queue is full; dropped "{}".'.format(
+                    eventName))
+            with self._cond:
+                self._counts['dropped'] += 1
+                self._outstanding -= 1
+                self._cond.notify_all()
+        else:
+            with self._cond:
+                self._counts['inline'] += 1
+            self._handle(item)
 
     def stop(self):
         """
-        Gracefully stops this thread. Will finish the currently processing
-        event before stopping.
+        Gracefully stops the worker threads. Waits up to drainTimeout seconds
+        for the events that have already been triggered to be handled. Any
+        events still queued or deferred after that are discarded and counted
+        as dropped, and each worker finishes its current event and exits.
         """
-        self.terminate = True
+        deadline = time.time() + self.drainTimeout
+        with self._cond:
+            while self._outstanding > 0 and self._threads:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            timedOut = self._outstanding > 0 and self._threads
+
+        if timedOut:
+            self._discardPending()
+
+        threads, self._threads = self._threads, []
+        for thread in threads:
+            self.eventQueue.put(self._stop)
+        for thread in threads:
+            thread.join(max(deadline - time.time(), 0.1))
+
+        if threads:
+            print TerminalColor.info(
+                'Stopped asynchronous event worker threads.')
+
+    def _discardPending(self):
+        """
+        Remove every event that is waiting in the queue or on a concurrency
+        limit so that the stop sentinels are not stuck behind them.
+        """
+        dropped = 0
+        while True:
+            try:
+                self.eventQueue.get_nowait()
+            except Queue.Empty:
+                break
+            dropped += 1
+
+        with self._cond:
+            for deferred in self._deferred.values():
+                dropped += len(deferred)
+                deferred.clear()
+            self._counts['dropped'] += dropped
+            self._outstanding -= dropped
+            self._cond.notify_all()
+
+        logger.warning(
+            'Stopping with asynchronous events pending; dropped {}.'.format(
+                dropped))
+
+    def getStats(self):
+        """
+        Return metrics about the asynchronous events: the current queue depth,
+        the number of events being handled or waiting on a concurrency limit,
+        totals of events handled, dropped, or run inline because the queue was
+        full, and per event name, the time spent waiting in the queue and
+        being handled.
+        """
+        with self._cond:
+            return {
+                'workers': len(self._threads),
+                'queued': self.eventQueue.qsize(),
+                'running': sum(self._running.values()),
+                'deferred': sum(len(d) for d in self._deferred.values()),
+                'handled': self._counts['handled'],
+                'dropped': self._counts['dropped'],
+                'inline': self._counts['inline'],
+                'events': copy.deepcopy(self._latency)
+            }
+
+
+def _updateDispatch(eventName):
+    """
+    Rebuild the tuple of handlers that trigger() calls for an event, in the
+    order they should be called.
+    """
+    handlers = _mapping.get(eventName)
+    if handlers:
+        order = _order[eventName]
+        _dispatch[eventName] = tuple(
+            (name, handlers[name])
+            for name in sorted(handlers, key=lambda name: order[name]))
+    else:
+        _dispatch.pop(eventName, None)
 
 
-def bind(eventName, handlerName, handler):
+def bind(eventName, handlerName, handler, priority=0):
     """
     Bind a listener (handler) to the event identified by eventName. It is
     convention that plugins will use their own name as the handlerName, so that
@@ -172,12 +407,19 @@ def bind(eventName, handlerName, handler):
                     triggerer should be passed via the addResponse() method of
                     the Event.
     :type handler: function
+    :param priority: Handlers with a higher priority are called first. Those
+                     with equal priority are called in the order they were
+                     bound.
+    :type priority: int
     """
     global _mapping
     if eventName not in _mapping:
         _mapping[eventName] = {}
+        _order[eventName] = {}
 
     _mapping[eventName][handlerName] = handler
+    _order[eventName][handlerName] = (-priority, next(_bindSequence))
+    _updateDispatch(eventName)
 
 
 def unbind(eventName, handlerName):
@@ -192,14 +434,18 @@ def unbind(eventName, handlerName):
     global _mapping
     if eventName in _mapping and handlerName in _mapping[eventName]:
         del _mapping[eventName][handlerName]
+        del _order[eventName][handlerName]
+        _updateDispatch(eventName)
 
 
 def unbindAll():
     """
     Clears the entire event map. Any bound listeners will be unbound.
     """
-    global _mapping
+    global _mapping, _order, _dispatch
     _mapping = {}
+    _order = {}
+    _dispatch = {}
 
 
 def trigger(eventName, info=None):
@@ -208,22 +454,88 @@ def trigger(eventName, info=None):
     called until they are exhausted or one of the handlers calls the
     stopPropagation() method on the event.
 
+    If no listeners are bound, a shared Event with no name or info is returned
+    without doing any other work.
+
     :param eventName: The name that identifies the event.
     :type eventName: str
     :param info: The info argument to pass to the handler function. The
                  type of this argument is opaque, and can be anything.
     """
-    global _mapping
+    handlers = _dispatch.get(eventName)
+    if handlers is None:
+        return _noListeners
+
     e = Event(eventName, info)
-    for handlerName, handler in _mapping.get(eventName, {}).iteritems():
-        e.currentHandlerName = handlerName
-        handler(e)
+    timings = []
+    start = time.time()
+    try:
+        for handlerName, handler in handlers:
+            e.currentHandlerName = handlerName
+            handlerStart = time.time()
+            try:
+                handler(e)
+            finally:
+                timings.append((handlerName, time.time() - handlerStart))
 
-        if e.propagate is False:
-            break
+            if e.propagate is False:
+                break
+    finally:
+        _recordStats(eventName, time.time() - start, timings)
 
     return e
 
 
+def _recordStats(eventName, duration, timings):
+    with _statsLock:
+        stats = _stats.get(eventName)
+        if stats is None:
+            stats = _stats[eventName] = {
+                'count': 0,
+                'seconds': 0.0,
+                'handlers': {}
+            }
+        stats['count'] += 1
+        stats['seconds'] += duration
+
+        for handlerName, handlerDuration in timings:
+            handlerStats = stats['handlers'].get(handlerName)
+            if handlerStats is None:
+                handlerStats = stats['handlers'][handlerName] = {
+                    'count': 0,
+                    'seconds': 0.0
+                }
+            handlerStats['count'] += 1
+            handlerStats['seconds'] += handlerDuration
+
+
+def getStats():
+    """
+    Return the number of times each event with listeners has been triggered
+    and the total time spent handling it, broken down by handler. Events
+    without any listeners are not counted.
+
+    :returns: A dict keyed by event name. Each value is a dict with 'count',
+              'seconds', and 'handlers' keys; the last maps handler names to
+              dicts with their own 'count' and 'seconds'.
+    """
+    with _statsLock:
+        return copy.deepcopy(_stats)
+
+
+def resetStats():
+    """
+    Clear the statistics returned by getStats().
+    """
+    with _statsLock:
+        _stats.clear()
+
+
 _mapping = {}
-daemon = AsyncEventsThread()
+_order = {}
+_dispatch = {}
+_bindSequence = itertools.count()
+_noListeners = _NoListenersEvent()
+_stats = {}
+_statsLock = threading.Lock()
+daemon = AsyncEventsExecutor()
@@ -18,16 +18,28 @@
 ###############################################################################
 
 import datetime
+import hashlib
 import pymongo
+import Queue
+import threading
+import time
 
-from .model_base import Model, ValidationException
+from .model_base import Model, ValidationException, identityMap
+from girder import logger
 from girder.utility import assetstore_utilities
+from girder.utility.progress import noProgress
 from girder.utility.filesystem_assetstore_adapter import\
     FilesystemAssetstoreAdapter
 from girder.utility.gridfs_assetstore_adapter import GridFsAssetstoreAdapter
 from girder.utility.s3_assetstore_adapter import S3AssetstoreAdapter
 from girder.constants import AssetstoreType
 
+# Fields of a file document that locate its data within an assetstore, and
+# the subset of them that identify the data.
+STORAGE_FIELDS = ('path', 'chunkUuid', 'chunkSize', 'relpath', 's3Key',
+                  's3Verified', 's3FinalizeRequest', 'imported', 'mtime')
+LOCATION_FIELDS = ('path', 'chunkUuid', 's3Key')
+
 
 class Assetstore(Model):
     """
@@ -70,8 +82,20 @@ class Assetstore(Model):
         if doc['current'] is True:
             self.update({'current': True}, {'$set': {'current': False}})
 
+        # The modification time identifies cached adapters for this assetstore
+        doc['updated'] = datetime.datetime.utcnow()
+
         return doc
 
+    def save(self, document, validate=True, triggerEvents=True):
+        """
+        Save the assetstore and discard any cached adapter for it.
+        """
+        document = Model.save(self, document, validate=validate,
+                              triggerEvents=triggerEvents)
+        assetstore_utilities.clearAdapterCache(document['_id'])
+        return document
+
     def remove(self, assetstore, **kwargs):
         """
         Delete an assetstore. If there are any files within this assetstore,
@@ -93,6 +117,8 @@ class Assetstore(Model):
             pass
         # now remove the assetstore
         Model.remove(self, assetstore)
+        self.model('blob').removeWithQuery({'assetstoreId': assetstore['_id']})
+        assetstore_utilities.clearAdapterCache(assetstore['_id'])
         # If after removal there is no current assetstore, then pick a
         # different assetstore to be the current one.
         current = self.findOne({'current': True})
@@ -116,6 +142,9 @@ class Assetstore(Model):
         for assetstore in cursor:
             adapter = assetstore_utilities.getAssetstoreAdapter(assetstore)
             assetstore['capacity'] = adapter.capacityInfo()
+            if assetstore['type'] == AssetstoreType.FILESYSTEM:
+                assetstore['storage'] = self.model('blob').storageInfo(
+                    assetstore)
             assetstore['hasFiles'] = (self.model('file').findOne(
                 {'assetstoreId': assetstore['_id']}) is not None)
             assetstores.append(assetstore)
@@ -154,6 +183,186 @@ class Assetstore(Model):
             'service': service
         })
 
+    def migrate(self, source, target, workers=4, removeSource=False,
+                batchSize=1000, progress=noProgress):
+        """
+        Move the data of every file in one assetstore into another. Each
+        file's data is streamed from the source adapter through the upload
+        path of the target adapter by a pool of worker threads, checked
+        against the file's size and SHA-512 checksum, and then the file is
+        switched to the target in a single atomic update. Files that fail are
+        logged and left in the source assetstore. Since only files still in
+        the source are visited, an interrupted migration is resumed by
+        running it again.
+
+        :param source: The assetstore to move files out of.
+        :type source: dict
+        :param target: The assetstore to move files into.
+        :type target: dict
+        :param workers: The number of files to move at once.
+        :type workers: int
+        :param removeSource: Whether to delete the data of each moved file
+            from the source assetstore.
+        :type removeSource: bool
+        :param batchSize: The number of file records to read per query.
+        :type batchSize: int
+        :param progress: A progress context to record progress on.
+        :type progress: girder.utility.progress.ProgressContext or None.
+        :returns: A dict with the number of files moved, their total size,
+            and the number of files that failed.
+        """
+        if source['_id'] == target['_id']:
+            raise ValidationException(
+                'The source and target assetstores must be different.',
+                'targetId')
+        if workers < 1:
+            raise ValidationException(
+                'There must be at least one worker.', 'workers')
+
+        sourceAdapter = assetstore_utilities.getAssetstoreAdapter(source)
+        targetAdapter = assetstore_utilities.getAssetstoreAdapter(target)
+        query = {'assetstoreId': source['_id']}
+        total = self.model('file').find(query, limit=0, fields=[]).count()
+        info = {'files': 0, 'size': 0, 'failed': 0}
+        lock = threading.Lock()
+        queue = Queue.Queue(maxsize=2 * workers)
+
+        def work():
+            while True:
+                file = queue.get()
+                if file is None:
+                    return
+                try:
+                    self._migrateFile(file, source, target, sourceAdapter,
+                                      targetAdapter, removeSource)
+                    moved = True
+                except Exception:
+                    logger.exception('Failed to migrate file {}.'.format(
+                        file['_id']))
+                    moved = False
+                with lock:
+                    if moved:
+                        info['files'] += 1
+                        info['size'] += file['size']
+                    else:
+                        info['failed'] += 1
+
+        def report():
+            # Progress is only recorded from the calling thread
+            with lock:
+                current = info['files'] + info['failed']
+            progress.update(current=current, message='Migrated {} of {} '
+                            'files'.format(current, total))
+
+        progress.update(total=total, current=0, message='Migrating files')
+        threads = [threading.Thread(target=work) for _ in xrange(workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            # Page by _id rather than holding one cursor open, as the query
+            # matches fewer files as they are moved.
+            while True:
+                files = list(self.model('file').find(
+                    query, limit=batchSize, sort=[('_id', pymongo.ASCENDING)]))
+                if not files:
+                    break
+                for file in files:
+                    queue.put(file)
+                    report()
+                query['_id'] = {'$gt': files[-1]['_id']}
+        finally:
+            for thread in threads:
+                queue.put(None)
+            while any(thread.is_alive() for thread in threads):
+                report()
+                time.sleep(0.1)
+        report()
+        return info
+
+    def _migrateFile(self, file, source, target, sourceAdapter,
+                     targetAdapter, removeSource):
+        """
+        Move the data of one file into the target assetstore. If the file is
+        changed by another request while its data is copied, the copy is
+        discarded.
+        """
+        fileModel = self.model('file')
+        upload = targetAdapter.initUpload({
+            'assetstoreId': target['_id'],
+            'fileId': file['_id'],
+            'userId': file.get('creatorId'),
+            'name': file['name'],
+            'mimeType': file.get('mimeType'),
+            'size': file['size'],
+            'received': 0
+        })
+        checksum = hashlib.sha512()
+
+        def stream():
+            for data in sourceAdapter.readFile(file)():
+                checksum.update(data)
+                yield data
+
+        try:
+            upload = targetAdapter.uploadFromStream(upload, stream())
+            sha512 = checksum.hexdigest()
+            if (upload['received'] != file['size'] or
+                    file.get('sha512', sha512) != sha512):
+                raise ValidationException(
+                    'Data read for file {} does not match its size or '
+                    'checksum.'.format(file['_id']))
+        except Exception:
+            targetAdapter.cancelUpload(upload)
+            raise
+
+        stored = targetAdapter.finalizeUpload(upload, {
+            '_id': file['_id'],
+            'itemId': file['itemId'],
+            'name': file['name'],
+            'assetstoreId': target['_id'],
+            'size': file['size']
+        })
+        fields = {k: v for k, v in stored.iteritems()
+                  if k not in ('_id', 'itemId', 'name')}
+        if fields.setdefault('sha512', sha512) != sha512:
+            targetAdapter.deleteFile(stored)
+            raise ValidationException(
+                'The data stored for file {} does not match its '
+                'checksum.'.format(file['_id']))
+
+        location = {k: file[k] for k in LOCATION_FIELDS if k in file}
+        query = {
+            '_id': file['_id'],
+            'assetstoreId': source['_id'],
+            'size': file['size']
+        }
+        query.update(location)
+        update = {'$set': fields}
+        unset = {k: True for k in STORAGE_FIELDS
+                 if k in file and k not in fields}
+        if unset:
+            update['$unset'] = unset
+        result = fileModel.collection.update(query, update)
+        identityMap.invalidate(fileModel.name, file['_id'])
+
+        if not result['updatedExisting']:
+            targetAdapter.deleteFile(stored)
+            raise ValidationException(
+                'File {} was changed while it was migrated.'.format(
+                    file['_id']))
+
+        if removeSource:
+            # Copies of a file share its data, which is only deleted once none
+            # of them is left in the source assetstore.
+            remaining = 0
+            if location:
+                remaining = fileModel.find(
+                    dict(location, assetstoreId=source['_id']), limit=1,
+                    fields=[]).count(True)
+            if not remaining:
+                sourceAdapter.deleteData(file)
+
     def getCurrent(self):
         """
         Returns the current assetstore. If none exists, this will raise a 500
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import pymongo
+
+from .model_base import Model
+from girder.utility.progress import noProgress
+
+
+class Blob(Model):
+    """
+    This model keeps a reference count for each piece of data stored in a
+    content-addressed assetstore, keyed by the assetstore and the SHA-512 of
+    the data. Counts are changed atomically as files are created, copied and
+    deleted, so the assetstore can tell when data is no longer used without
+    querying the file collection.
+
+    Databases created before this model existed have no blob records. These
+    are created lazily from the file collection the first time a reference
+    is added, and can be rebuilt for a whole assetstore with ``reconcile``.
+    """
+    def initialize(self):
+        self.name = 'blob'
+        self.ensureIndex(([('assetstoreId', pymongo.ASCENDING),
+                           ('sha512', pymongo.ASCENDING)], {'unique': True}))
+
+    def validate(self, doc):
+        return doc
+
+    def addReference(self, file):
+        """
+        Record that a file refers to its data. Call this before the file is
+        saved.
+
+        :param file: The file document, with its assetstoreId, sha512 and size.
+        :type file: dict
+        """
+        key = {'assetstoreId': file['assetstoreId'], 'sha512': file['sha512']}
+        result = self.collection.update(key, {'$inc': {'refCount': 1}})
+        if result['updatedExisting']:
+            return
+
+        # There is no record yet; files created before reference counting
+        # may already use this data, so count them.
+        query = dict(key, imported={'$exists': False})
+        if '_id' in file:
+            query['_id'] = {'$ne': file['_id']}
+        existing = self.model('file').find(query, limit=0, fields=[]).count()
+        doc = dict(key, refCount=existing + 1, size=file['size'])
+        try:
+            self.collection.insert(doc)
+        except pymongo.errors.DuplicateKeyError:
+            # Another reference created the record first
+            self.collection.update(key, {'$inc': {'refCount': 1}})
+
+    def removeReference(self, file):
+        """
+        Record that a file no longer refers to its data.
+
+        :param file: The file document being deleted.
+        :type file: dict
+        :returns: True if no files refer to the data any more and it should be
+            deleted, False if it is still in use, or None if the data has no
+            blob record, in which case the caller must check the file
+            collection itself.
+        """
+        key = {'assetstoreId': file['assetstoreId'], 'sha512': file['sha512']}
+        doc = self.collection.find_and_modify(
+            key, {'$inc': {'refCount': -1}}, new=True)
+        if doc is None:
+            return None
+        if doc['refCount'] > 0:
+            return False
+        # Only the caller that removes the record deletes the data
+        result = self.collection.remove(
+            {'_id': doc['_id'], 'refCount': {'$lte': 0}})
+        return result['n'] > 0
+
+    def reconcile(self, assetstore, batchSize=1000, progress=noProgress):
+        """
+        Rebuild the reference counts of an assetstore from the file
+        collection. Run this once after upgrading an existing database, or to
+        repair the counts. Files should not be created or deleted in the
+        assetstore while this runs.
+
+        :param assetstore: The assetstore to reconcile.
+        :type assetstore: dict
+        :param batchSize: The number of records to write per bulk operation.
+        :type batchSize: int
+        :param progress: A progress context to record progress on.
+        :type progress: girder.utility.progress.ProgressContext or None.
+        :returns: A dict with the number of files, the number of distinct
+            blobs, the total size of the files and the deduplicated size of
+            the blobs.
+        """
+        counts = {}
+        info = {'files': 0, 'blobs': 0, 'size': 0, 'storedSize': 0}
+        cursor = self.model('file').find({
+            'assetstoreId': assetstore['_id'],
+            'sha512': {'$exists': True},
+            'imported': {'$exists': False}
+        }, limit=0, fields=['sha512', 'size'], timeout=False)
+        for file in cursor:
+            if file['sha512'] in counts:
+                counts[file['sha512']][0] += 1
+            else:
+                counts[file['sha512']] = [1, file['size']]
+            info['files'] += 1
+            info['size'] += file['size']
+        cursor.close()
+
+        progress.update(total=len(counts), current=0,
+                        message='Updating reference counts')
+        hashes = counts.keys()
+        for start in xrange(0, len(hashes), batchSize):
+            ops = self.collection.initialize_unordered_bulk_op()
+            for sha512 in hashes[start:start + batchSize]:
+                refCount, size = counts[sha512]
+                ops.find({
+                    'assetstoreId': assetstore['_id'],
+                    'sha512': sha512
+                }).upsert().update_one({
+                    '$set': {'refCount': refCount, 'size': size}
+                })
+                info['storedSize'] += size
+            ops.execute()
+            progress.update(current=min(start + batchSize, len(hashes)))
+        info['blobs'] = len(counts)
+
+        # Remove records of data that no file refers to any more
+        stale = []
+        cursor = self.find({'assetstoreId': assetstore['_id']}, limit=0,
+                           fields=['sha512'], timeout=False)
+        for blob in cursor:
+            if blob['sha512'] not in counts:
+                stale.append(blob['_id'])
+        cursor.close()
+        for start in xrange(0, len(stale), batchSize):
+            self.collection.remove(
+                {'_id': {'$in': stale[start:start + batchSize]}})
+
+        return info
+
+    def storageInfo(self, assetstore):
+        """
+        Get the number of distinct blobs in an assetstore and their total
+        size, counting data that is shared by several files only once.
+
+        :param assetstore: The assetstore.
+        :type assetstore: dict
+        :returns: A dict with the number of blobs and their total size.
+        """
+        result = self.collection.aggregate([
+            {'$match': {'assetstoreId': assetstore['_id']}},
+            {'$group': {'_id': None, 'blobs': {'$sum': 1},
+                        'storedSize': {'$sum': '$size'}}}
+        ])['result']
+        if not result:
+            return {'blobs': 0, 'storedSize': 0}
+        return {'blobs': result[0]['blobs'],
+                'storedSize': result[0]['storedSize']}
@@ -95,15 +95,15 @@ class Collection(AccessControlledModel):
             progress.update(increment=1, message='Deleted collection ' +
                             collection['name'])
 
-    def list(self, user=None, limit=50, offset=0, sort=None):
+    def list(self, user=None, limit=50, offset=0, sort=None, after=None):
         """
         Search for collections with full text search.
         """
-        cursor = self.find({}, limit=0, sort=sort)
+        cursor = self.findWithPermissions(
+            {}, user=user, level=AccessType.READ, limit=limit, offset=offset,
+            sort=sort, after=after)
 
-        for r in self.filterResultsByPermission(cursor=cursor, user=user,
-                                                level=AccessType.READ,
-                                                limit=limit, offset=offset):
+        for r in cursor:
             yield r
 
     def createCollection(self, name, creator, description='', public=True):
@@ -171,7 +171,7 @@ class Collection(AccessControlledModel):
         return self.save(collection)
 
     def fileList(self, doc, user=None, path='', includeMetadata=False,
-                 subpath=True):
+                 subpath=True, data=True):
         """
         Generate a list of files within this collection's folders.
 
@@ -184,6 +184,8 @@ class Collection(AccessControlledModel):
                                 metadata[-(number).json that is distinct from
                                 any file within the item.
         :param subpath: if True, add the collection's name to the path.
+        :param data: if True, return a function that generates the contents of
+                     each file; otherwise return the file document.
         """
         if subpath:
             path = os.path.join(path, doc['name'])
@@ -193,7 +195,8 @@ class Collection(AccessControlledModel):
         }, limit=0, timeout=False)
         for folder in folders:
             for (filepath, file) in self.model('folder').fileList(
-                    folder, user, path, includeMetadata, subpath=True):
+                    folder, user, path, includeMetadata, subpath=True,
+                    data=data):
                 yield (filepath, file)
 
     def subtreeCount(self, doc):
@@ -204,6 +207,14 @@ class Collection(AccessControlledModel):
         :param doc: The collection.
         """
         count = 1
+        if self.model('folder').ancestorsComplete():
+            q = {
+                'ancestors': doc['_id']
+            }
+            count += self.model('folder').find(q, fields=(), limit=0).count()
+            count += self.model('item').find(q, fields=(), limit=0).count()
+            return count
+
         folders = self.model('folder').find({
             'parentId': doc['_id'],
             'parentCollection': 'collection'
@@ -19,10 +19,11 @@
 
 import cherrypy
 import datetime
+import functools
 
 from .model_base import Model, ValidationException
 from ..constants import AccessType
-from girder.utility import assetstore_utilities
+from girder.utility import assetstore_utilities, download_cache, range_utils
 
 
 class File(Model):
@@ -58,16 +59,86 @@ class File(Model):
 
         Model.remove(self, file)
 
-    def download(self, file, offset=0, headers=True):
+    def download(self, file, offset=0, headers=True, endByte=None):
         """
         Use the appropriate assetstore adapter for whatever assetstore the
         file is stored in, and call downloadFile on it. If the file is a link
         file rather than a file in an assetstore, we redirect to it.
+
+        When headers are sent, this also serves HTTP conditional and byte
+        range requests: ETag and Last-Modified headers are set, a 304 status
+        is returned if the client's copy is current, and if no offset or
+        endByte is given, any ranges requested by a Range header are sent as
+        a 206 partial content response. In that case the adapter may instead
+        hand the download off to a front-end web server.
+
+        If a download cache is configured, files in remote assetstores are
+        served from it when it holds their data; otherwise their data is
+        copied into it in the background.
+
+        :param file: The file document to download.
+        :param offset: Offset in bytes to start the download at.
+        :type offset: int
+        :param headers: Whether to set headers on the response.
+        :type headers: bool
+        :param endByte: Final byte to download, exclusive. If None, download
+            to the end of the file.
+        :type endByte: int or None
         """
         if file.get('assetstoreId'):
             assetstore = self.model('assetstore').load(file['assetstoreId'])
             adapter = assetstore_utilities.getAssetstoreAdapter(assetstore)
-            return adapter.downloadFile(file, offset=offset, headers=headers)
+
+            ranges = None
+            if headers:
+                etag = '"%s"' % file['sha512'] if file.get('sha512') else None
+                lastModified = file.get('created')
+                range_utils.setValidators(etag, lastModified)
+                if range_utils.notModified(etag, lastModified):
+                    return lambda: ''
+                if not offset and endByte is None:
+                    if adapter.offloadDownload(file):
+                        return lambda: ''
+                    ranges = range_utils.requestedRanges(
+                        file['size'], etag, lastModified)
+                    if ranges:
+                        offset, endByte = ranges[0]
+
+            downloadFile = adapter.downloadFile
+            handle = None
+            cache = download_cache.getCache()
+            if (cache is not None and file.get('size') and
+                    assetstore['type'] in download_cache.CACHED_TYPES):
+                handle = cache.open(file)
+                if handle is None:
+                    cache.fill(file, adapter)
+                else:
+                    downloadFile = functools.partial(
+                        download_cache.streamFile, handle, adapter)
+
+            try:
+                kwargs = {} if endByte is None else {'endByte': endByte}
+                stream = downloadFile(
+                    file, offset=offset, headers=headers, **kwargs)
+
+                if ranges and len(ranges) > 1:
+                    stream = range_utils.multipartRanges(
+                        ranges, file['size'], cherrypy.response.headers.get(
+                            'Content-Type', 'application/octet-stream'),
+                        lambda start, end: downloadFile(
+                            file, offset=start, headers=False, endByte=end))
+                elif ranges:
+                    range_utils.setPartialContent(
+                        offset, endByte, file['size'])
+            except Exception:
+                if handle is not None:
+                    handle.close()
+                raise
+            if handle is not None:
+                # Every range is read from the one handle, which is closed
+                # once the whole response has been sent or abandoned.
+                stream = download_cache.closeAfter(stream, handle)
+            return stream
         elif file.get('linkUrl'):
             if headers:
                 raise cherrypy.HTTPRedirect(file['linkUrl'])
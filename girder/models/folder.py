@@ -24,9 +24,9 @@ import os
 
 from bson.objectid import ObjectId
 from .model_base import AccessControlledModel, ValidationException
-from girder import events
-from girder.constants import AccessType
-from girder.utility.progress import setResponseTimeLimit
+from girder import events, logger
+from girder.constants import AccessType, SettingKey
+from girder.utility.progress import noProgress, setResponseTimeLimit
 
 
 class Folder(AccessControlledModel):
@@ -40,8 +40,10 @@ class Folder(AccessControlledModel):
 
     def initialize(self):
         self.name = 'folder'
-        self.ensureIndices(('parentId', 'name', 'lowerName',
-                            ([('parentId', 1), ('name', 1)], {})))
+        self.ensureIndices(('parentId', 'name', 'lowerName', 'ancestors',
+                            ([('parentId', 1), ('name', 1)], {}),
+                            ([('parentId', 1), ('lowerName', 1), ('_id', 1)],
+                             {})))
         self.ensureTextIndex({
             'name': 10,
             'description': 1
@@ -141,25 +143,83 @@ class Folder(AccessControlledModel):
             doc['baseParentId'] = baseParent['object']['_id']
             doc['baseParentType'] = baseParent['type']
             self.save(doc, triggerEvents=False)
+        if doc is not None and 'ancestors' not in doc and fields is None:
+            doc['ancestors'] = [parent['object']['_id'] for parent in
+                                self.parentsToRoot(doc, user=user, force=True)]
+            self.save(doc, triggerEvents=False)
         if doc is not None and 'lowerName' not in doc:
             self.save(doc, triggerEvents=False)
 
         return doc
 
+    def getAncestorIds(self, parent, parentType):
+        """
+        Return the value of the ``ancestors`` field for a new child of the
+        given parent. This is the list of ids of every folder above the child,
+        plus the id of the user or collection at the root of the hierarchy,
+        ordered from the root down to the immediate parent.
+
+        :param parent: The parent document.
+        :type parent: dict
+        :param parentType: The type of the parent.
+        :type parentType: 'user', 'folder', or 'collection'
+        """
+        if parentType != 'folder':
+            return [parent['_id']]
+
+        if 'ancestors' not in parent:
+            parent['ancestors'] = [
+                p['object']['_id'] for p in
+                self.parentsToRoot(parent, force=True)]
+
+        return parent['ancestors'] + [parent['_id']]
+
+    def ancestorsComplete(self):
+        """
+        Whether every folder and item is known to have the ``ancestors``
+        field, so that a subtree can be found with a single query on it.
+        Databases created before the field existed lack it until
+        ``girder-admin backfill-ancestors`` has been run, and until then
+        subtrees are walked one level at a time.
+
+        This is recorded in the ``core.ancestors_complete`` setting. If the
+        setting is absent, the database is checked once and the result
+        stored.
+        """
+        settingModel = self.model('setting')
+        complete = settingModel.get(SettingKey.ANCESTORS_COMPLETE)
+        if complete is None:
+            missing = {'ancestors': {'$exists': False}}
+            complete = (
+                self.findOne(missing, fields=[]) is None and
+                self.model('item').findOne(missing, fields=[]) is None)
+            if not complete:
+                logger.warning(
+                    'Some folders or items have no ancestors field. Run '
+                    '"girder-admin backfill-ancestors" to speed up subtree '
+                    'queries.')
+            settingModel.set(SettingKey.ANCESTORS_COMPLETE, complete)
+        return complete
+
     def getSizeRecursive(self, folder):
         """
-        Calculate the total size of the folder by recursing into all of its
-        descendent folders.
+        Calculate the total size of the folder and all of its descendent
+        folders. This is a single indexed query on the ``ancestors`` field,
+        unless some documents lack that field (see ancestorsComplete).
         """
         size = folder['size']
 
-        q = {
-            'parentId': folder['_id'],
-            'parentCollection': 'folder'
-        }
-
-        for child in self.find(q, limit=0):
-            size += self.getSizeRecursive(child)
+        if self.ancestorsComplete():
+            for child in self.find({'ancestors': folder['_id']}, limit=0,
+                                   fields=['size']):
+                size += child.get('size', 0)
+        else:
+            q = {
+                'parentId': folder['_id'],
+                'parentCollection': 'folder'
+            }
+            for child in self.find(q, limit=0):
+                size += self.getSizeRecursive(child)
 
         return size
 
@@ -195,13 +255,24 @@ class Folder(AccessControlledModel):
     def _updateDescendants(self, folderId, updateQuery):
         """
         This helper is used to update all items and folders underneath a
-        folder. This is expensive, so think carefully before using it.
+        folder. It issues one multi-document update per collection using the
+        ``ancestors`` index, unless some documents lack that field (see
+        ancestorsComplete), in which case it recurses through the subtree.
 
         :param folderId: The _id of the folder at the root of the subtree.
         :param updateQuery: The mongo query to apply to all of the children of
         the folder.
         :type updateQuery: dict
         """
+        if self.ancestorsComplete():
+            self.model('folder').update(query={
+                'ancestors': folderId
+            }, update=updateQuery, multi=True)
+            self.model('item').update(query={
+                'ancestors': folderId
+            }, update=updateQuery, multi=True)
+            return
+
         self.model('folder').update(query={
             'parentId': folderId,
             'parentCollection': 'folder'
@@ -231,15 +302,10 @@ class Folder(AccessControlledModel):
         if ancestor['_id'] == descendant['_id']:
             return True
 
-        if descendant['parentCollection'] != 'folder':
-            return False
-
-        descendant = self.load(descendant['parentId'], force=True)
-
-        if descendant is None:
-            return False
+        if 'ancestors' not in descendant:
+            descendant = self.load(descendant['_id'], force=True)
 
-        return self._isAncestor(ancestor, descendant)
+        return ancestor['_id'] in descendant['ancestors']
 
     def move(self, folder, parent, parentType):
         """
@@ -258,14 +324,22 @@ class Folder(AccessControlledModel):
             raise ValidationException(
                 'You may not move a folder underneath itself.')
 
+        oldAncestors = folder.get('ancestors')
+        if oldAncestors is None:
+            oldAncestors = [p['object']['_id'] for p in
+                            self.parentsToRoot(folder, force=True)]
+        newAncestors = self.getAncestorIds(parent, parentType)
+
         folder['parentId'] = parent['_id']
         folder['parentCollection'] = parentType
+        folder['ancestors'] = newAncestors
 
         if parentType == 'folder':
             rootType, rootId = parent['baseParentType'], parent['baseParentId']
         else:
             rootType, rootId = parentType, parent['_id']
 
+        baseParentUpdate = {}
         if (folder['baseParentType'], folder['baseParentId']) !=\
            (rootType, rootId):
             def propagateSizeChange(folder, inc):
@@ -278,12 +352,28 @@ class Folder(AccessControlledModel):
             folder['baseParentType'] = rootType
             folder['baseParentId'] = rootId
             propagateSizeChange(folder, totalSize)
+            baseParentUpdate = {
+                'baseParentType': rootType,
+                'baseParentId': rootId
+            }
+
+        if self.ancestorsComplete():
+            # Replace the old ancestor prefix of every descendant with the
+            # new one. These can't be combined into a single update since both
+            # touch the same array field.
             self._updateDescendants(folder['_id'], {
-                '$set': {
-                    'baseParentType': rootType,
-                    'baseParentId': rootId
-                }
+                '$pullAll': {'ancestors': oldAncestors}
             })
+            update = {
+                '$push': {'ancestors': {'$each': newAncestors, '$position': 0}}
+            }
+        else:
+            # Descendants without the field can't be patched, so drop it from
+            # all of them; it is recomputed on load or by the backfill.
+            update = {'$unset': {'ancestors': True}}
+        if baseParentUpdate:
+            update['$set'] = baseParentUpdate
+        self._updateDescendants(folder['_id'], update)
 
         return self.save(folder)
 
@@ -390,13 +480,11 @@ class Folder(AccessControlledModel):
         }
         q.update(filters)
 
-        # Perform the find; we'll do access-based filtering of the result set
-        # afterward.
-        cursor = self.find(q, limit=0, sort=sort, **kwargs)
+        cursor = self.findWithPermissions(
+            q, user=user, level=AccessType.READ, limit=limit, offset=offset,
+            sort=sort, **kwargs)
 
-        for r in self.filterResultsByPermission(cursor=cursor, user=user,
-                                                level=AccessType.READ,
-                                                limit=limit, offset=offset):
+        for r in cursor:
             yield r
 
     def createFolder(self, parent, name, description='', parentType='folder',
@@ -454,6 +542,7 @@ class Folder(AccessControlledModel):
             'baseParentId': parent['baseParentId'],
             'baseParentType': parent['baseParentType'],
             'parentId': ObjectId(parent['_id']),
+            'ancestors': self.getAncestorIds(parent, parentType),
             'creatorId': creatorId,
             'created': now,
             'updated': now,
@@ -500,6 +589,10 @@ class Folder(AccessControlledModel):
         :returns: an ordered list of dictionaries from root to the current
                   folder
         """
+        if not curPath and 'ancestors' in folder and \
+                'baseParentType' in folder:
+            return self._parentsFromAncestors(folder, user, force, level)
+
         if not curPath:
             curPath = []
 
@@ -520,6 +613,29 @@ class Folder(AccessControlledModel):
             return self.parentsToRoot(curParentObject, curPath, user=user,
                                       force=force)
 
+    def _parentsFromAncestors(self, folder, user, force, level):
+        """
+        Implementation of parentsToRoot for folders with an ``ancestors``
+        field. All of the intermediate folders are fetched with one query.
+        As in the recursive version, the immediate parent is checked at the
+        requested access level and the others at READ.
+        """
+        ancestors = folder['ancestors']
+        rootType = folder['baseParentType']
+        rootModel = self.model(rootType)
+        rootLevel = level if len(ancestors) == 1 else AccessType.READ
+        root = rootModel.load(ancestors[0], user=user, level=rootLevel,
+                              force=force)
+        path = [{'type': rootType, 'object': rootModel.filter(root, user)}]
+
+        folders = self.loadMany(ancestors[1:], user=user,
+                                level=AccessType.READ, force=force)
+        if folders and not force:
+            self.requireAccess(folders[-1], user=user, level=level)
+        path.extend({'type': 'folder', 'object': self.filter(parent, user)}
+                    for parent in folders)
+        return path
+
     def subtreeCount(self, folder):
         """
         Return the size of the subtree rooted at the given folder. Includes
@@ -531,6 +647,14 @@ class Folder(AccessControlledModel):
         """
         count = 1
 
+        if self.ancestorsComplete():
+            q = {
+                'ancestors': folder['_id']
+            }
+            count += self.model('item').find(q, fields=(), limit=0).count()
+            count += self.find(q, fields=(), limit=0).count()
+            return count
+
         items = self.model('item').find({
             'folderId': folder['_id']
         }, fields=(), limit=0)
@@ -547,8 +671,69 @@ class Folder(AccessControlledModel):
 
         return count
 
+    def backfillAncestors(self, batchSize=1000, progress=noProgress):
+        """
+        Compute and store the ``ancestors`` field on every folder and item in
+        the database. This is needed once for databases created before the
+        field existed. The hierarchy is walked breadth first, one level at a
+        time, so each batch of folders costs a fixed number of queries
+        regardless of the shape of the tree. Once it finishes, subtree
+        queries use the field (see ancestorsComplete).
+
+        :param batchSize: The number of folders to update per bulk operation.
+        :type batchSize: int
+        :param progress: A progress context to record progress on.
+        :type progress: girder.utility.progress.ProgressContext or None.
+        :returns: The number of folders that were updated.
+        """
+        settingModel = self.model('setting')
+        settingModel.set(SettingKey.ANCESTORS_COMPLETE, False)
+        itemModel = self.model('item')
+        frontier = {}
+        cursor = self.find({
+            'parentCollection': {'$in': ['user', 'collection']}
+        }, limit=0, fields=['parentId'], timeout=False)
+        for folder in cursor:
+            frontier[folder['_id']] = [folder['parentId']]
+        cursor.close()
+
+        count = 0
+        while frontier:
+            nextFrontier = {}
+            ids = frontier.keys()
+            for start in xrange(0, len(ids), batchSize):
+                batch = ids[start:start + batchSize]
+                folderOps = self.collection.initialize_unordered_bulk_op()
+                itemOps = itemModel.collection.initialize_unordered_bulk_op()
+                for id in batch:
+                    folderOps.find({'_id': id}).update_one({
+                        '$set': {'ancestors': frontier[id]}
+                    })
+                    itemOps.find({'folderId': id}).update({
+                        '$set': {'ancestors': frontier[id] + [id]}
+                    })
+                folderOps.execute()
+                itemOps.execute()
+
+                children = self.find({
+                    'parentId': {'$in': batch},
+                    'parentCollection': 'folder'
+                }, limit=0, fields=['parentId'], timeout=False)
+                for child in children:
+                    nextFrontier[child['_id']] = \
+                        frontier[child['parentId']] + [child['parentId']]
+                children.close()
+
+                count += len(batch)
+                progress.update(current=count, message='Updated {} folders'
+                                .format(count))
+            frontier = nextFrontier
+
+        settingModel.set(SettingKey.ANCESTORS_COMPLETE, True)
+        return count
+
     def fileList(self, doc, user=None, path='', includeMetadata=False,
-                 subpath=True):
+                 subpath=True, data=True):
         """
         Generate a list of files within this folder.
 
@@ -561,6 +746,8 @@ class Folder(AccessControlledModel):
                                 metadata[-(number).json that is distinct from
                                 any file within the folder.
         :param subpath: if True, add the folder's name to the path.
+        :param data: if True, return a function that generates the contents of
+                     each file; otherwise return the file document.
         """
         if subpath:
             path = os.path.join(path, doc['name'])
@@ -570,13 +757,14 @@ class Folder(AccessControlledModel):
             if sub['name'] == metadataFile:
                 metadataFile = None
             for (filepath, file) in self.fileList(
-                    sub, user, path, includeMetadata, subpath=True):
+                    sub, user, path, includeMetadata, subpath=True,
+                    data=data):
                 yield (filepath, file)
         for item in self.childItems(folder=doc, limit=0, timeout=False):
             if item['name'] == metadataFile:
                 metadataFile = None
             for (filepath, file) in self.model('item').fileList(
-                    item, user, path, includeMetadata):
+                    item, user, path, includeMetadata, data=data):
                 yield (filepath, file)
         if includeMetadata and metadataFile and len(doc.get('meta', {})):
             def stream():
@@ -116,7 +116,7 @@ class Group(AccessControlledModel):
 
         return doc
 
-    def list(self, user=None, limit=50, offset=0, sort=None):
+    def list(self, user=None, limit=50, offset=0, sort=None, after=None):
         """
         Search for groups or simply list all visible groups.
 
@@ -125,14 +125,13 @@ class Group(AccessControlledModel):
         :param limit: Result set size limit.
         :param offset: Offset into the results.
         :param sort: The sort direction.
+        :param after: Sort key values to page after, see Model.find.
         """
-        # Perform the find; we'll do access-based filtering of the result
-        # set afterward.
-        cursor = self.find({}, limit=0, sort=sort)
+        cursor = self.findWithPermissions(
+            {}, user=user, level=AccessType.READ, limit=limit, offset=offset,
+            sort=sort, after=after)
 
-        for r in self.filterResultsByPermission(cursor=cursor, user=user,
-                                                level=AccessType.READ,
-                                                limit=limit, offset=offset):
+        for r in cursor:
             yield r
 
     def listMembers(self, group, offset=0, limit=50, sort=None):
@@ -388,10 +387,11 @@ class Group(AccessControlledModel):
         :type group: dict
         """
         reqList = []
+        userIds = group.get('requests', [])
+        users = self.model('user').loadMany(
+            userIds, force=True, fields=['firstName', 'lastName', 'login'])
 
-        for userId in group.get('requests', []):
-            user = self.model('user').load(
-                userId, force=True, fields=['firstName', 'lastName', 'login'])
+        for userId, user in zip(userIds, users):
             reqList.append({
                 'id': userId,
                 'login': user['login'],
@@ -430,6 +430,35 @@ class Group(AccessControlledModel):
             return self._hasUserAccess(doc.get('access', {}).get('users', []),
                                        user['_id'], level)
 
+    def permissionClauses(self, user=None, level=AccessType.READ):
+        """
+        This overrides the default AccessControlledModel behavior to match
+        the custom hasAccess logic of this model.
+
+        :param user: The user to check policies against.
+        :type user: dict or None
+        :param level: The access level.
+        :type level: AccessType
+        """
+        if user is None:
+            if level == AccessType.READ:
+                return {'public': True}
+            return {'_id': {'$in': []}}
+        elif user.get('admin', False) is True:
+            return {}
+        elif level == AccessType.READ:
+            groupIds = user.get('groups', []) + [
+                i['groupId'] for i in user.get('groupInvites', [])]
+            return {'$or': [
+                {'public': True},
+                {'_id': {'$in': groupIds}}
+            ]}
+        else:
+            return {'access.users': {'$elemMatch': {
+                'id': user['_id'],
+                'level': {'$gte': level}
+            }}}
+
     def getAccessLevel(self, doc, user):
         """
         Return the maximum access level for a given user on the group.
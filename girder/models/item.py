@@ -19,6 +19,7 @@
 
 import copy
 import datetime
+import itertools
 import json
 import os
 
@@ -36,8 +37,10 @@ class Item(Model):
 
     def initialize(self):
         self.name = 'item'
-        self.ensureIndices(('folderId', 'name', 'lowerName',
-                            ([('folderId', 1), ('name', 1)], {})))
+        self.ensureIndices(('folderId', 'name', 'lowerName', 'ancestors',
+                            ([('folderId', 1), ('name', 1)], {}),
+                            ([('folderId', 1), ('lowerName', 1), ('_id', 1)],
+                             {})))
         self.ensureTextIndex({
             'name': 10,
             'description': 1
@@ -133,6 +136,10 @@ class Item(Model):
             doc['baseParentId'] = baseParent['object']['_id']
             doc['baseParentType'] = baseParent['type']
             self.save(doc, triggerEvents=False)
+        if doc is not None and 'ancestors' not in doc and fields is None:
+            doc['ancestors'] = [parent['object']['_id'] for parent in
+                                self.parentsToRoot(doc, user=user, force=True)]
+            self.save(doc, triggerEvents=False)
         if doc is not None and 'lowerName' not in doc:
             self.save(doc, triggerEvents=False)
 
@@ -159,6 +166,8 @@ class Item(Model):
         propagateSizeChange(item, -item['size'])
 
         item['folderId'] = folder['_id']
+        item['ancestors'] = self.model('folder').getAncestorIds(
+            folder, 'folder')
         item['baseParentType'] = folder['baseParentType']
         item['baseParentId'] = folder['baseParentId']
 
@@ -229,32 +238,19 @@ class Item(Model):
         # list where we will store the filtered results
         filtered = []
 
-        # cache dictionary mapping folderId's to read permission
-        folderCache = {}
-
-        # loop through all results in the non-filtered list
+        # loop through all results the user can read
         i = 0
-        for result in cursor:
-            # check if the folderId is cached
-            folderId = result['folderId']
-
-            if folderId not in folderCache:
-                # if the folderId is not cached check for read permission
-                # and set the cache
-                folder = self.model('folder').load(folderId, force=True)
-                folderCache[folderId] = self.model('folder').hasAccess(
-                    folder, user=user, level=AccessType.READ)
-
-            if folderCache[folderId] is True:
-                if i < offset:
-                    i += 1
-                    continue
-
-                filtered.append(result)
-
-                # once we have hit the requested limit, return
-                if len(filtered) >= limit:
-                    break
+        for result in self._filterByFolderAccess(cursor, user,
+                                                 AccessType.READ):
+            if i < offset:
+                i += 1
+                continue
+
+            filtered.append(result)
+
+            # once we have hit the requested limit, return
+            if len(filtered) >= limit:
+                break
 
         cursor.close()
         return filtered
@@ -274,26 +270,43 @@ class Item(Model):
         of items by permissions, based on the parent folder. The results in
         the cursor must contain the folderId field.
         """
-        # Cache mapping folderIds -> access granted (bool)
-        folderCache = {}
         count = skipped = 0
-        for result in cursor:
-            folderId = result['folderId']
-
-            if folderId not in folderCache:
-                folder = self.model('folder').load(folderId, force=True)
-                folderCache[folderId] = self.model('folder').hasAccess(
-                    folder, user=user, level=level)
-
-            if folderCache[folderId] is True:
-                if skipped < offset:
-                    skipped += 1
-                else:
-                    yield result
-                    count += 1
+        for result in self._filterByFolderAccess(cursor, user, level):
+            if skipped < offset:
+                skipped += 1
+            else:
+                yield result
+                count += 1
             if count == limit:
                     break
 
+    def _filterByFolderAccess(self, cursor, user, level, batchSize=100):
+        """
+        Yield the results in the cursor whose parent folder the user has the
+        given level of access on. Results are read in batches, and the parent
+        folders of each batch that haven't been seen yet are loaded with a
+        single query.
+        """
+        folderModel = self.model('folder')
+        # Cache mapping folderIds -> access granted (bool)
+        folderCache = {}
+        results = iter(cursor)
+        while True:
+            batch = list(itertools.islice(results, batchSize))
+            if not batch:
+                break
+
+            folderIds = list(set(r['folderId'] for r in batch) -
+                             set(folderCache))
+            folders = folderModel.loadMany(folderIds, force=True)
+            for folderId, folder in zip(folderIds, folders):
+                folderCache[folderId] = folder is not None and \
+                    folderModel.hasAccess(folder, user=user, level=level)
+
+            for result in batch:
+                if folderCache[result['folderId']]:
+                    yield result
+
     def createItem(self, name, creator, folder, description=''):
         """
         Create a new item. The creator will be given admin access to it.
@@ -313,16 +326,19 @@ class Item(Model):
             # Internal error -- this shouldn't be called without a user.
             raise Exception('Creator must be a user.')
 
-        if 'baseParentType' not in folder:
+        if 'baseParentType' not in folder or 'ancestors' not in folder:
             pathFromRoot = self.parentsToRoot({'folderId': folder['_id']},
                                               creator, force=True)
             folder['baseParentType'] = pathFromRoot[0]['type']
             folder['baseParentId'] = pathFromRoot[0]['object']['_id']
+            folder['ancestors'] = [
+                p['object']['_id'] for p in pathFromRoot[:-1]]
 
         return self.save({
             'name': self._validateString(name),
             'description': self._validateString(description),
             'folderId': ObjectId(folder['_id']),
+            'ancestors': folder['ancestors'] + [ObjectId(folder['_id'])],
             'creatorId': creator['_id'],
             'baseParentType': folder['baseParentType'],
             'baseParentId': folder['baseParentId'],
@@ -432,7 +448,7 @@ class Item(Model):
         return self.filter(newItem)
 
     def fileList(self, doc, user=None, path='', includeMetadata=False,
-                 subpath=True):
+                 subpath=True, data=True):
         """
         Generate a list of files within this item.
 
@@ -449,6 +465,9 @@ class Item(Model):
         :param subpath: if True and the item has more than one file, metadata,
                         or the sole file is not named the same as the item,
                         then the returned paths include the item name.
+        :param data: if True, return a function that generates the contents of
+                     each file; otherwise return the file document. Metadata
+                     is always returned as a function.
         """
         if subpath:
             files = [file for file in self.childFiles(item=doc, limit=2)]
@@ -460,7 +479,8 @@ class Item(Model):
             if file['name'] == metadataFile:
                 metadataFile = None
             yield (os.path.join(path, file['name']),
-                   self.model('file').download(file, headers=False))
+                   self.model('file').download(file, headers=False)
+                   if data else file)
         if includeMetadata and metadataFile and len(doc.get('meta', {})):
             def stream():
                 yield json.dumps(doc['meta'], default=str)
@@ -17,7 +17,9 @@
 #  limitations under the License.
 ###############################################################################
 
+import copy
 import pymongo
+import threading
 
 from girder.external.mongodb_proxy import MongoProxy
 
@@ -27,6 +29,102 @@ from girder.constants import AccessType, TerminalColor, TEXT_SCORE_SORT_MAX
 from girder.utility.model_importer import ModelImporter
 from girder.models import getDbConnection
 
+_identityMapStats = {}
+_identityMapStatsLock = threading.Lock()
+
+
+class IdentityMap(threading.local):
+    """
+    A per-thread cache of documents fetched by Model.load, keyed on model name
+    and _id. It is only active between calls to begin() and end(), which the
+    REST layer makes around each endpoint call, so it acts as a request-scoped
+    identity map. Any write through a model invalidates the affected entries.
+    Documents are copied on the way in and out so that callers mutating a
+    loaded document without saving it can't affect later loads.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.endpoint = None
+        self.hits = 0
+        self.misses = 0
+        self._docs = {}
+
+    def begin(self):
+        """
+        Start a new, empty identity map for the current thread.
+        """
+        self.enabled = True
+        self.endpoint = None
+        self.hits = 0
+        self.misses = 0
+        self._docs = {}
+
+    def end(self):
+        """
+        Discard the identity map for the current thread. If an endpoint name
+        was set during the request, its hit and miss counts are added to the
+        totals returned by getIdentityMapStats().
+        """
+        if self.enabled and self.endpoint is not None:
+            with _identityMapStatsLock:
+                stats = _identityMapStats.setdefault(self.endpoint, {
+                    'requests': 0,
+                    'hits': 0,
+                    'misses': 0
+                })
+                stats['requests'] += 1
+                stats['hits'] += self.hits
+                stats['misses'] += self.misses
+
+        self.enabled = False
+        self.endpoint = None
+        self._docs = {}
+
+    def get(self, modelName, id):
+        """
+        Return a copy of the cached document, or None if it is not cached.
+        """
+        if not self.enabled:
+            return None
+
+        doc = self._docs.get(modelName, {}).get(id)
+        if doc is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return copy.deepcopy(doc)
+
+    def put(self, modelName, doc):
+        if self.enabled:
+            self._docs.setdefault(modelName, {})[doc['_id']] = \
+                copy.deepcopy(doc)
+
+    def invalidate(self, modelName, id=None):
+        """
+        Remove a single document, or all documents of a model if no id is
+        passed, from the identity map.
+        """
+        if not self.enabled:
+            return
+
+        if id is None:
+            self._docs.pop(modelName, None)
+        else:
+            self._docs.get(modelName, {}).pop(id, None)
+
+
+identityMap = IdentityMap()
+
+
+def getIdentityMapStats():
+    """
+    Return the cumulative identity map hit and miss counts for each REST
+    endpoint, keyed by the endpoint's event prefix, e.g. ``rest.get.item/:id``.
+    """
+    with _identityMapStatsLock:
+        return copy.deepcopy(_identityMapStats)
+
 
 class Model(ModelImporter):
     """
@@ -116,7 +214,7 @@ class Model(ModelImporter):
         raise Exception('Must override initialize() in %s model'
                         % self.__class__.__name__)  # pragma: no cover
 
-    def find(self, query=None, offset=0, limit=50, **kwargs):
+    def find(self, query=None, offset=0, limit=50, after=None, **kwargs):
         """
         Search the collection by a set of parameters. Passes any kwargs
         through to the underlying pymongo.collection.find function.
@@ -127,6 +225,11 @@ class Model(ModelImporter):
         :type offset: int
         :param limit: Maximum number of documents to return
         :type limit: int
+        :param after: For keyset pagination, the values of the sort fields of
+            the last document of the previous page. Only documents that come
+            after it in the sort order are returned. The sort must be total,
+            i.e. end with _id.
+        :type after: list
         :param sort: The sort order.
         :type sort: List of (key, order) tuples.
         :param fields: A mask for filtering result documents by key.
@@ -136,9 +239,41 @@ class Model(ModelImporter):
         if not query:
             query = {}
 
+        if after is not None:
+            keyset = self._keysetClauses(kwargs.get('sort'), after)
+            if '$or' in query:
+                query = {'$and': [query, keyset]}
+            else:
+                query = dict(query)
+                query.update(keyset)
+
         return self.collection.find(
             spec=query, skip=offset, limit=limit, **kwargs)
 
+    def _keysetClauses(self, sort, after):
+        """
+        Build the query matching the documents that come after the given sort
+        key values in the given sort order.
+        """
+        if not sort or len(sort) != len(after):
+            raise ValidationException(
+                'Keyset pagination values must match the sort fields.',
+                'after')
+        if None in after:
+            # Comparing with null matches nothing, so the rest of the
+            # documents would silently be skipped.
+            raise ValidationException(
+                'Keyset pagination values must not be null.', 'after')
+
+        clauses = []
+        for i, (field, direction) in enumerate(sort):
+            clause = {f: v for (f, _), v in zip(sort[:i], after[:i])}
+            op = '$gt' if direction == pymongo.ASCENDING else '$lt'
+            clause[field] = {op: after[i]}
+            clauses.append(clause)
+
+        return {'$or': clauses}
+
     def findOne(self, query=None, **kwargs):
         """
         Search the collection by a set of parameters. Passes any kwargs
@@ -219,6 +354,7 @@ class Model(ModelImporter):
 
         sendCreateEvent = ('_id' not in document)
         document['_id'] = self.collection.save(document)
+        identityMap.invalidate(self.name, document['_id'])
 
         if triggerEvents:
             if sendCreateEvent:
@@ -246,6 +382,7 @@ class Model(ModelImporter):
         :type update: dict
         """
         self.collection.update(query, update, multi=multi)
+        identityMap.invalidate(self.name)
 
     def increment(self, query, field, amount, **kwargs):
         """
@@ -275,6 +412,7 @@ class Model(ModelImporter):
         event = events.trigger('.'.join(('model', self.name, 'remove')),
                                document)
         if not event.defaultPrevented:
+            identityMap.invalidate(self.name, document['_id'])
             return self.collection.remove({'_id': document['_id']})
 
     def removeWithQuery(self, query):
@@ -284,11 +422,14 @@ class Model(ModelImporter):
         """
         assert query
 
+        identityMap.invalidate(self.name)
         return self.collection.remove(query)
 
     def load(self, id, objectId=True, fields=None, exc=False):
         """
-        Fetch a single object from the database using its _id field.
+        Fetch a single object from the database using its _id field. When
+        loading whole documents during a request, the request's identity map
+        is consulted first.
 
         :param id: The value for searching the _id field.
         :type id: string or ObjectId
@@ -307,7 +448,14 @@ class Model(ModelImporter):
             except:
                 raise ValidationException('Invalid ObjectId: {}'.format(id),
                                           field='id')
-        doc = self.collection.find_one({'_id': id}, fields=fields)
+        if fields is None:
+            doc = identityMap.get(self.name, id)
+            if doc is None:
+                doc = self.collection.find_one({'_id': id})
+                if doc is not None:
+                    identityMap.put(self.name, doc)
+        else:
+            doc = self.collection.find_one({'_id': id}, fields=fields)
 
         if doc is None and exc is True:
             raise ValidationException('No such {}: {}'.format(
@@ -315,6 +463,52 @@ class Model(ModelImporter):
 
         return doc
 
+    def loadMany(self, ids, objectId=True, fields=None, chunkSize=1000):
+        """
+        Fetch a list of objects from the database by their _id fields. This
+        issues one query per chunk of ids rather than one per id. Whole
+        documents already in the request's identity map are not refetched.
+
+        :param ids: The values for searching the _id field.
+        :type ids: list of string or ObjectId
+        :param objectId: Whether the ids should be coerced to ObjectId type.
+        :type objectId: bool
+        :param fields: Fields list to include. Also can be a dict for
+                       exclusion. See pymongo docs for how to use this arg.
+        :param chunkSize: The maximum number of ids to pass in each query.
+        :type chunkSize: int
+        :returns: A list of the matching documents in the same order as ids,
+                  with None in place of any id that has no document.
+        """
+        if objectId:
+            try:
+                ids = [id if type(id) is ObjectId else ObjectId(id)
+                       for id in ids]
+            except Exception:
+                raise ValidationException('Invalid ObjectId in list.',
+                                          field='id')
+
+        docs = {}
+        missing = []
+        for id in ids:
+            if id in docs:
+                continue
+            doc = identityMap.get(self.name, id) if fields is None else None
+            if doc is None:
+                missing.append(id)
+            docs[id] = doc
+
+        for start in xrange(0, len(missing), chunkSize):
+            cursor = self.collection.find({
+                '_id': {'$in': missing[start:start + chunkSize]}
+            }, fields=fields)
+            for doc in cursor:
+                if fields is None:
+                    identityMap.put(self.name, doc)
+                docs[doc['_id']] = doc
+
+        return [docs[id] for id in ids]
+
     def filterDocument(self, doc, allow=None):
         """
         This method will filter the given document to make it suitable to
@@ -364,6 +558,16 @@ class AccessControlledModel(Model):
     resource.
     """
 
+    def __init__(self):
+        Model.__init__(self)
+
+        # These support the query built by permissionClauses
+        self.collection.ensure_index('public')
+        self.collection.ensure_index(
+            [('access.users.id', 1), ('access.users.level', 1)])
+        self.collection.ensure_index(
+            [('access.groups.id', 1), ('access.groups.level', 1)])
+
     def _hasGroupAccess(self, perms, groupIds, level):
         """
         Private helper method for checking group access.
@@ -553,17 +757,18 @@ class AccessControlledModel(Model):
             'groups': doc['access'].get('groups', [])
         }
 
-        for user in acList['users']:
-            userDoc = self.model('user').load(
-                user['id'], force=True,
-                fields=['firstName', 'lastName', 'login'])
+        userDocs = self.model('user').loadMany(
+            [user['id'] for user in acList['users']], force=True,
+            fields=['firstName', 'lastName', 'login'])
+        for user, userDoc in zip(acList['users'], userDocs):
             user['login'] = userDoc['login']
             user['name'] = '{} {}'.format(
                 userDoc['firstName'], userDoc['lastName'])
 
-        for grp in acList['groups']:
-            grpDoc = self.model('group').load(
-                grp['id'], force=True, fields=['name'])
+        grpDocs = self.model('group').loadMany(
+            [grp['id'] for grp in acList['groups']], force=True,
+            fields=['name'])
+        for grp, grpDoc in zip(acList['groups'], grpDocs):
             grp['name'] = grpDoc['name']
 
         return acList
@@ -674,6 +879,41 @@ class AccessControlledModel(Model):
 
         return doc
 
+    def loadMany(self, ids, level=AccessType.ADMIN, user=None, objectId=True,
+                 force=False, fields=None, chunkSize=1000):
+        """
+        Override of Model.loadMany to also do permission checking. Access is
+        checked on every returned document once they have all been fetched.
+
+        :param ids: The ids of the resources.
+        :type ids: list of str or ObjectId
+        :param user: The user to check access against.
+        :type user: dict or None
+        :param level: The required access type for the objects.
+        :type level: AccessType
+        :param force: If you explicitly want to circumvent access
+                      checking on these resources, set this to True.
+        :type force: bool
+        :param objectId: Whether the _id field is an ObjectId.
+        :type objectId: bool
+        :param fields: The subset of fields to load from the returned
+            documents, or None to return the full documents.
+        :param chunkSize: The maximum number of ids to pass in each query.
+        :type chunkSize: int
+        :raises AccessException: If the user lacks access to any document.
+        :returns: A list of the matching documents in the same order as ids,
+            with None in place of any id that has no document.
+        """
+        docs = Model.loadMany(self, ids, objectId=objectId, fields=fields,
+                              chunkSize=chunkSize)
+
+        if not force:
+            for doc in docs:
+                if doc is not None:
+                    self.requireAccess(doc, user, level)
+
+        return docs
+
     def copyAccessPolicies(self, src, dest, save=False):
         """
         Copies the set of access control policies from one document to another.
@@ -694,6 +934,87 @@ class AccessControlledModel(Model):
             dest = self.save(dest, validate=False)
         return dest
 
+    def permissionClauses(self, user=None, level=AccessType.READ):
+        """
+        Return a query fragment that matches only the documents the given user
+        has at least the given level of access on. This mirrors the logic of
+        hasAccess, so any model that overrides hasAccess must override this
+        as well.
+
+        :param user: The user to check policies against.
+        :type user: dict or None
+        :param level: The access level.
+        :type level: AccessType
+        :returns: A query dict, which is empty if no filtering is required.
+        """
+        if user is not None and user.get('admin', False) is True:
+            return {}
+
+        clauses = []
+        if level == AccessType.READ:
+            clauses.append({'public': True})
+        if user is not None:
+            clauses.append({'access.users': {'$elemMatch': {
+                'id': user['_id'],
+                'level': {'$gte': level}
+            }}})
+            if user.get('groups'):
+                clauses.append({'access.groups': {'$elemMatch': {
+                    'id': {'$in': user['groups']},
+                    'level': {'$gte': level}
+                }}})
+
+        if not clauses:
+            # Nothing can match, e.g. anonymous requests for WRITE access
+            return {'_id': {'$in': []}}
+
+        return {'$or': clauses}
+
+    def mergePermissionClauses(self, query, user=None,
+                               level=AccessType.READ):
+        """
+        Return a copy of the query restricted to the documents the given user
+        has at least the given level of access on.
+
+        :param query: The query to restrict.
+        :type query: dict or None
+        :param user: The user to check policies against.
+        :type user: dict or None
+        :param level: The access level.
+        :type level: AccessType
+        """
+        query = dict(query or {})
+        clauses = self.permissionClauses(user=user, level=level)
+
+        if set(query) & set(clauses):
+            return {'$and': [query, clauses]}
+
+        query.update(clauses)
+        return query
+
+    def findWithPermissions(self, query=None, offset=0, limit=50, user=None,
+                            level=AccessType.READ, **kwargs):
+        """
+        Search the collection, returning only documents that the user has the
+        given level of access on. Unlike filterResultsByPermission, this is
+        done by the database, so offset and limit are applied server-side.
+        Passes any kwargs through to find().
+
+        :param query: The search query (see general MongoDB docs for "find()")
+        :type query: dict
+        :param offset: The offset into the results
+        :type offset: int
+        :param limit: Maximum number of documents to return
+        :type limit: int
+        :param user: The user to check policies against.
+        :type user: dict or None
+        :param level: The access level.
+        :type level: AccessType
+        :returns: A pymongo database cursor.
+        """
+        return self.find(self.mergePermissionClauses(query, user, level),
+                         offset=offset, limit=limit, **kwargs)
+
     def filterResultsByPermission(self, cursor, user, level, limit, offset,
                                   removeKeys=()):
         """
@@ -732,15 +1053,13 @@ class AccessControlledModel(Model):
 
         :param user: The user to apply permission filtering for.
         """
-        if not filters:
-            filters = {}
+        filters = self.mergePermissionClauses(filters, user=user,
+                                              level=AccessType.READ)
 
         cursor = Model.textSearch(
-            self, query=query, filters=filters, limit=0, sort=sort,
-            fields=fields)
-        return [r for r in self.filterResultsByPermission(
-            cursor, user=user, level=AccessType.READ, limit=limit,
-            offset=offset)]
+            self, query=query, filters=filters, limit=limit, offset=offset,
+            sort=sort, fields=fields)
+        return [r for r in cursor]
 
 
 class AccessException(Exception):
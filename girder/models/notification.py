@@ -21,6 +21,7 @@ import datetime
 import time
 
 from .model_base import Model
+from girder.utility.notification_broker import broker
 
 
 class ProgressState(object):
@@ -55,6 +56,16 @@ class Notification(Model):
     def validate(self, doc):
         return doc
 
+    def save(self, document, validate=True, triggerEvents=True):
+        """
+        Save the notification, then publish it to any notification streams
+        open in this process.
+        """
+        document = Model.save(self, document, validate=validate,
+                              triggerEvents=triggerEvents)
+        broker.publish(document)
+        return document
+
     def _createNotification(self, type, data, user, expires=None, token=None):
         """
         Helper method to create the notification record that gets saved.
@@ -168,23 +179,55 @@ class Notification(Model):
         record['updatedTime'] = time.time()
         if save:
             # Only update the time estimate if we are also saving
-            if (record['updatedTime'] > record['startTime'] and
-                    record['data']['estimateTime']):
-                if 'estimatedTotalTime' in record:
-                    del record['estimatedTotalTime']
-                try:
-                    total = float(record['data']['total'])
-                    current = float(record['data']['current'])
-                    if total >= current and total > 0 and current > 0:
-                        record['estimatedTotalTime'] = (total * (
-                            record['updatedTime'] - record['startTime']) /
-                            current)
-                except ValueError:
-                    pass
+            self._estimateTime(record)
             return self.save(record)
         else:
             return record
 
+    def _estimateTime(self, record):
+        """
+        Recompute the estimated total time of a progress record from its
+        elapsed time and the fraction of the task completed so far.
+        """
+        if (record['updatedTime'] > record['startTime'] and
+                record['data']['estimateTime']):
+            if 'estimatedTotalTime' in record:
+                del record['estimatedTotalTime']
+            try:
+                total = float(record['data']['total'])
+                current = float(record['data']['current'])
+                if total >= current and total > 0 and current > 0:
+                    record['estimatedTotalTime'] = (total * (
+                        record['updatedTime'] - record['startTime']) /
+                        current)
+            except ValueError:
+                pass
+
+    def flushProgress(self, record):
+        """
+        Write the changeable fields of a progress record that was modified
+        with ``updateProgress(save=False)``. Unlike saving the record, this
+        only sets the fields that progress updates can change rather than
+        rewriting the whole document.
+
+        :param record: The existing progress record to write.
+        :type record: dict
+        """
+        self._estimateTime(record)
+        fields = {'data.' + k: record['data'][k]
+                  for k in ('total', 'current', 'state', 'message')}
+        for k in ('updated', 'expires', 'updatedTime'):
+            fields[k] = record[k]
+        update = {'$set': fields}
+        if 'estimatedTotalTime' in record:
+            fields['estimatedTotalTime'] = record['estimatedTotalTime']
+        else:
+            update['$unset'] = {'estimatedTotalTime': True}
+
+        self.update({'_id': record['_id']}, update, multi=False)
+        broker.publish(record)
+        return record
+
     def get(self, user, since=None, token=None):
         """
         Get outstanding notifications for the given user.
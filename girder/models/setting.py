@@ -78,6 +78,11 @@ class Setting(Model):
 
         doc['value'] = list(doc['value'])
 
+    def validateCoreAncestorsComplete(self, doc):
+        if not isinstance(doc['value'], bool):
+            raise ValidationException(
+                'Ancestors complete flag must be a boolean.', 'value')
+
     def validateCoreCookieLifetime(self, doc):
         try:
             doc['value'] = int(doc['value'])
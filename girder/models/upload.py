@@ -18,19 +18,27 @@
 ###############################################################################
 
 import datetime
+import re
 from bson.objectid import ObjectId
 
 from girder import events
-from girder.utility import assetstore_utilities
-from .model_base import Model, ValidationException
+from girder.utility import assetstore_utilities, hash_state
+from .model_base import Model, ValidationException, identityMap
 from ..constants import AccessType
 
+# The number of seconds a request may spend finalizing a parallel upload
+# before a later chunk may take over, in case the first request died.
+FINALIZE_TIMEOUT = 600
+
 
 class Upload(Model):
     """
     This model stores temporary records for uploads that have been approved
     but are not yet complete, so that they can be uploaded in chunks of
-    arbitrary size. The chunks must be uploaded in order.
+    arbitrary size. The chunks must be uploaded in order, unless the upload
+    was created as a parallel upload. Parallel uploads accept chunks at any
+    offset, in any order and concurrently; the byte ranges received so far
+    are tracked in the ``ranges`` field.
     """
     def initialize(self):
         self.name = 'upload'
@@ -46,7 +54,7 @@ class Upload(Model):
 
         return doc
 
-    def handleChunk(self, upload, chunk):
+    def handleChunk(self, upload, chunk, offset=None):
         """
         When a chunk is uploaded, this should be called to process the chunk.
         If this is the final chunk of the upload, this method will finalize
@@ -55,10 +63,17 @@ class Upload(Model):
         :type upload: dict
         :param chunk: The file object representing the chunk that was uploaded.
         :type chunk: file
+        :param offset: The offset of the chunk within the file. This is only
+            used by parallel uploads.
+        :type offset: int
         """
         assetstore = self.model('assetstore').load(upload['assetstoreId'])
         adapter = assetstore_utilities.getAssetstoreAdapter(assetstore)
 
+        if 'ranges' in upload:
+            return self._handleChunkAt(upload, chunk, offset, adapter,
+                                       assetstore)
+
         upload = self.save(adapter.uploadChunk(upload, chunk))
 
         # If upload is finished, we finalize it
@@ -67,11 +82,75 @@ class Upload(Model):
         else:
             return upload
 
+    def _handleChunkAt(self, upload, chunk, offset, adapter, assetstore):
+        """
+        Store a chunk of a parallel upload and record its byte range. The
+        range is pushed atomically, so concurrent chunks never lose each
+        other's ranges, and exactly one request finalizes the upload once
+        every byte has been received.
+        """
+        if offset is None:
+            raise ValidationException('Parallel uploads require the offset '
+                                      'of each chunk.', 'offset')
+        size = adapter.uploadChunkAt(upload, chunk, offset)
+
+        updated = self.collection.find_and_modify(
+            {'_id': upload['_id']},
+            {'$push': {'ranges': [offset, offset + size]},
+             '$set': {'updated': datetime.datetime.utcnow()}},
+            new=True)
+        identityMap.invalidate(self.name, upload['_id'])
+        if updated is None:
+            # The upload was finalized or cancelled by another request while
+            # this chunk was written.
+            adapter.cancelChunkAt(upload, offset, size)
+            raise ValidationException('Upload no longer exists.')
+        upload = updated
+
+        received = sum(end - start
+                       for start, end in _mergeRanges(upload['ranges']))
+        self.update({'_id': upload['_id'], 'received': {'$lt': received}},
+                    {'$set': {'received': received}}, multi=False)
+        upload['received'] = max(upload['received'], received)
+
+        if received != upload['size']:
+            return upload
+
+        # Several chunks may complete the upload at once; only one of them
+        # gets to finalize it. The claim is released if finalizing fails, and
+        # expires in case the process holding it has died.
+        now = datetime.datetime.utcnow()
+        expired = now - datetime.timedelta(seconds=FINALIZE_TIMEOUT)
+        claimed = self.collection.find_and_modify(
+            {'_id': upload['_id'], '$or': [
+                {'finalizing': {'$exists': False}},
+                {'finalizing': {'$lt': expired}}
+            ]},
+            {'$set': {'finalizing': now}}, new=True)
+        identityMap.invalidate(self.name, upload['_id'])
+        if claimed is None:
+            return upload
+        try:
+            return self.finalizeUpload(claimed, assetstore)
+        except Exception:
+            self.update({'_id': upload['_id'], 'finalizing': now},
+                        {'$unset': {'finalizing': True}}, multi=False)
+            raise
+
     def requestOffset(self, upload):
         """
         Requests the offset that should be used to resume uploading. This
-        makes the request from the assetstore adapter.
+        makes the request from the assetstore adapter. For parallel uploads,
+        this returns the first missing offset and the list of missing
+        [start, end) byte ranges instead.
         """
+        if 'ranges' in upload:
+            missing = _missingRanges(upload['ranges'], upload['size'])
+            return {
+                'offset': missing[0][0] if missing else upload['size'],
+                'missing': missing
+            }
+
         assetstore = self.model('assetstore').load(upload['assetstoreId'])
         adapter = assetstore_utilities.getAssetstoreAdapter(assetstore)
         return adapter.requestOffset(upload)
@@ -120,9 +199,21 @@ class Upload(Model):
                 mimeType=upload['mimeType'], saveFile=False)
 
         adapter = assetstore_utilities.getAssetstoreAdapter(assetstore)
-        file = adapter.finalizeUpload(upload, file)
+        if 'blob' in upload:
+            # The data is already stored in the assetstore, so refer to it
+            # just as a copy of a file with that data would.
+            file.update(upload['blob'])
+            file = adapter.copyFile(upload['blob'], file)
+        else:
+            if 'ranges' in upload:
+                # Chunks arrived out of order, so the checksum could not be
+                # computed incrementally.
+                upload['hashState'] = hash_state.save(
+                    adapter.hashUpload(upload))
+            file = adapter.finalizeUpload(upload, file)
         self.model('file').save(file)
-        self.remove(upload)
+        if '_id' in upload:
+            self.remove(upload)
 
         # Add an async event for handlers that wish to process this file.
         events.daemon.trigger('data.process', {
@@ -132,7 +223,84 @@ class Upload(Model):
 
         return file
 
-    def createUploadToFile(self, file, user, size):
+    def createFileFromHash(self, user, name, parentType, parent, size,
+                           mimeType, sha512):
+        """
+        Creates a new file whose contents are already stored in the current
+        assetstore, without uploading them again. The data is only reused if
+        the user can read an existing file that has the same checksum and
+        size, so that knowing a checksum doesn't grant access to the data.
+
+        :param user: The user performing the upload.
+        :type user: dict
+        :param name: The name of the file being uploaded.
+        :type name: str
+        :param parentType: The type of the parent being uploaded into.
+        :type parentType: str ('folder' or 'item')
+        :param parent: The document representing the parent.
+        :type parentId: dict
+        :param size: Total size in bytes of the whole file.
+        :type size: int
+        :param mimeType: The mimeType of the file.
+        :type mimeType: str
+        :param sha512: The SHA-512 checksum of the file, as hex.
+        :type sha512: str
+        :returns: The new file document, or None if the data must be uploaded.
+        """
+        sha512 = sha512.lower()
+        if not re.match('^[0-9a-f]{128}$', sha512):
+            raise ValidationException('Invalid SHA-512 checksum.', 'sha512')
+
+        assetstore = self.model('assetstore').getCurrent()
+        if size <= 0 or not self._canReadData(user, assetstore, sha512, size):
+            return None
+        adapter = assetstore_utilities.getAssetstoreAdapter(assetstore)
+        blob = adapter.findBlob(sha512, size)
+        if blob is None:
+            return None
+        if 'crc32' not in blob:
+            existing = self.model('file').findOne({
+                'assetstoreId': assetstore['_id'],
+                'sha512': sha512,
+                'crc32': {'$exists': True}
+            }, fields=['crc32'])
+            if existing is not None:
+                blob['crc32'] = existing['crc32']
+
+        upload = {
+            'userId': user['_id'],
+            'parentType': parentType.lower(),
+            'parentId': ObjectId(parent['_id']),
+            'assetstoreId': assetstore['_id'],
+            'size': size,
+            'name': name,
+            'mimeType': mimeType or 'application/octet-stream',
+            'received': size,
+            'blob': blob
+        }
+        return self.finalizeUpload(upload, assetstore)
+
+    def _canReadData(self, user, assetstore, sha512, size):
+        """
+        Whether the user can read some file in the assetstore with the given
+        checksum and size.
+        """
+        files = self.model('file').find({
+            'assetstoreId': assetstore['_id'],
+            'sha512': sha512,
+            'size': size
+        }, limit=0, fields=['itemId'])
+        for file in files:
+            item = self.model('item').load(file['itemId'], force=True)
+            if item is None:
+                continue
+            folder = self.model('folder').load(item['folderId'], force=True)
+            if folder is not None and self.model('folder').hasAccess(
+                    folder, user, AccessType.READ):
+                return True
+        return False
+
+    def createUploadToFile(self, file, user, size, parallel=False):
         """
         Creates a new upload record into a file that already exists. This
         should be used when updating the contents of a file. Deletes any
@@ -143,6 +311,8 @@ class Upload(Model):
         :param file: The file record to update.
         :param user: The user performing this upload.
         :param size: The size of the new file contents.
+        :param parallel: Whether chunks may be sent out of order.
+        :type parallel: bool
         """
         assetstore = self.model('assetstore').getCurrent()
         adapter = assetstore_utilities.getAssetstoreAdapter(assetstore)
@@ -160,9 +330,13 @@ class Upload(Model):
             'received': 0
         }
         upload = adapter.initUpload(upload)
+        if parallel and upload['size'] > 0:
+            upload['ranges'] = []
+            upload = adapter.initParallelUpload(upload)
         return self.save(upload)
 
-    def createUpload(self, user, name, parentType, parent, size, mimeType):
+    def createUpload(self, user, name, parentType, parent, size, mimeType,
+                     parallel=False):
         """
         Creates a new upload record, and creates its temporary file
         that the chunks will be written into. Chunks should then be sent
@@ -180,6 +354,9 @@ class Upload(Model):
         :type size: int
         :param mimeType: The mimeType of the file.
         :type mimeType: str
+        :param parallel: Whether chunks may be sent out of order and
+            concurrently. The assetstore must support this.
+        :type parallel: bool
         :returns: The upload document that was created.
         """
         assetstore = self.model('assetstore').getCurrent()
@@ -201,6 +378,9 @@ class Upload(Model):
             'received': 0
         }
         upload = adapter.initUpload(upload)
+        if parallel and upload['size'] > 0:
+            upload['ranges'] = []
+            upload = adapter.initParallelUpload(upload)
         return self.save(upload)
 
     def list(self, limit=50, offset=0, sort=None, filters=None):
@@ -281,3 +461,32 @@ class Upload(Model):
                 # this assetstore is currently unreachable, so skip it
                 pass
         return results
+
+
+def _mergeRanges(ranges):
+    """
+    Merge a list of [start, end) ranges into a sorted list of disjoint ranges.
+    """
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def _missingRanges(ranges, size):
+    """
+    Get the [start, end) ranges of a file of the given size that are not
+    covered by any of the given ranges.
+    """
+    missing = []
+    position = 0
+    for start, end in _mergeRanges(ranges):
+        if start > position:
+            missing.append([position, start])
+        position = max(position, end)
+    if position < size:
+        missing.append([position, size])
+    return missing
@@ -167,7 +167,8 @@ class User(AccessControlledModel):
             progress.update(increment=1, message='Deleted user ' +
                             user['login'])
 
-    def search(self, text=None, user=None, limit=50, offset=0, sort=None):
+    def search(self, text=None, user=None, limit=50, offset=0, sort=None,
+               after=None):
         """
         List all users. Since users are access-controlled, this will filter
         them by access policy.
@@ -178,18 +179,20 @@ class User(AccessControlledModel):
         :param limit: Result limit.
         :param offset: Result offset.
         :param sort: The sort structure to pass to pymongo.
+        :param after: Sort key values to page after, see Model.find. Ignored
+            for text searches.
         :returns: List of users.
         """
-        # Perform the find; we'll do access-based filtering of the result set
-        # afterward.
+        # Access-based filtering is done as part of the database query.
         if text is not None:
-            cursor = self.textSearch(text, limit=0, sort=sort)
+            cursor = self.textSearch(text, user=user, limit=limit,
+                                     offset=offset, sort=sort)
         else:
-            cursor = self.find({}, limit=0, sort=sort)
+            cursor = self.findWithPermissions(
+                {}, user=user, level=AccessType.READ, limit=limit,
+                offset=offset, sort=sort, after=after)
 
-        for r in self.filterResultsByPermission(cursor=cursor, user=user,
-                                                level=AccessType.READ,
-                                                limit=limit, offset=offset):
+        for r in cursor:
             yield r
 
     def setPassword(self, user, password, save=True):
@@ -257,7 +260,7 @@ class User(AccessControlledModel):
         return user
 
     def fileList(self, doc, user=None, path='', includeMetadata=False,
-                 subpath=True):
+                 subpath=True, data=True):
         """
         Generate a list of files within this user's folders.
 
@@ -270,6 +273,8 @@ class User(AccessControlledModel):
                                 metadata[-(number).json that is distinct from
                                 any file within the item.
         :param subpath: if True, add the user's name to the path.
+        :param data: if True, return a function that generates the contents of
+                     each file; otherwise return the file document.
         """
         if subpath:
             path = os.path.join(path, doc['login'])
@@ -279,7 +284,8 @@ class User(AccessControlledModel):
         }, limit=0, timeout=False)
         for folder in folders:
             for (filepath, file) in self.model('folder').fileList(
-                    folder, user, path, includeMetadata, subpath=True):
+                    folder, user, path, includeMetadata, subpath=True,
+                    data=data):
                 yield (filepath, file)
 
     def subtreeCount(self, doc):
@@ -289,6 +295,14 @@ class User(AccessControlledModel):
         :param doc: The user.
         """
         count = 1
+        if self.model('folder').ancestorsComplete():
+            q = {
+                'ancestors': doc['_id']
+            }
+            count += self.model('folder').find(q, fields=(), limit=0).count()
+            count += self.model('item').find(q, fields=(), limit=0).count()
+            return count
+
         folders = self.model('folder').find({
             'parentId': doc['_id'],
             'parentCollection': 'user'
@@ -14,6 +14,7 @@
 #  limitations under the License.
 ###############################################################################
 
+import cherrypy
 import os
 
 from ..constants import SettingKey
@@ -80,6 +81,21 @@ class AbstractAssetstoreAdapter(object):
         raise Exception('Must override processChunk in %s.'
                         % self.__class__.__name__)  # pragma: no cover
 
+    def uploadFromStream(self, upload, stream):
+        """
+        Store all of the data of an upload from an iterable of data blocks
+        read on the server, rather than from chunks sent by a client, as when
+        files are moved between assetstores. Default behavior is to pass the
+        data to uploadChunk as a single chunk; adapters whose uploadChunk does
+        not take the data itself must override this.
+        :param upload: The upload document, as returned by initUpload.
+        :type upload: dict
+        :param stream: The data of the whole upload.
+        :type stream: iterable of str
+        :returns: The upload document, ready to be finalized.
+        """
+        return self.uploadChunk(upload, _StreamReader(stream))
+
     def finalizeUpload(self, upload, file):
         """
         Call this once the last chunk has been processed. This method does not
@@ -94,6 +110,20 @@ class AbstractAssetstoreAdapter(object):
         """
         return file
 
+    def findBlob(self, sha512, size):
+        """
+        Look for data with the given checksum and size that is already stored
+        in this assetstore, so that a new file can refer to it without the
+        data being uploaded again. By default, nothing is found.
+        :param sha512: The SHA-512 checksum of the data, as lowercase hex.
+        :type sha512: str
+        :param size: The size of the data in bytes.
+        :type size: int
+        :returns: A dict of the fields to set on a file that refers to the
+            data, or None if this assetstore doesn't have it.
+        """
+        return None
+
     def requestOffset(self, upload):
         """
         Request the offset for resuming an interrupted upload. Default behavior
@@ -115,7 +145,18 @@ class AbstractAssetstoreAdapter(object):
         raise Exception('Must override deleteFile in %s.'
                         % self.__class__.__name__)  # pragma: no cover
 
-    def downloadFile(self, file, offset=0, headers=True):
+    def deleteData(self, file):
+        """
+        Remove the stored data of a file that has been moved out of this
+        assetstore. Unlike deleteFile, this does not check whether other files
+        share the data; the caller must have done so.
+        :param file: The File document as it was in this assetstore.
+        :type file: dict
+        """
+        raise Exception('Must override deleteData in %s.'
+                        % self.__class__.__name__)  # pragma: no cover
+
+    def downloadFile(self, file, offset=0, headers=True, endByte=None):
         """
         This method is in charge of returning a value to the RESTful endpoint
         that can be used to download the file. This can return a generator
@@ -127,10 +168,60 @@ class AbstractAssetstoreAdapter(object):
         :type offset: int
         :param headers: Flag for whether headers should be sent on the response.
         :type headers: bool
+        :param endByte: Final byte to download, exclusive. If None, download
+            to the end of the file.
+        :type endByte: int or None
         """
         raise Exception('Must override downloadFile in %s.'
                         % self.__class__.__name__)  # pragma: no cover
 
+    def readFile(self, file, offset=0, endByte=None):
+        """
+        Returns a generator function that yields the stored data of a file,
+        or of a byte range of it, without touching the response. This is used
+        to copy files out of the assetstore, for instance into the download
+        cache or into an archive. The default uses downloadFile, which suits
+        adapters that stream their data; adapters that redirect downloads must
+        override this.
+        :param file: The file document to read.
+        :type file: dict
+        :param offset: Offset in bytes to start reading at.
+        :type offset: int
+        :param endByte: Final byte to read, exclusive. If None, read to the
+            end of the file.
+        :type endByte: int or None
+        """
+        kwargs = {} if endByte is None else {'endByte': endByte}
+        return self.downloadFile(file, offset=offset, headers=False, **kwargs)
+
+    def offloadDownload(self, file):
+        """
+        Adapters whose files can be sent directly by a front-end web server
+        may override this to hand off the download of a whole file: it should
+        set the response headers that instruct the front-end server to send
+        the file and return True. The front-end server is then responsible
+        for honoring any Range header of the request. Default behavior is to
+        return False, in which case downloadFile is used.
+
+        :param file: The file document being downloaded.
+        :type file: dict
+        :returns: Whether the download was handed off.
+        """
+        return False
+
+    def setContentHeaders(self, file, offset, endByte):
+        """
+        Set the Content-Type, Content-Length and Content-Disposition headers
+        for downloading the given byte range of a file.
+        """
+        mimeType = file.get('mimeType', 'application/octet-stream')
+        if not mimeType:
+            mimeType = 'application/octet-stream'
+        cherrypy.response.headers['Content-Type'] = mimeType
+        cherrypy.response.headers['Content-Length'] = max(endByte - offset, 0)
+        cherrypy.response.headers['Content-Disposition'] = \
+            'attachment; filename="%s"' % file['name']
+
     def copyFile(self, srcFile, destFile):
         """
         This method copies the necessary fields and data so that the
@@ -147,7 +238,8 @@ class AbstractAssetstoreAdapter(object):
         """
         Given a chunk that is either a file-like object or a string, attempt to
         determine its length.  If it is a filelike object, then this relies on
-        being able to use fstat.
+        being able to use fstat, or on its length attribute, as is set for a
+        request body that is streamed.
         :param chunk: the chunk to get the size of
         :type chunk: a file-like object or a string
         :returns: the length of the chunk if known, or None.
@@ -157,6 +249,8 @@ class AbstractAssetstoreAdapter(object):
             chunkSize = os.fstat(chunk.fileno()).st_size
         elif isinstance(chunk, basestring):
             chunkSize = len(chunk)
+        elif getattr(chunk, 'length', None) is not None:
+            chunkSize = chunk.length
         return chunkSize
 
     def checkUploadSize(self, upload, chunkSize):
@@ -169,15 +263,81 @@ class AbstractAssetstoreAdapter(object):
         :type chunkSize: a non-negative integer or None if unknown."""
         if 'received' not in upload or 'size' not in upload:
             return
+        self.checkChunkRange(upload, upload['received'], chunkSize)
+
+    def checkChunkRange(self, upload, offset, chunkSize):
+        """Check if a chunk of the given size may be written at an offset
+        within the upload.  Every chunk other than the one that ends the file
+        must be at least the minimum chunk size.
+        :param upload: the dictionary of upload information.
+        :param offset: the offset of the chunk within the upload.
+        :type offset: int
+        :param chunkSize: the chunk size that needs to be validated.
+        :type chunkSize: a non-negative integer or None if unknown."""
         if chunkSize is None:
             return
-        if upload['received']+chunkSize > upload['size']:
+        if offset+chunkSize > upload['size']:
             raise ValidationException('Received too many bytes.')
-        if upload['received']+chunkSize != upload['size'] and \
+        if offset+chunkSize != upload['size'] and \
                 chunkSize < ModelImporter().model('setting').get(
                 SettingKey.UPLOAD_MINIMUM_CHUNK_SIZE):
             raise ValidationException('Chunk is smaller than the minimum size.')
 
+    def initParallelUpload(self, upload):
+        """
+        Prepare an upload, after initUpload, to receive chunks at arbitrary
+        offsets, possibly concurrently. Adapters that support this must also
+        implement uploadChunkAt and hashUpload. By default, parallel uploads
+        are refused.
+        :param upload: The upload document.
+        :type upload: dict
+        :returns: The upload document.
+        """
+        raise ValidationException(
+            'This assetstore does not support parallel uploads.')
+
+    def uploadChunkAt(self, upload, chunk, offset):
+        """
+        Write a chunk of a parallel upload at the given offset. This may be
+        called concurrently for different chunks of the same upload, so it
+        must not modify the upload document.
+        :param upload: The upload document.
+        :type upload: dict
+        :param chunk: The chunk contents.
+        :type chunk: a file-like object or a string
+        :param offset: The offset of the chunk within the file.
+        :type offset: int
+        :returns: The number of bytes written.
+        """
+        raise Exception('Must override uploadChunkAt in %s.'
+                        % self.__class__.__name__)  # pragma: no cover
+
+    def cancelChunkAt(self, upload, offset, size):
+        """
+        Discard a chunk written by uploadChunkAt after its upload was
+        finalized or cancelled by another request. Data that now belongs to a
+        file must be left alone. By default, nothing is done.
+        :param upload: The upload document the chunk was written for.
+        :type upload: dict
+        :param offset: The offset of the chunk within the file.
+        :type offset: int
+        :param size: The number of bytes that were written.
+        :type size: int
+        """
+        pass
+
+    def hashUpload(self, upload):
+        """
+        Compute the checksums of all of the data of an upload. This is called
+        once every chunk of a parallel upload has been received, and when
+        finalizing an upload whose streaming checksums were lost.
+        :param upload: The upload document.
+        :type upload: dict
+        :returns: a girder.utility.hash_state.ResumableHasher.
+        """
+        raise Exception('Must override hashUpload in %s.'
+                        % self.__class__.__name__)  # pragma: no cover
+
     def cancelUpload(self, upload):
         """
         This is called when an upload has been begun and it should be
@@ -187,6 +347,24 @@ class AbstractAssetstoreAdapter(object):
         raise Exception('Must override cancelUpload in %s.'
                         % self.__class__.__name__)  # pragma: no cover
 
+    def importData(self, parent, parentType, params, progress, user):
+        """
+        Register existing data in the assetstore's storage as files, without
+        copying it. By default, importing is refused.
+        :param parent: The folder, user or collection to import into.
+        :type parent: dict
+        :param parentType: The type of the parent.
+        :type parentType: str
+        :param params: Parameters specific to the assetstore type.
+        :type params: dict
+        :param progress: A progress context to record progress on.
+        :param user: The user to record as the creator of new records.
+        :type user: dict
+        :returns: A dict of counts of what was imported.
+        """
+        raise ValidationException(
+            'This assetstore does not support importing data.')
+
     def untrackedUploads(self, knownUploads=[], delete=False):
         """
         List and optionally discard uploads that are in the assetstore but not
@@ -199,3 +377,30 @@ class AbstractAssetstoreAdapter(object):
         :returns: a list of unknown uploads.
         """
         return []
+
+
+class _StreamReader(object):
+    """
+    A file-like wrapper around an iterable of data blocks.
+    """
+    def __init__(self, stream):
+        self._stream = iter(stream)
+        self._buffer = ''
+
+    def read(self, size=-1):
+        pieces = [self._buffer]
+        length = len(self._buffer)
+        while size < 0 or length < size:
+            data = next(self._stream, None)
+            if data is None:
+                break
+            pieces.append(data)
+            length += len(data)
+        data = ''.join(pieces)
+        if size < 0:
+            size = length
+        data, self._buffer = data[:size], data[size:]
+        return data
+
+    def close(self):
+        pass
@@ -17,6 +17,8 @@
 #  limitations under the License.
 ###############################################################################
 
+import threading
+
 from .filesystem_assetstore_adapter import FilesystemAssetstoreAdapter
 from .gridfs_assetstore_adapter import GridFsAssetstoreAdapter
 from .s3_assetstore_adapter import S3AssetstoreAdapter
@@ -24,19 +26,42 @@ from girder.constants import AssetstoreType
 from girder import events
 
 
+# Adapters of the built-in assetstore types, keyed by assetstore id. Each
+# entry holds the assetstore's modification time along with the adapter so
+# that a stale adapter is never returned for an assetstore that has since
+# been changed, even by another process.
+_adapterCache = {}
+_adapterCacheLock = threading.Lock()
+
+
 def getAssetstoreAdapter(assetstore):
     """
     This is a factory method that will return the appropriate assetstore adapter
     for the specified assetstore. The returned object will conform to
     the interface of the AbstractAssetstoreAdapter.
+
+    Adapters of the built-in assetstore types are cached and reused while the
+    assetstore is unchanged, since constructing them may open connections and
+    check indices.
+
     :param assetstore: The assetstore document used to instantiate the adapter.
     :type assetstore: dict
     :returns: An adapter descending from AbstractAssetstoreAdapter
     """
+    key = assetstore.get('_id')
+    updated = assetstore.get('updated')
+    if key is not None:
+        entry = _adapterCache.get(key)
+        if entry is not None and entry[0] == updated:
+            return entry[1]
+
     if assetstore['type'] == AssetstoreType.FILESYSTEM:
         assetstoreAdapter = FilesystemAssetstoreAdapter(assetstore)
     elif assetstore['type'] == AssetstoreType.GRIDFS:
         assetstoreAdapter = GridFsAssetstoreAdapter(assetstore)
+        if isinstance(assetstoreAdapter.chunkColl, basestring):
+            # The database could not be reached; retry on the next call.
+            return assetstoreAdapter
     elif assetstore['type'] == AssetstoreType.S3:
         assetstoreAdapter = S3AssetstoreAdapter(assetstore)
     else:
@@ -45,9 +70,27 @@ def getAssetstoreAdapter(assetstore):
             return e.responses[-1]
         raise Exception('No AssetstoreAdapter for type: ' + assetstore['type'])
 
+    if key is not None:
+        with _adapterCacheLock:
+            _adapterCache[key] = (updated, assetstoreAdapter)
     return assetstoreAdapter
 
 
+def clearAdapterCache(assetstoreId=None):
+    """
+    Discard cached assetstore adapters. This is called whenever an assetstore
+    is saved or removed.
+
+    :param assetstoreId: The id of the assetstore whose adapter should be
+        discarded. If None, all cached adapters are discarded.
+    """
+    with _adapterCacheLock:
+        if assetstoreId is None:
+            _adapterCache.clear()
+        else:
+            _adapterCache.pop(assetstoreId, None)
+
+
 def fileIndexFields():
     """
     This will return a set of all required index fields from all of the
@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+"""
+A read-through cache on local disk for files in remote assetstores. Downloads
+of files in S3 and GridFS assetstores are served from the cache when it holds
+their data. Otherwise the download proceeds as usual and the data is copied
+into the cache by an asynchronous event, so later downloads are local.
+
+Cached data is stored by its SHA-512 checksum, so files with the same contents
+share an entry. When a file without a checksum is cached, as is the case for
+files uploaded directly to S3, its checksums are computed while it is copied
+and recorded on the file. The total size of the cache is bounded; the least
+recently used entries are evicted to make room.
+
+The cache is configured by the "cache_root" and "cache_capacity" values of the
+"downloads" config section. Each server process keeps its own index of the
+entries, so processes should not share a cache directory.
+"""
+
+import collections
+import errno
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from girder import events, logger
+from girder.constants import AssetstoreType
+from girder.utility import config, hash_state
+from .model_importer import ModelImporter
+
+BUF_SIZE = 65536
+# Assetstore types whose downloads are cached. Filesystem assetstores are
+# already local.
+CACHED_TYPES = (AssetstoreType.GRIDFS, AssetstoreType.S3)
+# Seconds after which a fill that never finished, for instance because its
+# event was dropped, no longer prevents the file from being filled again.
+FILL_TIMEOUT = 3600
+
+_cache = None
+_cacheLock = threading.Lock()
+
+
+class DownloadCache(object):
+    """
+    A size-bounded cache of file data in a local directory, evicted in least
+    recently used order. All methods are thread safe.
+
+    :param root: The directory to store the cache in.
+    :type root: str
+    :param capacity: The maximum total size of the cached data in bytes.
+    :type capacity: int
+    """
+    def __init__(self, root, capacity):
+        self.root = root
+        self.capacity = capacity
+        self.tempDir = os.path.join(root, 'temp')
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._reserved = 0
+        self._filling = {}
+        self._counts = collections.defaultdict(int)
+        self._load()
+
+    def _path(self, sha512):
+        return os.path.join(self.root, sha512[0:2], sha512[2:4], sha512)
+
+    def _load(self):
+        """
+        Index the entries left by a previous process, oldest first, and remove
+        the remains of fills that were interrupted.
+        """
+        shutil.rmtree(self.tempDir, ignore_errors=True)
+        found = []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for name in filenames:
+                if len(name) == 128:
+                    stat = os.stat(os.path.join(dirpath, name))
+                    found.append((stat.st_mtime, name, stat.st_size))
+        for _, sha512, size in sorted(found):
+            self._entries[sha512] = size
+            self._size += size
+        with self._lock:
+            self._evict(0)
+
+    def _evict(self, size):
+        """
+        Remove the least recently used entries until there is room for size
+        more bytes. The lock must be held by the caller.
+
+        :returns: Whether there is room.
+        """
+        while (self._entries and
+               self._size + self._reserved + size > self.capacity):
+            sha512, entrySize = self._entries.popitem(last=False)
+            self._size -= entrySize
+            self._counts['evictions'] += 1
+            try:
+                os.remove(self._path(sha512))
+            except OSError as exc:
+                if exc.errno != errno.ENOENT:
+                    raise
+        return self._size + self._reserved + size <= self.capacity
+
+    def open(self, file):
+        """
+        Open the cached data of a file. Readers keep their handle valid even
+        if the entry is evicted while they read.
+
+        :param file: The file document.
+        :type file: dict
+        :returns: A file object open for reading, or None if the data is not
+            cached.
+        """
+        sha512 = file.get('sha512')
+        with self._lock:
+            hit = sha512 in self._entries
+            if hit:
+                # Mark the entry as the most recently used
+                self._entries[sha512] = self._entries.pop(sha512)
+        if hit:
+            path = self._path(sha512)
+            try:
+                handle = open(path, 'rb')
+                os.utime(path, None)
+            except (IOError, OSError):
+                logger.warning('Cached file %s has gone missing.' % path)
+                with self._lock:
+                    if sha512 in self._entries:
+                        self._size -= self._entries.pop(sha512)
+                hit = False
+        with self._lock:
+            self._counts['hits' if hit else 'misses'] += 1
+        return handle if hit else None
+
+    def fill(self, file, adapter):
+        """
+        Schedule copying the data of a file into the cache. Nothing is done if
+        the data is already cached, is being copied, or can't fit.
+
+        :param file: The file document.
+        :type file: dict
+        :param adapter: The adapter of the assetstore the file is in.
+        :returns: Whether a copy was scheduled.
+        """
+        key = file.get('sha512') or str(file['_id'])
+        now = time.time()
+        with self._lock:
+            if (key in self._entries or file['size'] > self.capacity or
+                    self._filling.get(key, 0) > now - FILL_TIMEOUT):
+                return False
+            self._filling[key] = now
+        events.daemon.trigger('_download_cache_fill', {
+            'cache': self,
+            'key': key,
+            'file': file,
+            'adapter': adapter
+        })
+        return True
+
+    def _fill(self, key, file, adapter):
+        """
+        Copy the data of a file into the cache. The data is written to a
+        temporary file and checked against the file's size and checksum
+        before it is moved into place, so readers never see partial entries.
+        """
+        size = file['size']
+        tempPath = None
+        reserved = False
+        try:
+            with self._lock:
+                reserved = self._evict(size)
+                if not reserved:
+                    # Other fills in progress have reserved the room
+                    return
+                self._reserved += size
+
+            _makeDirs(self.tempDir)
+            fd, tempPath = tempfile.mkstemp(dir=self.tempDir)
+            checksum = hash_state.ResumableHasher(['sha512', 'crc32'])
+            written = 0
+            with os.fdopen(fd, 'wb') as out:
+                for data in adapter.readFile(file)():
+                    checksum.update(data)
+                    out.write(data)
+                    written += len(data)
+            digests = checksum.hexdigests()
+            sha512 = digests['sha512']
+            if written != size or file.get('sha512', sha512) != sha512:
+                raise Exception(
+                    'Data read for file {} does not match its size or '
+                    'checksum.'.format(file['_id']))
+
+            path = self._path(sha512)
+            _makeDirs(os.path.dirname(path))
+            os.rename(tempPath, path)
+            tempPath = None
+            with self._lock:
+                self._reserved -= size
+                reserved = False
+                if sha512 not in self._entries:
+                    self._entries[sha512] = size
+                    self._size += size
+                self._counts['fills'] += 1
+
+            missing = {alg: digest for alg, digest in digests.iteritems()
+                       if alg not in file}
+            if missing:
+                ModelImporter().model('file').update({
+                    '_id': file['_id']
+                }, {'$set': missing}, multi=False)
+        except Exception:
+            logger.exception('Failed to cache file {}.'.format(file['_id']))
+            with self._lock:
+                self._counts['fillErrors'] += 1
+        finally:
+            if tempPath is not None:
+                os.remove(tempPath)
+            with self._lock:
+                if reserved:
+                    self._reserved -= size
+                self._filling.pop(key, None)
+
+    def stats(self):
+        """
+        :returns: A dict with the capacity and current size of the cache, the
+            number of entries and of fills in progress, and counts of hits,
+            misses, evictions, completed fills and failed fills.
+        """
+        with self._lock:
+            return {
+                'capacity': self.capacity,
+                'size': self._size,
+                'entries': len(self._entries),
+                'filling': len(self._filling),
+                'hits': self._counts['hits'],
+                'misses': self._counts['misses'],
+                'evictions': self._counts['evictions'],
+                'fills': self._counts['fills'],
+                'fillErrors': self._counts['fillErrors']
+            }
+
+
+def _makeDirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+
+
+def getCache():
+    """
+    Get the download cache described by the config, creating it if the config
+    has changed.
+
+    :returns: The DownloadCache, or None if caching is not configured.
+    """
+    global _cache
+
+    conf = config.getConfig().get('downloads', {})
+    root = conf.get('cache_root')
+    capacity = int(conf.get('cache_capacity') or 0)
+    if not root or capacity <= 0:
+        return None
+    with _cacheLock:
+        if _cache is None or (_cache.root, _cache.capacity) != (
+                root, capacity):
+            _cache = DownloadCache(root, capacity)
+        return _cache
+
+
+def getStats():
+    """
+    :returns: The statistics of the download cache, with "enabled" set to
+        whether it is configured.
+    """
+    cache = getCache()
+    if cache is None:
+        return {'enabled': False}
+    return dict(cache.stats(), enabled=True)
+
+
+def streamFile(handle, adapter, file, offset=0, headers=True, endByte=None):
+    """
+    Serve a download from the cached data of a file. This has the signature
+    of an adapter's downloadFile method, after the handle and adapter.
+
+    :param handle: The open cached data, as returned by DownloadCache.open.
+        It is left open; see closeAfter.
+    :param adapter: The adapter of the file's assetstore, used to set the
+        response headers.
+    """
+    if endByte is None or endByte > file['size']:
+        endByte = file['size']
+
+    if headers:
+        adapter.setContentHeaders(file, offset, endByte)
+
+    def stream():
+        position = offset
+        while position < endByte:
+            # Seek every time, as several ranges may be read from one handle
+            handle.seek(position)
+            data = handle.read(min(BUF_SIZE, endByte - position))
+            if not data:
+                break
+            position += len(data)
+            yield data
+
+    return stream
+
+
+def closeAfter(stream, handle):
+    """
+    Wrap a generator function so that a handle is closed once the stream has
+    been read, or when it is abandoned.
+
+    :param stream: The generator function to wrap.
+    :param handle: The file object to close.
+    :returns: A generator function.
+    """
+    def wrapped():
+        try:
+            for data in stream():
+                yield data
+        finally:
+            handle.close()
+
+    return wrapped
+
+
+def _fillImpl(event):
+    info = event.info
+    info['cache']._fill(info['key'], info['file'], info['adapter'])
+
+
+events.bind('_download_cache_fill', '_download_cache_fill', _fillImpl)
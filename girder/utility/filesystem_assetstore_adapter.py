@@ -18,20 +18,34 @@
 ###############################################################################
 
 import cherrypy
+import datetime
+import errno
+import mimetypes
 import os
 import stat
 import tempfile
+import urllib
 
 from StringIO import StringIO
-from hashlib import sha512
-from . import sha512_state
+from . import config, hash_state, ingest
 from .abstract_assetstore_adapter import AbstractAssetstoreAdapter
 from .model_importer import ModelImporter
 from girder.models.model_base import ValidationException
-from girder import logger
+from girder import events, logger
 
 BUF_SIZE = 65536
 
+# Number of imported files whose records are inserted at once
+IMPORT_BATCH_SIZE = 1000
+# Number of imported files whose checksums are computed per event
+IMPORT_HASH_BATCH_SIZE = 100
+
+# Headers used to hand downloads off to a front-end web server, by mode
+OFFLOAD_HEADERS = {
+    'x-sendfile': 'X-Sendfile',
+    'x-accel-redirect': 'X-Accel-Redirect'
+}
+
 
 class FilesystemAssetstoreAdapter(AbstractAssetstoreAdapter):
     """
@@ -61,9 +75,10 @@ class FilesystemAssetstoreAdapter(AbstractAssetstoreAdapter):
     @staticmethod
     def fileIndexFields():
         """
-        File documents should have an index on their sha512 field.
+        File documents should have an index on their sha512 field, and on
+        their path field, which imports look files up by.
         """
-        return ['sha512']
+        return ['sha512', 'path']
 
     def __init__(self, assetstore):
         """
@@ -113,43 +128,57 @@ class FilesystemAssetstoreAdapter(AbstractAssetstoreAdapter):
         fd, path = tempfile.mkstemp(dir=self.tempDir)
         os.close(fd)  # Must close this file descriptor or it will leak
         upload['tempFile'] = path
-        upload['sha512state'] = sha512_state.serializeHex(sha512())
+        upload['hashState'] = hash_state.save(hash_state.ResumableHasher())
         return upload
 
+    def _readTempFile(self, upload, offset=0):
+        """
+        Yields the contents of the temporary file of an upload from the given
+        offset.
+        """
+        with open(upload['tempFile'], 'rb') as tempFile:
+            tempFile.seek(offset)
+            while True:
+                data = tempFile.read(BUF_SIZE)
+                if not data:
+                    break
+                yield data
+
     def uploadChunk(self, upload, chunk):
         """
         Appends the chunk into the temporary file.
         """
         # If we know the chunk size is too large or small, fail early.
-        self.checkUploadSize(upload, self.getChunkSize(chunk))
+        chunkSize = self.getChunkSize(chunk)
+        self.checkUploadSize(upload, chunkSize)
 
         if isinstance(chunk, basestring):
             chunk = StringIO(chunk)
 
-        # Restore the internal state of the streaming SHA-512 checksum
-        checksum = sha512_state.restoreHex(upload['sha512state'])
+        # Resume the streaming checksums. If they were lost, the chunk is
+        # stored without hashing and the checksums are computed on finalize.
+        checksum = hash_state.resume(upload.get('hashState'))
 
-        if self.requestOffset(upload) > upload['received']:
+        if (not checksum.stale and
+                self.requestOffset(upload) > checksum.offset):
             # This probably means the server died midway through writing last
             # chunk to disk, and the database record was not updated. This means
-            # we need to update the sha512 state with the difference.
-            with open(upload['tempFile'], 'rb') as tempFile:
-                tempFile.seek(upload['received'])
-                while True:
-                    data = tempFile.read(BUF_SIZE)
-                    if not data:
-                        break
-                    checksum.update(data)
+            # we need to update the checksums with the difference.
+            for data in self._readTempFile(upload, checksum.offset):
+                checksum.update(data)
 
-        with open(upload['tempFile'], 'a+b') as tempFile:
+        # Each block is hashed on another thread while it is written and the
+        # next block is read.
+        with open(upload['tempFile'], 'a+b') as tempFile, \
+                ingest.HashPipeline(checksum, chunkSize) as pipeline:
             size = 0
             while not upload['received']+size > upload['size']:
-                data = chunk.read(BUF_SIZE)
+                data = chunk.read(ingest.BLOCK_SIZE)
                 if not data:
                     break
                 size += len(data)
+                pipeline.put(data)
                 tempFile.write(data)
-                checksum.update(data)
         chunk.close()
 
         try:
@@ -159,23 +188,94 @@ class FilesystemAssetstoreAdapter(AbstractAssetstoreAdapter):
                 tempFile.truncate(upload['received'])
             raise
 
-        # Persist the internal state of the checksum
-        upload['sha512state'] = sha512_state.serializeHex(checksum)
+        # Keep the checksums for the next chunk
+        upload['hashState'] = hash_state.save(checksum)
         upload['received'] += size
+        return ingest.recordStats(upload, pipeline)
+
+    def initParallelUpload(self, upload):
+        """
+        Preallocate the temporary file to the full size of the upload so that
+        chunks can be written into it at any offset.
+        """
+        with open(upload['tempFile'], 'r+b') as tempFile:
+            tempFile.truncate(upload['size'])
         return upload
 
+    def uploadChunkAt(self, upload, chunk, offset):
+        """
+        Writes the chunk into the preallocated temporary file at its offset.
+        Each call writes through its own file descriptor, so chunks of the same
+        upload can be written concurrently.
+        """
+        self.checkChunkRange(upload, offset, self.getChunkSize(chunk))
+
+        if isinstance(chunk, basestring):
+            chunk = StringIO(chunk)
+
+        size = 0
+        try:
+            fd = os.open(upload['tempFile'], os.O_WRONLY)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            chunk.close()
+            raise ValidationException('Upload no longer exists.')
+        try:
+            os.lseek(fd, offset, os.SEEK_SET)
+            while True:
+                data = chunk.read(BUF_SIZE)
+                if not data:
+                    break
+                if offset + size + len(data) > upload['size']:
+                    raise ValidationException('Received too many bytes.')
+                size += len(data)
+                while data:
+                    data = data[os.write(fd, data):]
+        finally:
+            os.close(fd)
+            chunk.close()
+
+        self.checkChunkRange(upload, offset, size)
+        return size
+
+    def hashUpload(self, upload):
+        """
+        Computes the checksums of the assembled temporary file.
+        """
+        checksum = hash_state.ResumableHasher()
+        for data in self._readTempFile(upload):
+            checksum.update(data)
+        return checksum
+
     def requestOffset(self, upload):
         """
         Returns the size of the temp file.
         """
         return os.stat(upload['tempFile']).st_size
 
+    def findBlob(self, sha512, size):
+        """
+        Files are stored by their checksum, so this only needs to check that
+        the content-addressed path exists and has the right size.
+        """
+        path = os.path.join(sha512[0:2], sha512[2:4], sha512)
+        abspath = os.path.join(self.assetstore['root'], path)
+        if os.path.isfile(abspath) and os.path.getsize(abspath) == size:
+            return {'sha512': sha512, 'path': path}
+        return None
+
     def finalizeUpload(self, upload, file):
         """
         Moves the file into its permanent content-addressed location within the
         assetstore. Directory hierarchy yields 256^2 buckets.
         """
-        hash = sha512_state.restoreHex(upload['sha512state']).hexdigest()
+        checksum = hash_state.resume(upload.get('hashState'))
+        if checksum.stale:
+            # The checksums were lost between chunks; hash the file once now
+            checksum = self.hashUpload(upload)
+        digests = checksum.hexdigests()
+        hash = digests['sha512']
         dir = os.path.join(hash[0:2], hash[2:4])
         absdir = os.path.join(self.assetstore['root'], dir)
 
@@ -193,60 +293,329 @@ class FilesystemAssetstoreAdapter(AbstractAssetstoreAdapter):
             os.rename(upload['tempFile'], abspath)
             os.chmod(abspath, stat.S_IRUSR | stat.S_IWUSR)
 
-        file['sha512'] = hash
+        file.update(digests)
         file['path'] = path
+        ModelImporter().model('blob').addReference(file)
 
         return file
 
-    def downloadFile(self, file, offset=0, headers=True):
+    def copyFile(self, srcFile, destFile):
+        """
+        Copies share the stored data, so only its reference count changes.
+        Imported data is not reference counted.
+        """
+        if not srcFile.get('imported'):
+            ModelImporter().model('blob').addReference(destFile)
+        return destFile
+
+    def downloadFile(self, file, offset=0, headers=True, endByte=None):
         """
         Returns a generator function that will be used to stream the file from
         disk to the response.
         """
+        if endByte is None or endByte > file['size']:
+            endByte = file['size']
+
         path = os.path.join(self.assetstore['root'], file['path'])
         if not os.path.isfile(path):
             raise Exception('File %s does not exist.' % path)
 
         if headers:
-            mimeType = file.get('mimeType', 'application/octet-stream')
-            if not mimeType:
-                mimeType = 'application/octet-stream'
-            cherrypy.response.headers['Content-Type'] = mimeType
-            cherrypy.response.headers['Content-Length'] = file['size'] - offset
-            cherrypy.response.headers['Content-Disposition'] = \
-                'attachment; filename="%s"' % file['name']
+            self.setContentHeaders(file, offset, endByte)
 
         def stream():
+            bytesRead = offset
             with open(path, 'rb') as f:
                 if offset > 0:
                     f.seek(offset)
 
-                while True:
-                    data = f.read(BUF_SIZE)
+                while bytesRead < endByte:
+                    data = f.read(min(BUF_SIZE, endByte - bytesRead))
                     if not data:
                         break
+                    bytesRead += len(data)
                     yield data
 
         return stream
 
+    def offloadDownload(self, file):
+        """
+        If the filesystem_mode option of the downloads config section is
+        "x-sendfile" or "x-accel-redirect", hand whole-file and byte range
+        downloads to the front-end web server, which sends the file from disk
+        without it passing through Girder.
+        """
+        downloadConfig = config.getConfig().get('downloads', {})
+        mode = downloadConfig.get('filesystem_mode', 'stream')
+        if mode not in OFFLOAD_HEADERS:
+            return False
+
+        path = os.path.abspath(
+            os.path.join(self.assetstore['root'], file['path']))
+        if not os.path.isfile(path):
+            raise Exception('File %s does not exist.' % path)
+
+        self.setContentHeaders(file, 0, file['size'])
+        # The front-end server sets the length of the body it sends
+        del cherrypy.response.headers['Content-Length']
+        if mode == 'x-accel-redirect':
+            path = downloadConfig.get(
+                'accel_redirect_prefix', '/girder-files') + urllib.quote(path)
+        cherrypy.response.headers[OFFLOAD_HEADERS[mode]] = path
+        return True
+
     def deleteFile(self, file):
         """
         Deletes the file from disk if it is the only File in this assetstore
-        with the given sha512.
+        with the given sha512. This is decided by the data's reference count;
+        the file collection is only queried for data that has no blob record.
+        Imported files are never deleted from disk.
+        """
+        if file.get('imported'):
+            return
+        unused = ModelImporter().model('blob').removeReference(file)
+        if unused is None:
+            q = {
+                'sha512': file['sha512'],
+                'assetstoreId': self.assetstore['_id'],
+                'imported': {'$exists': False}
+            }
+            matching = ModelImporter().model('file').find(
+                q, limit=2, fields=[])
+            unused = matching.count(True) == 1
+        if unused:
+            self._removePath(file)
+
+    def deleteData(self, file):
+        """
+        Deletes the file from disk along with the reference count of its data.
+        Imported files are never deleted from disk.
         """
-        q = {
+        if file.get('imported'):
+            return
+        ModelImporter().model('blob').removeWithQuery({
             'sha512': file['sha512'],
             'assetstoreId': self.assetstore['_id']
-        }
-        matching = ModelImporter().model('file').find(q, limit=2, fields=[])
-        if matching.count(True) == 1:
-            path = os.path.join(self.assetstore['root'], file['path'])
-            if os.path.isfile(path):
-                os.remove(path)
+        })
+        self._removePath(file)
+
+    def _removePath(self, file):
+        path = os.path.join(self.assetstore['root'], file['path'])
+        if os.path.isfile(path):
+            os.remove(path)
 
     def cancelUpload(self, upload):
         """
         Delete the temporary files associated with a given upload.
         """
+        hash_state.discard(upload.get('hashState'))
         if os.path.exists(upload['tempFile']):
             os.unlink(upload['tempFile'])
+
+    def importData(self, parent, parentType, params, progress, user):
+        """
+        Register the files under a directory on the server's disk in place,
+        without copying them into the assetstore. Each subdirectory becomes a
+        folder, and each file becomes an item holding one file that refers to
+        the file's absolute path. The items and files of each directory are
+        inserted in bulk, so model save events are not triggered for them.
+        Their checksums are computed afterward by asynchronous events.
+
+        Importing a directory again adds new files, and updates the files
+        whose size or modification time has changed; the rest are skipped.
+        Girder never deletes imported data from disk.
+
+        :param parent: The folder, user or collection to import into.
+        :type parent: dict
+        :param parentType: The type of the parent.
+        :type parentType: str ('folder', 'user' or 'collection')
+        :param params: The import parameters: importPath is the directory.
+        :type params: dict
+        :param progress: A progress context to record progress on.
+        :type progress: girder.utility.progress.ProgressContext
+        :param user: The user to record as the creator of new records.
+        :type user: dict
+        :returns: A dict with the numbers of folders and files created, and
+            of files that were updated or unchanged.
+        """
+        importPath = os.path.abspath(params['importPath'])
+        if not os.path.isdir(importPath):
+            raise ValidationException(
+                'No such directory: {}.'.format(importPath), 'importPath')
+
+        info = {'folders': 0, 'files': 0, 'updated': 0, 'unchanged': 0}
+        toHash = []
+        parents = {importPath: (parent, parentType)}
+        for dirpath, dirnames, filenames in os.walk(importPath):
+            folder, folderType = parents.pop(dirpath)
+            progress.update(message='Importing {}'.format(dirpath))
+            dirnames.sort()
+            for name in dirnames:
+                parents[os.path.join(dirpath, name)] = (self._importFolder(
+                    folder, folderType, name, user, info), 'folder')
+            if folderType != 'folder':
+                if filenames:
+                    logger.warning('Files directly under {} were not '
+                                   'imported, as it is imported into a '
+                                   '{}.'.format(dirpath, folderType))
+                continue
+            filenames.sort()
+            for start in xrange(0, len(filenames), IMPORT_BATCH_SIZE):
+                batch = filenames[start:start + IMPORT_BATCH_SIZE]
+                self._importFiles(folder, dirpath, batch, user, info, toHash)
+
+        for start in xrange(0, len(toHash), IMPORT_HASH_BATCH_SIZE):
+            events.daemon.trigger('_filesystem_import_hash', {
+                'fileIds': toHash[start:start + IMPORT_HASH_BATCH_SIZE]
+            })
+        return info
+
+    def _importFolder(self, parent, parentType, name, user, info):
+        """
+        Get the folder for an imported directory, creating it if needed.
+        """
+        folderModel = ModelImporter().model('folder')
+        folder = folderModel.findOne({
+            'parentId': parent['_id'],
+            'parentCollection': parentType,
+            'name': name
+        }, fields=['_id'])
+        if folder is not None:
+            return folderModel.load(folder['_id'], force=True)
+        info['folders'] += 1
+        return folderModel.createFolder(
+            parent, name, parentType=parentType, creator=user)
+
+    def _importFiles(self, folder, dirpath, filenames, user, info, toHash):
+        """
+        Register files of one directory, which are in the given folder.
+        """
+        fileModel = ModelImporter().model('file')
+        itemModel = ModelImporter().model('item')
+        folderModel = ModelImporter().model('folder')
+
+        taken = set(item['name'] for item in itemModel.find({
+            'folderId': folder['_id'],
+            'name': {'$in': filenames}
+        }, limit=0, fields=['name']))
+        taken.update(child['name'] for child in folderModel.find({
+            'parentId': folder['_id'],
+            'parentCollection': 'folder',
+            'name': {'$in': filenames}
+        }, limit=0, fields=['name']))
+        paths = [os.path.join(dirpath, name) for name in filenames]
+        existing = {file['path']: file for file in fileModel.find({
+            'assetstoreId': self.assetstore['_id'],
+            'path': {'$in': paths}
+        }, limit=0)}
+
+        now = datetime.datetime.utcnow()
+        items = []
+        files = []
+        for name, path in zip(filenames, paths):
+            try:
+                st = os.stat(path)
+            except OSError:
+                logger.warning('Could not import {}.'.format(path))
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                continue
+
+            file = existing.get(path)
+            if file is not None:
+                if (file['size'] == st.st_size and
+                        file.get('mtime') == st.st_mtime):
+                    info['unchanged'] += 1
+                    if 'sha512' not in file:
+                        toHash.append(file['_id'])
+                    continue
+                # The file was changed, so its checksums are out of date
+                fileModel.update({'_id': file['_id']}, {
+                    '$set': {'size': st.st_size, 'mtime': st.st_mtime},
+                    '$unset': {alg: True
+                               for alg in hash_state.uploadAlgorithms()}
+                }, multi=False)
+                item = itemModel.load(file['itemId'], force=True)
+                fileModel.propagateSizeChange(item, st.st_size - file['size'])
+                info['updated'] += 1
+                toHash.append(file['_id'])
+                continue
+
+            if name in taken:
+                # Let the item model pick a unique name
+                item = itemModel.createItem(name, user, folder)
+                fileModel.propagateSizeChange(item, st.st_size)
+            else:
+                item = {
+                    'name': name,
+                    'lowerName': name.lower(),
+                    'description': '',
+                    'folderId': folder['_id'],
+                    'ancestors': folder['ancestors'] + [folder['_id']],
+                    'creatorId': user['_id'],
+                    'baseParentType': folder['baseParentType'],
+                    'baseParentId': folder['baseParentId'],
+                    'created': now,
+                    'updated': now,
+                    'size': st.st_size
+                }
+                items.append(item)
+            files.append((item, fileModel.validate({
+                'created': now,
+                'creatorId': user['_id'],
+                'assetstoreId': self.assetstore['_id'],
+                'name': name,
+                'mimeType': (mimetypes.guess_type(name)[0] or
+                             'application/octet-stream'),
+                'size': st.st_size,
+                'path': path,
+                'imported': True,
+                'mtime': st.st_mtime
+            })))
+
+        if items:
+            itemModel.collection.insert(items)
+            fileModel.propagateSizeChange(
+                items[0], sum(item['size'] for item in items),
+                updateItemSize=False)
+        if files:
+            for item, file in files:
+                file['itemId'] = item['_id']
+            fileIds = fileModel.collection.insert(
+                [file for item, file in files])
+            toHash.extend(fileIds)
+            info['files'] += len(files)
+
+
+def _hashImportedFiles(event):
+    """
+    Compute the checksums of imported files. Files that have changed since
+    they were registered are left to be updated by the next import.
+    """
+    fileModel = ModelImporter().model('file')
+    for file in fileModel.find({
+            '_id': {'$in': event.info['fileIds']},
+            'imported': True}, limit=0):
+        try:
+            st = os.stat(file['path'])
+        except OSError:
+            logger.warning('Imported file {} is missing.'.format(file['path']))
+            continue
+        if st.st_size != file['size'] or st.st_mtime != file['mtime']:
+            continue
+        checksum = hash_state.ResumableHasher()
+        with open(file['path'], 'rb') as f:
+            while True:
+                data = f.read(ingest.BLOCK_SIZE)
+                if not data:
+                    break
+                checksum.update(data)
+        fileModel.update({
+            '_id': file['_id'],
+            'size': file['size'],
+            'mtime': file['mtime']
+        }, {'$set': checksum.hexdigests()}, multi=False)
+
+
+events.bind('_filesystem_import_hash', '_filesystem_import_hash',
+            _hashImportedFiles)
@@ -18,7 +18,6 @@
 ###############################################################################
 
 import bson
-import cherrypy
 import pymongo
 import uuid
 
@@ -28,8 +27,7 @@ from girder import logger
 from girder.models import getDbConnection
 from girder.models.model_base import ValidationException
 
-from hashlib import sha512
-from . import sha512_state
+from . import hash_state, ingest
 from .abstract_assetstore_adapter import AbstractAssetstoreAdapter
 
 
@@ -89,37 +87,50 @@ class GridFsAssetstoreAdapter(AbstractAssetstoreAdapter):
         Creates a UUID that will be used to uniquely link each chunk to
         """
         upload['chunkUuid'] = uuid.uuid4().hex
-        upload['sha512state'] = sha512_state.serializeHex(sha512())
+        upload['hashState'] = hash_state.save(hash_state.ResumableHasher())
         return upload
 
+    def _readChunks(self, upload, offset=0):
+        """
+        Yields the stored data of an upload from the given offset.
+        """
+        cursor = self.chunkColl.find({
+            'uuid': upload['chunkUuid']
+        }, fields=['data']).sort('n', pymongo.ASCENDING)
+        position = 0
+        for chunk in cursor:
+            data = chunk['data']
+            if position + len(data) > offset:
+                yield data[max(offset - position, 0):]
+            position += len(data)
+
     def uploadChunk(self, upload, chunk):
         """
         Stores the uploaded chunk in fixed-sized pieces in the chunks
         collection of this assetstore's database.
         """
         # If we know the chunk size is too large or small, fail early.
-        self.checkUploadSize(upload, self.getChunkSize(chunk))
+        chunkSize = self.getChunkSize(chunk)
+        self.checkUploadSize(upload, chunkSize)
 
         if isinstance(chunk, basestring):
             if isinstance(chunk, unicode):
                 chunk = chunk.encode('utf8')
             chunk = StringIO(chunk)
 
-        # Restore the internal state of the streaming SHA-512 checksum
-        checksum = sha512_state.restoreHex(upload['sha512state'])
+        # Resume the streaming checksums. If they were lost, the chunk is
+        # stored without hashing and the checksums are computed on finalize.
+        checksum = hash_state.resume(upload.get('hashState'))
 
         # This bit of code will only do anything if there is a discrepancy
         # between the received count of the upload record and the length of
         # the file stored as chunks in the database. This code simply updates
-        # the sha512 state with the difference before reading the bytes sent
+        # the checksums with the difference before reading the bytes sent
         # from the user.
-        if self.requestOffset(upload) > upload['received']:
-            cursor = self.chunkColl.find({
-                'uuid': upload['chunkUuid'],
-                'n': {'$gte': upload['received'] // CHUNK_SIZE}
-            }, fields=['data']).sort('n', pymongo.ASCENDING)
-            for result in cursor:
-                checksum.update(result['data'])
+        if (not checksum.stale and
+                self.requestOffset(upload) > checksum.offset):
+            for data in self._readChunks(upload, checksum.offset):
+                checksum.update(data)
 
         cursor = self.chunkColl.find({
             'uuid': upload['chunkUuid']
@@ -132,27 +143,31 @@ class GridFsAssetstoreAdapter(AbstractAssetstoreAdapter):
         size = 0
         startingN = n
 
-        while not upload['received']+size > upload['size']:
-            data = chunk.read(CHUNK_SIZE)
-            if not data:
-                break
-            # If a timeout occurs while we are trying to load data, we might
-            # have succeeded, in which case we will get a DuplicateKeyError
-            # when it automatically retries.  Therefore, log this error but
-            # don't stop.
-            try:
-                self.chunkColl.insert({
-                    'n': n,
-                    'uuid': upload['chunkUuid'],
-                    'data': bson.binary.Binary(data)
-                })
-            except pymongo.errors.DuplicateKeyError:
-                logger.info('Received a DuplicateKeyError while uploading, '
-                            'probably because we reconnected to the database '
-                            '(chunk uuid %s part %d)', upload['chunkUuid'], n)
-            n += 1
-            size += len(data)
-            checksum.update(data)
+        # Each piece is hashed on another thread while it is inserted and the
+        # next piece is read.
+        with ingest.HashPipeline(checksum, chunkSize) as pipeline:
+            while not upload['received']+size > upload['size']:
+                data = chunk.read(CHUNK_SIZE)
+                if not data:
+                    break
+                pipeline.put(data)
+                # If a timeout occurs while we are trying to load data, we
+                # might have succeeded, in which case we will get a
+                # DuplicateKeyError when it automatically retries.  Therefore,
+                # log this error but don't stop.
+                try:
+                    self.chunkColl.insert({
+                        'n': n,
+                        'uuid': upload['chunkUuid'],
+                        'data': bson.binary.Binary(data)
+                    })
+                except pymongo.errors.DuplicateKeyError:
+                    logger.info('Received a DuplicateKeyError while '
+                                'uploading, probably because we reconnected '
+                                'to the database (chunk uuid %s part %d)',
+                                upload['chunkUuid'], n)
+                n += 1
+                size += len(data)
         chunk.close()
 
         try:
@@ -164,11 +179,89 @@ class GridFsAssetstoreAdapter(AbstractAssetstoreAdapter):
                                    'n': {'$gte': startingN}}, multi=True)
             raise
 
-        # Persist the internal state of the checksum
-        upload['sha512state'] = sha512_state.serializeHex(checksum)
+        # Keep the checksums for the next chunk
+        upload['hashState'] = hash_state.save(checksum)
         upload['received'] += size
+        return ingest.recordStats(upload, pipeline)
+
+    def initParallelUpload(self, upload):
+        """
+        Chunks are stored independently, so nothing needs to be prepared.
+        """
         return upload
 
+    def uploadChunkAt(self, upload, chunk, offset):
+        """
+        Stores the chunk as the fixed-sized pieces that start at its offset.
+        The offset must be a multiple of the piece size, as must the length of
+        every chunk except the one that ends the file. Pieces are upserted, so
+        a chunk that is sent again replaces the earlier copy.
+        """
+        if offset % CHUNK_SIZE:
+            raise ValidationException(
+                'Chunk offsets must be a multiple of %d bytes.' % CHUNK_SIZE)
+        self.checkChunkRange(upload, offset, self.getChunkSize(chunk))
+
+        if isinstance(chunk, basestring):
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode('utf8')
+            chunk = StringIO(chunk)
+
+        n = offset // CHUNK_SIZE
+        size = 0
+        try:
+            while True:
+                data = chunk.read(CHUNK_SIZE)
+                if not data:
+                    break
+                end = offset + size + len(data)
+                if end > upload['size']:
+                    raise ValidationException('Received too many bytes.')
+                if len(data) < CHUNK_SIZE and end != upload['size']:
+                    raise ValidationException(
+                        'Chunk lengths must be a multiple of %d bytes, except '
+                        'for the end of the file.' % CHUNK_SIZE)
+                self.chunkColl.update({
+                    'uuid': upload['chunkUuid'],
+                    'n': n
+                }, {
+                    '$set': {'data': bson.binary.Binary(data)}
+                }, upsert=True)
+                n += 1
+                size += len(data)
+        finally:
+            chunk.close()
+
+        self.checkChunkRange(upload, offset, size)
+        return size
+
+    def cancelChunkAt(self, upload, offset, size):
+        """
+        Removes the pieces of the chunk, unless a file was finalized from the
+        upload and now owns them.
+        """
+        q = {
+            'chunkUuid': upload['chunkUuid'],
+            'assetstoreId': self.assetstore['_id']
+        }
+        if ModelImporter().model('file').findOne(q, fields=[]) is None:
+            self.chunkColl.remove({
+                'uuid': upload['chunkUuid'],
+                'n': {
+                    '$gte': offset // CHUNK_SIZE,
+                    '$lt': (offset + size + CHUNK_SIZE - 1) // CHUNK_SIZE
+                }
+            })
+
+    def hashUpload(self, upload):
+        """
+        Computes the checksums of the stored pieces in order.
+        """
+        checksum = hash_state.ResumableHasher()
+        for data in self._readChunks(upload):
+            checksum.update(data)
+        return checksum
+
     def requestOffset(self, upload):
         """
         The offset will be the CHUNK_SIZE * total number of chunks in the
@@ -186,35 +279,54 @@ class GridFsAssetstoreAdapter(AbstractAssetstoreAdapter):
 
         return max(offset, upload['received'])
 
+    def findBlob(self, sha512, size):
+        """
+        Finds a file in this assetstore with the checksum and size whose chunks
+        are still present. The new file shares its chunks, as copies do.
+        """
+        existing = ModelImporter().model('file').findOne({
+            'assetstoreId': self.assetstore['_id'],
+            'sha512': sha512,
+            'size': size,
+            'chunkUuid': {'$exists': True}
+        }, fields=['chunkUuid', 'chunkSize'])
+        if existing is None or self.chunkColl.find_one(
+                {'uuid': existing['chunkUuid']}, fields=[]) is None:
+            return None
+        return {
+            'sha512': sha512,
+            'chunkUuid': existing['chunkUuid'],
+            'chunkSize': existing.get('chunkSize', CHUNK_SIZE)
+        }
+
     def finalizeUpload(self, upload, file):
         """
         Grab the final state of the checksum and set it on the file object,
         and write the generated UUID into the file itself.
         """
-        hash = sha512_state.restoreHex(upload['sha512state']).hexdigest()
-
-        file['sha512'] = hash
+        checksum = hash_state.resume(upload.get('hashState'))
+        if checksum.stale:
+            # The checksums were lost between chunks; hash the data once now
+            checksum = self.hashUpload(upload)
+        file.update(checksum.hexdigests())
         file['chunkUuid'] = upload['chunkUuid']
         file['chunkSize'] = CHUNK_SIZE
 
         return file
 
-    def downloadFile(self, file, offset=0, headers=True):
+    def downloadFile(self, file, offset=0, headers=True, endByte=None):
         """
         Returns a generator function that will be used to stream the file from
         the database to the response.
         """
+        if endByte is None or endByte > file['size']:
+            endByte = file['size']
+
         if headers:
-            mimeType = file.get('mimeType', 'application/octet-stream')
-            if not mimeType:
-                mimeType = 'application/octet-stream'
-            cherrypy.response.headers['Content-Type'] = mimeType
-            cherrypy.response.headers['Content-Length'] = file['size'] - offset
-            cherrypy.response.headers['Content-Disposition'] = \
-                'attachment; filename="%s"' % file['name']
+            self.setContentHeaders(file, offset, endByte)
 
         # If the file is empty, we stop here
-        if file['size'] - offset <= 0:
+        if endByte - offset <= 0:
             return lambda: ''
 
         n = 0
@@ -232,12 +344,16 @@ class GridFsAssetstoreAdapter(AbstractAssetstoreAdapter):
 
         def stream():
             co = chunkOffset  # Can't assign to outer scope without "nonlocal"
+            position = offset
             for chunk in cursor:
-                if co > 0:
-                    yield chunk['data'][co:]
-                    co = 0
-                else:
-                    yield chunk['data']
+                data = chunk['data'][co:co + endByte - position]
+                co = 0
+                position += len(data)
+                yield data
+                # Stop once the end of the requested range has been sent
+                if position >= endByte:
+                    break
+            cursor.close()
 
         return stream
 
@@ -252,15 +368,22 @@ class GridFsAssetstoreAdapter(AbstractAssetstoreAdapter):
         }
         matching = ModelImporter().model('file').find(q, limit=2, fields=[])
         if matching.count(True) == 1:
-            try:
-                self.chunkColl.remove({'uuid': file['chunkUuid']})
-            except pymongo.errors.AutoReconnect:
-                # we can't reach the database.  Go ahead and return; a system
-                # check will be necessary to remove the abandoned file
-                pass
+            self.deleteData(file)
+
+    def deleteData(self, file):
+        """
+        Delete all of the chunks of the file.
+        """
+        try:
+            self.chunkColl.remove({'uuid': file['chunkUuid']})
+        except pymongo.errors.AutoReconnect:
+            # we can't reach the database.  Go ahead and return; a system
+            # check will be necessary to remove the abandoned file
+            pass
 
     def cancelUpload(self, upload):
         """
         Delete all of the chunks associated with a given upload.
         """
+        hash_state.discard(upload.get('hashState'))
         self.chunkColl.remove({'uuid': upload['chunkUuid']})
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+"""
+Resumable checksums for chunked uploads. The checksums of an upload are
+computed as its chunks arrive, but each chunk is a separate request, so the
+hash state has to be carried from one request to the next.
+
+The hash objects themselves are kept in memory between chunks, and the upload
+document only records a small state dict naming the algorithms, the number of
+bytes hashed and a key for the in-memory objects. Resuming in the process
+that handled the previous chunk takes constant time. If that process is gone,
+for instance after a restart or when chunks are spread over several servers,
+the state is marked stale: later chunks are stored without being hashed, and
+the checksums are computed once from the stored data when the upload is
+finalized. The state never depends on interpreter internals.
+"""
+
+import collections
+import hashlib
+import threading
+import uuid
+import zlib
+
+from girder.utility import config
+
+# Hash states kept in memory; the least recently saved are dropped first
+MAX_LIVE = 1000
+
+_live = collections.OrderedDict()
+_liveLock = threading.Lock()
+
+
+def uploadAlgorithms():
+    """
+    Get the algorithms computed for uploads: sha512, which content addressed
+    assetstores depend on, and crc32, which zip archives record for each file,
+    plus any configured in the "extra_hashes" value of the "uploads" config
+    section.
+
+    :returns: A list of algorithm names.
+    """
+    extra = config.getConfig().get('uploads', {}).get('extra_hashes') or []
+    return ['sha512', 'crc32'] + [alg for alg in extra
+                                  if alg not in ('sha512', 'crc32')]
+
+
+class Crc32(object):
+    """
+    The CRC-32 checksum used by zip archives, with the interface of a hashlib
+    object. Its hex digest is the unsigned value as eight hex digits.
+    """
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def hexdigest(self):
+        return '%08x' % (self.value & 0xffffffff)
+
+
+def newHash(algorithm):
+    """
+    Create a hash object for an algorithm name: crc32, or any hashlib name.
+    """
+    if algorithm == 'crc32':
+        return Crc32()
+    return hashlib.new(algorithm)
+
+
+class ResumableHasher(object):
+    """
+    Computes several digests in a single pass over the data.
+
+    :param algorithms: The algorithm names to compute.
+    :type algorithms: list
+    """
+    stale = False
+
+    def __init__(self, algorithms=None):
+        if algorithms is None:
+            algorithms = uploadAlgorithms()
+        self.algorithms = list(algorithms)
+        self.hashes = [newHash(alg) for alg in self.algorithms]
+        self.offset = 0
+
+    def update(self, data):
+        for h in self.hashes:
+            h.update(data)
+        self.offset += len(data)
+
+    def hexdigests(self):
+        """
+        :returns: A dict of the hex digest for each algorithm.
+        """
+        return {alg: h.hexdigest()
+                for alg, h in zip(self.algorithms, self.hashes)}
+
+
+class StaleHasher(object):
+    """
+    Stands in for a hasher that was lost between chunks. It only counts the
+    bytes passed to it; the caller must compute the digests from the stored
+    data once the upload is complete.
+    """
+    stale = True
+
+    def __init__(self, algorithms=None, offset=0):
+        if algorithms is None:
+            algorithms = uploadAlgorithms()
+        self.algorithms = list(algorithms)
+        self.offset = offset
+
+    def update(self, data):
+        self.offset += len(data)
+
+
+def save(hasher):
+    """
+    Keep a hasher in memory so that it can be resumed by a later chunk.
+
+    :param hasher: The hasher to save.
+    :type hasher: ResumableHasher or StaleHasher
+    :returns: The state dict to store in the upload document.
+    """
+    if hasher.stale:
+        return {
+            'algorithms': hasher.algorithms,
+            'offset': hasher.offset,
+            'stale': True
+        }
+
+    key = uuid.uuid4().hex
+    with _liveLock:
+        _live[key] = hasher
+        while len(_live) > MAX_LIVE:
+            _live.popitem(last=False)
+    return {
+        'algorithms': hasher.algorithms,
+        'offset': hasher.offset,
+        'key': key
+    }
+
+
+def resume(state):
+    """
+    Get the hasher for a state created by save(). The hasher is removed from
+    memory, so if the caller fails before saving it again, the state becomes
+    stale rather than using a hasher that may have been partially updated.
+
+    :param state: The state dict, or None if the upload has no state, as is
+        the case for uploads begun before this module existed.
+    :type state: dict
+    :returns: A ResumableHasher, or a StaleHasher if the state is stale or
+        its hasher is no longer in memory. In the latter case the caller need
+        not hash any more data, and must compute the checksums from the whole
+        of the stored data instead of calling hexdigests().
+    """
+    if state is None:
+        return StaleHasher()
+    if not state.get('stale'):
+        with _liveLock:
+            hasher = _live.pop(state.get('key'), None)
+        if hasher is not None and hasher.offset == state['offset']:
+            return hasher
+    return StaleHasher(state['algorithms'], state['offset'])
+
+
+def discard(state):
+    """
+    Drop the hasher for a state, if it is in memory. Call this when an upload
+    is cancelled.
+    """
+    if state is not None:
+        with _liveLock:
+            _live.pop(state.get('key'), None)
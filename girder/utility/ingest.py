@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+"""
+Pipelined ingestion of upload chunks. While the request thread reads a block
+of a chunk and stores it, the checksums of the previous blocks are computed on
+a worker thread. hashlib releases the GIL while hashing large buffers, so the
+two overlap. Blocks are handed over through a bounded queue, which limits the
+memory used per upload and makes the reader wait if hashing falls behind.
+"""
+
+import Queue
+import threading
+import time
+
+# Size of the blocks read from a chunk and handed to the hashing thread
+BLOCK_SIZE = 1024 * 1024
+# Maximum number of blocks waiting to be hashed
+DEPTH = 4
+# Chunks smaller than this are hashed on the request thread, as starting a
+# thread would cost more than it saves.
+MIN_PIPELINE_SIZE = 4 * 1024 * 1024
+
+
+class HashPipeline(object):
+    """
+    Hashes the blocks passed to ``put`` on a worker thread. Use this as a
+    context manager around the loop that reads and stores a chunk; on exit,
+    the worker has hashed every block and the hasher may be used again.
+
+    :param hasher: The object to hash with; anything with an update method,
+        usually a girder.utility.hash_state.ResumableHasher.
+    :param chunkSize: The size of the chunk, if known. Small chunks are hashed
+        inline.
+    :type chunkSize: int or None
+    :param depth: The maximum number of blocks waiting to be hashed.
+    :type depth: int
+    """
+    def __init__(self, hasher, chunkSize=None, depth=DEPTH):
+        self.hasher = hasher
+        self.threaded = chunkSize is None or chunkSize >= MIN_PIPELINE_SIZE
+        self.bytes = 0
+        self.hashWait = 0.0
+        self.seconds = 0.0
+        self._error = None
+        self._queue = Queue.Queue(maxsize=depth)
+        self._thread = None
+
+    def __enter__(self):
+        self._start = time.time()
+        if self.threaded:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if self._thread is not None:
+            start = time.time()
+            self._queue.put(None)
+            self._thread.join()
+            self.hashWait += time.time() - start
+        self.seconds = time.time() - self._start
+        if self._error is not None and type is None:
+            raise self._error
+
+    def put(self, data):
+        """
+        Queue a block to be hashed. This blocks if the worker is behind.
+        """
+        self.bytes += len(data)
+        if self._thread is None:
+            self.hasher.update(data)
+        else:
+            start = time.time()
+            self._queue.put(data)
+            self.hashWait += time.time() - start
+
+    def _run(self):
+        while True:
+            data = self._queue.get()
+            if data is None:
+                return
+            if self._error is None:
+                try:
+                    self.hasher.update(data)
+                except Exception as exc:
+                    # Keep draining so the reader isn't left blocked
+                    self._error = exc
+
+    def stats(self):
+        """
+        :returns: A dict with the bytes ingested, the total seconds, and the
+            seconds spent waiting for the hashing thread.
+        """
+        return {
+            'bytes': self.bytes,
+            'seconds': self.seconds,
+            'hashWaitSeconds': self.hashWait
+        }
+
+
+def recordStats(upload, pipeline):
+    """
+    Add the statistics of a pipeline to the running totals kept in the
+    ``ingest`` field of an upload, along with its overall throughput.
+
+    :param upload: The upload document.
+    :type upload: dict
+    :param pipeline: The pipeline that ingested a chunk of the upload.
+    :type pipeline: HashPipeline
+    """
+    totals = upload.setdefault('ingest', {
+        'chunks': 0, 'bytes': 0, 'seconds': 0.0, 'hashWaitSeconds': 0.0})
+    totals['chunks'] += 1
+    for key, value in pipeline.stats().iteritems():
+        totals[key] += value
+    if totals['seconds'] > 0:
+        totals['bytesPerSecond'] = totals['bytes'] / totals['seconds']
+    return upload
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+"""
+This module contains the in-process notification broker. Rather than having
+every open notification stream poll the database, streams subscribe to the
+broker and block on a queue. Notifications saved by this process are
+published to subscribers immediately; a single watcher thread polls the
+notification collection on behalf of all subscribers so that notifications
+written by other processes are delivered as well.
+"""
+
+import collections
+import copy
+import datetime
+import Queue
+import threading
+
+from girder import logger
+from girder.utility.model_importer import ModelImporter
+
+# How often the watcher polls the notification collection, in seconds
+POLL_INTERVAL = 0.5
+# Records updated this long before the newest one seen are re-read on each
+# poll, to tolerate clock skew between processes writing notifications.
+POLL_OVERLAP = datetime.timedelta(seconds=5)
+
+
+def _subscriptionKey(user=None, token=None, doc=None):
+    if doc is not None:
+        if 'userId' in doc:
+            return ('user', doc['userId'])
+        return ('token', doc.get('tokenId'))
+    if user:
+        return ('user', user['_id'])
+    return ('token', token['_id'])
+
+
+class Subscription(object):
+    """
+    A handle on the notifications for one user or token. Notifications are
+    placed on ``queue`` as they are published; use ``get`` to wait for them.
+    """
+    def __init__(self, broker, key):
+        self.broker = broker
+        self.key = key
+        self.queue = Queue.Queue()
+
+    def get(self, timeout):
+        """
+        Wait for the next notification.
+
+        :param timeout: The maximum number of seconds to wait.
+        :type timeout: float
+        :returns: The notification document, or None if the timeout elapsed.
+        """
+        try:
+            return self.queue.get(timeout=timeout)
+        except Queue.Empty:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class NotificationBroker(ModelImporter):
+    """
+    Fans notification records out to the subscribers of the user or token
+    they belong to. The watcher thread is started when the first subscriber
+    arrives and exits once there are none left, so an idle server does not
+    query the database at all.
+    """
+    def __init__(self, interval=POLL_INTERVAL):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._subscribers = collections.defaultdict(set)
+        self._seen = {}
+        self._lastUpdate = None
+        self._thread = None
+        self._stopEvent = threading.Event()
+
+    def subscribe(self, user=None, token=None):
+        """
+        Subscribe to the notifications of a user or, if user is None, of a
+        session token.
+
+        :returns: a Subscription, which should be closed when done.
+        """
+        sub = Subscription(self, _subscriptionKey(user, token))
+        with self._lock:
+            self._subscribers[sub.key].add(sub)
+            if self._thread is None or not self._thread.is_alive():
+                if self._lastUpdate is None:
+                    self._lastUpdate = datetime.datetime.utcnow()
+                self._stopEvent.clear()
+                self._thread = threading.Thread(target=self._watch)
+                self._thread.daemon = True
+                self._thread.start()
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            subs = self._subscribers.get(sub.key)
+            if subs is not None:
+                subs.discard(sub)
+                if not subs:
+                    del self._subscribers[sub.key]
+
+    def publish(self, doc):
+        """
+        Deliver a notification record to any subscribers for its user or
+        token. Records that have already been delivered at the same or a
+        later ``updated`` time are ignored.
+
+        :param doc: The notification document.
+        :type doc: dict
+        """
+        with self._lock:
+            subs = self._subscribers.get(_subscriptionKey(doc=doc))
+            if not subs:
+                return
+            seen = self._seen.get(doc['_id'])
+            if seen is not None and seen >= doc['updated']:
+                return
+            self._seen[doc['_id']] = doc['updated']
+            if self._lastUpdate is None or doc['updated'] > self._lastUpdate:
+                self._lastUpdate = doc['updated']
+            subs = list(subs)
+        # The saved record may continue to be modified in place by its owner
+        doc = copy.deepcopy(doc)
+        for sub in subs:
+            sub.queue.put(doc)
+
+    def stop(self):
+        """
+        Stop the watcher thread. It is restarted by the next subscription.
+        """
+        self._stopEvent.set()
+        thread = self._thread
+        if thread is not None and thread.is_alive():
+            thread.join(self.interval * 4)
+
+    def _watch(self):
+        while not self._stopEvent.wait(self.interval):
+            with self._lock:
+                keys = self._subscribers.keys()
+                if not keys:
+                    self._thread = None
+                    return
+                since = self._lastUpdate
+            try:
+                self._poll(keys, since)
+            except Exception:
+                logger.exception('Error polling for notifications')
+
+    def _poll(self, keys, since):
+        query = {'$or': [
+            {'userId': {'$in': [k[1] for k in keys if k[0] == 'user']}},
+            {'tokenId': {'$in': [k[1] for k in keys if k[0] == 'token']}}
+        ]}
+        if since is not None:
+            query['updated'] = {'$gt': since - POLL_OVERLAP}
+        for doc in self.model('notification').find(
+                query, limit=0, sort=[('updated', 1)]):
+            self.publish(doc)
+
+        with self._lock:
+            if self._lastUpdate is not None:
+                horizon = self._lastUpdate - POLL_OVERLAP * 2
+                self._seen = {k: v for k, v in self._seen.iteritems()
+                              if v >= horizon}
+
+
+broker = NotificationBroker()
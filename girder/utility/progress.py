@@ -18,7 +18,9 @@
 ###############################################################################
 
 import cherrypy
+import copy
 import datetime
+import threading
 import time
 
 from .model_importer import ModelImporter
@@ -32,6 +34,12 @@ class ProgressContext(ModelImporter):
     This class is a context manager that can be used to update progress in a way
     that rate-limits writes to the database and guarantees a flush when the
     context is exited.
+
+    Updates are applied to an in-memory copy of the progress record. At most
+    one write is made per interval; an update arriving sooner is held and
+    written behind by a timer once the interval has elapsed, so the latest
+    state always reaches the database. Writes set only the fields that a
+    progress update can change rather than saving the whole record.
     """
     def __init__(self, on, interval=0.5, **kwargs):
         """
@@ -49,6 +57,10 @@ class ProgressContext(ModelImporter):
 
         if on:
             self._lastSave = time.time()
+            self._lock = threading.Lock()
+            self._flushLock = threading.Lock()
+            self._timer = None
+            self._dirty = False
             self.progress = self.model('notification').initProgress(**kwargs)
 
     def __enter__(self):
@@ -72,17 +84,23 @@ class ProgressContext(ModelImporter):
             if isinstance(excValue, (ValidationException, RestException)):
                 message = 'Error: '+excValue.message
 
-        self.model('notification').updateProgress(
-            self.progress, state=state, message=message,
-            expires=datetime.datetime.utcnow() + datetime.timedelta(seconds=30)
-        )
+        with self._lock:
+            self._cancelTimer()
+            self.model('notification').updateProgress(
+                self.progress, save=False, state=state, message=message,
+                expires=datetime.datetime.utcnow() +
+                datetime.timedelta(seconds=30))
+            self._dirty = True
+        self.flush()
 
     def update(self, force=False, **kwargs):
         """
-        Update the underlying progress record. This will only actually save
-        to the database if at least self.interval seconds have passed since
-        the last time the record was written to the database. Accepts the
-        same kwargs as Notification.updateProgress.
+        Update the underlying progress record. This will only write to the
+        database immediately if at least self.interval seconds have passed
+        since the last time the record was written; otherwise the write is
+        deferred until the interval has elapsed, and coalesced with any other
+        updates made in the meantime. Accepts the same kwargs as
+        Notification.updateProgress.
 
         :param force: Whether we should force the write to the database.
         Use only in cases where progress may be indeterminate for a long time.
@@ -92,12 +110,40 @@ class ProgressContext(ModelImporter):
         setResponseTimeLimit()
         if not self.on:
             return
-        save = (time.time() - self._lastSave > self.interval) or force
-        self.progress = self.model('notification').updateProgress(
-            self.progress, save, **kwargs)
-
-        if save:
-            self._lastSave = time.time()
+        with self._lock:
+            self.progress = self.model('notification').updateProgress(
+                self.progress, False, **kwargs)
+            self._dirty = True
+            wait = self.interval - (time.time() - self._lastSave)
+            if not force and wait > 0:
+                if self._timer is None:
+                    self._timer = threading.Timer(wait, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+            self._cancelTimer()
+        self.flush()
+
+    def flush(self):
+        """
+        Write any pending progress update to the database.
+        """
+        if not self.on:
+            return
+        with self._flushLock:
+            with self._lock:
+                self._timer = None
+                if not self._dirty:
+                    return
+                record = copy.deepcopy(self.progress)
+                self._dirty = False
+                self._lastSave = time.time()
+            self.model('notification').flushProgress(record)
+
+    def _cancelTimer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
 
 
 noProgress = ProgressContext(False)
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+"""
+Helpers for serving HTTP byte range and conditional requests (RFC 7232 and
+RFC 7233) for downloads.
+"""
+
+import calendar
+import cherrypy
+import email.utils
+import uuid
+
+from girder.api.rest import RestException
+
+# A Range header with more ranges than this is ignored, and the whole entity
+# is sent instead.
+MAX_RANGES = 16
+
+
+def parseRangeHeader(header, size):
+    """
+    Parse the value of a Range header.
+
+    :param header: The value of the Range header.
+    :type header: str
+    :param size: The size of the entity in bytes.
+    :type size: int
+    :returns: None if the header is not a valid bytes range specifier or
+        lists more than MAX_RANGES ranges, and should be ignored. Otherwise,
+        the list of satisfiable ranges as (start, end) tuples, where end is
+        exclusive, in ascending order with overlapping and adjacent ranges
+        merged. This list is empty if none of the ranges can be satisfied.
+    """
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not spec.strip():
+        return None
+    parts = spec.split(',')
+    if len(parts) > MAX_RANGES:
+        return None
+
+    ranges = []
+    for part in parts:
+        first, sep, last = [p.strip() for p in part.partition('-')]
+        if not sep or not (first or last):
+            return None
+        try:
+            first = int(first) if first else None
+            last = int(last) if last else None
+        except ValueError:
+            return None
+
+        if first is None:
+            # A suffix range: the final "last" bytes of the entity
+            if last > 0 and size > 0:
+                ranges.append((max(0, size - last), size))
+        elif last is not None and last < first:
+            return None
+        elif first < size:
+            ranges.append((first, size if last is None else min(
+                last + 1, size)))
+
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def httpDate(value):
+    """
+    Format a UTC datetime as an HTTP date.
+    """
+    return email.utils.formatdate(_timestamp(value), usegmt=True)
+
+
+def _timestamp(value):
+    return calendar.timegm(value.utctimetuple())
+
+
+def _parseHttpDate(value):
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    return email.utils.mktime_tz(parsed)
+
+
+def _etagMatches(header, etag):
+    if etag is None:
+        return False
+    tags = [t.strip() for t in header.split(',')]
+    return '*' in tags or etag in tags or 'W/' + etag in tags
+
+
+def setValidators(etag, lastModified):
+    """
+    Set the ETag, Last-Modified and Accept-Ranges headers on the response.
+
+    :param etag: The entity tag, including quotes, or None.
+    :param lastModified: The modification time as a UTC datetime, or None.
+    """
+    headers = cherrypy.response.headers
+    headers['Accept-Ranges'] = 'bytes'
+    if etag is not None:
+        headers['ETag'] = etag
+    if lastModified is not None:
+        headers['Last-Modified'] = httpDate(lastModified)
+
+
+def notModified(etag, lastModified):
+    """
+    Evaluate If-None-Match and If-Modified-Since against the entity's
+    validators. If the client's copy is current, the response status is set
+    to 304 and True is returned; the caller should send no body.
+    """
+    request = cherrypy.request.headers
+    if 'If-None-Match' in request:
+        isCurrent = _etagMatches(request['If-None-Match'], etag)
+    elif 'If-Modified-Since' in request and lastModified is not None:
+        since = _parseHttpDate(request['If-Modified-Since'])
+        isCurrent = since is not None and _timestamp(lastModified) <= since
+    else:
+        isCurrent = False
+
+    if isCurrent:
+        cherrypy.response.status = 304
+    return isCurrent
+
+
+def requestedRanges(size, etag, lastModified):
+    """
+    Get the byte ranges requested by the Range header, taking If-Range into
+    account. If the requested ranges cannot be satisfied, a 416 error is
+    raised.
+
+    :param size: The size of the entity in bytes.
+    :type size: int
+    :returns: A list of (start, end) tuples, or None to send the whole entity.
+    """
+    request = cherrypy.request.headers
+    if 'Range' not in request:
+        return None
+
+    if 'If-Range' in request:
+        ifRange = request['If-Range'].strip()
+        if ifRange.startswith('"') or ifRange.startswith('W/'):
+            # Weak tags never match for If-Range
+            if etag is None or ifRange != etag:
+                return None
+        elif lastModified is None or ifRange != httpDate(lastModified):
+            return None
+
+    ranges = parseRangeHeader(request['Range'], size)
+    if ranges is None:
+        return None
+    if not ranges:
+        cherrypy.response.headers['Content-Range'] = 'bytes */%d' % size
+        raise RestException('Requested range not satisfiable.', code=416)
+    if len(ranges) == 1 and ranges[0] == (0, size):
+        return None
+    return ranges
+
+
+def setPartialContent(start, end, size):
+    """
+    Mark the response as partial content covering a single byte range.
+    """
+    cherrypy.response.status = 206
+    cherrypy.response.headers['Content-Range'] = 'bytes %d-%d/%d' % (
+        start, end - 1, size)
+    cherrypy.response.headers['Content-Length'] = end - start
+
+
+def multipartRanges(ranges, size, contentType, partStream):
+    """
+    Build a multipart/byteranges response for several byte ranges. This sets
+    the response status and headers.
+
+    :param ranges: The list of (start, end) ranges to send.
+    :param size: The size of the entity in bytes.
+    :param contentType: The content type of the entity.
+    :param partStream: A function taking (start, end) and returning a
+        generator function that yields that range of the entity.
+    :returns: A generator function yielding the response body.
+    """
+    boundary = uuid.uuid4().hex
+    partHeaders = [
+        '--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n' %
+        (boundary, contentType, start, end - 1, size)
+        for start, end in ranges]
+    trailer = '--%s--\r\n' % boundary
+
+    cherrypy.response.status = 206
+    cherrypy.response.headers['Content-Type'] = \
+        'multipart/byteranges; boundary=%s' % boundary
+    cherrypy.response.headers['Content-Length'] = sum(
+        len(header) + end - start + 2
+        for header, (start, end) in zip(partHeaders, ranges)) + len(trailer)
+    cherrypy.response.headers.pop('Content-Range', None)
+
+    def stream():
+        for header, (start, end) in zip(partHeaders, ranges):
+            yield header
+            for data in partStream(start, end)():
+                yield data
+            yield '\r\n'
+        yield trailer
+    return stream
+
+
+def sendEntity(size, etag, lastModified, contentType, partStream):
+    """
+    Serve an entity whose length is known and any of whose byte ranges can
+    be generated, honoring conditional and range requests. This sets the
+    response status and headers, including Content-Length.
+
+    :param size: The size of the entity in bytes.
+    :type size: int
+    :param etag: The entity tag, including quotes, or None.
+    :param lastModified: The modification time as a UTC datetime, or None.
+    :param contentType: The content type of the entity.
+    :param partStream: A function taking (start, end) and returning a
+        generator function that yields that range of the entity.
+    :returns: A generator function yielding the response body.
+    """
+    setValidators(etag, lastModified)
+    if notModified(etag, lastModified):
+        return lambda: ''
+    ranges = requestedRanges(size, etag, lastModified)
+    if ranges and len(ranges) > 1:
+        return multipartRanges(ranges, size, contentType, partStream)
+    if ranges:
+        start, end = ranges[0]
+        setPartialContent(start, end, size)
+    else:
+        start, end = 0, size
+        cherrypy.response.headers['Content-Length'] = size
+    return partStream(start, end)
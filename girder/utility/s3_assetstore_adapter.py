@@ -24,6 +24,8 @@ import json
 import re
 import uuid
 
+from StringIO import StringIO
+
 from .abstract_assetstore_adapter import AbstractAssetstoreAdapter
 from .model_importer import ModelImporter
 from girder.models.model_base import ValidationException
@@ -39,6 +41,7 @@ class S3AssetstoreAdapter(AbstractAssetstoreAdapter):
 
     CHUNK_LEN = 1024 * 1024 * 32  # Chunk size for uploading
     HMAC_TTL = 120  # Number of seconds each signed message is valid
+    READ_LEN = 1024 * 1024  # Block size for reading files back from S3
 
     @staticmethod
     def fileIndexFields():
@@ -173,6 +176,45 @@ class S3AssetstoreAdapter(AbstractAssetstoreAdapter):
         }
         return upload
 
+    def uploadFromStream(self, upload, stream):
+        """
+        Send the data to S3 through boto, as a multipart upload if it is
+        larger than CHUNK_LEN. Each part is held in memory while it is sent.
+        """
+        if upload['size'] <= 0:
+            return upload
+
+        conn = botoConnectS3(self.assetstore.get('botoConnect', {}))
+        bucket = conn.lookup(bucket_name=self.assetstore['bucket'],
+                             validate=False)
+        headers = self._getRequestHeaders(upload)
+        parts = _joinBlocks(stream, self.CHUNK_LEN)
+        size = 0
+        if upload['s3']['chunked']:
+            multipartUpload = bucket.initiate_multipart_upload(
+                upload['s3']['key'], headers=headers)
+            try:
+                for partNumber, data in enumerate(parts, 1):
+                    size += len(data)
+                    multipartUpload.upload_part_from_file(
+                        StringIO(data), partNumber)
+                self.checkUploadSize(upload, size)
+                multipartUpload.complete_upload()
+            except Exception:
+                multipartUpload.cancel_upload()
+                raise
+            # The parts are already combined, so finalizeUpload must not ask
+            # the client to do it.
+            upload['s3']['chunked'] = False
+        else:
+            data = ''.join(parts)
+            size = len(data)
+            self.checkUploadSize(upload, size)
+            bucket.new_key(upload['s3']['key']).set_contents_from_string(
+                data, headers=headers)
+        upload['received'] = size
+        return upload
+
     def requestOffset(self, upload):
         if upload['s3']['chunked']:
             raise ValidationException('Do not call requestOffset on a chunked '
@@ -207,7 +249,12 @@ class S3AssetstoreAdapter(AbstractAssetstoreAdapter):
             }
         return file
 
-    def downloadFile(self, file, offset=0, headers=True):
+    def downloadFile(self, file, offset=0, headers=True, endByte=None):
+        """
+        When downloading a single file with HTTP headers, this redirects to
+        S3. Byte ranges are served by S3 from the Range header that clients
+        send to the redirected URL, so offset and endByte are not used.
+        """
         if headers:
             if file['size'] > 0:
                 url = self._botoGenerateUrl(key=file['s3Key'])
@@ -231,6 +278,46 @@ class S3AssetstoreAdapter(AbstractAssetstoreAdapter):
                     yield '==S3==\n'
             return stream
 
+    def readFile(self, file, offset=0, endByte=None):
+        """
+        Read the contents of the file from S3 through boto, rather than
+        redirecting to it. Only the requested range is fetched.
+        """
+        if endByte is None or endByte > file['size']:
+            endByte = file['size']
+
+        def stream():
+            if offset >= endByte:
+                return
+            conn = botoConnectS3(self.assetstore.get('botoConnect', {}))
+            bucket = conn.lookup(bucket_name=self.assetstore['bucket'],
+                                 validate=False)
+            key = bucket.get_key(file['s3Key'], validate=True)
+            if key is None:
+                raise Exception('S3 key {} does not exist.'.format(
+                    file['s3Key']))
+            key.open_read(headers={
+                'Range': 'bytes={}-{}'.format(offset, endByte - 1)})
+            # A server that ignores the Range header sends the whole file
+            skip = offset if key.resp.status == 200 else 0
+            remaining = endByte - offset
+            try:
+                while remaining > 0:
+                    data = key.read(self.READ_LEN)
+                    if not data:
+                        break
+                    if skip:
+                        dropped = min(skip, len(data))
+                        data = data[dropped:]
+                        skip -= dropped
+                    data = data[:remaining]
+                    remaining -= len(data)
+                    if data:
+                        yield data
+            finally:
+                key.close()
+        return stream
+
     def deleteFile(self, file):
         """
         We want to queue up files to be deleted asynchronously since it requires
@@ -244,11 +331,18 @@ class S3AssetstoreAdapter(AbstractAssetstoreAdapter):
             }
             matching = ModelImporter().model('file').find(q, limit=2, fields=[])
             if matching.count(True) == 1:
-                events.daemon.trigger('_s3_assetstore_delete_file', {
-                    'botoConnect': self.assetstore.get('botoConnect', {}),
-                    'bucket': self.assetstore['bucket'],
-                    'key': file['s3Key']
-                })
+                self.deleteData(file)
+
+    def deleteData(self, file):
+        """
+        Queue the file's key to be deleted asynchronously.
+        """
+        if file['size'] > 0 and 'relpath' in file:
+            events.daemon.trigger('_s3_assetstore_delete_file', {
+                'botoConnect': self.assetstore.get('botoConnect', {}),
+                'bucket': self.assetstore['bucket'],
+                'key': file['s3Key']
+            })
 
     def cancelUpload(self, upload):
         """
@@ -425,6 +519,25 @@ def botoConnectS3(connectParams):
     return conn
 
 
+def _joinBlocks(stream, length):
+    """
+    Regroup an iterable of data blocks into blocks of the given length; the
+    last block may be shorter.
+    """
+    pieces = []
+    size = 0
+    for data in stream:
+        pieces.append(data)
+        size += len(data)
+        while size >= length:
+            joined = ''.join(pieces)
+            yield joined[:length]
+            pieces = [joined[length:]]
+            size -= length
+    if size:
+        yield ''.join(pieces)
+
+
 def makeBotoConnectParams(accessKeyId, secret, service=None):
     """
     Create a dictionary of values to pass to the boto connect_s3 function.
@@ -22,7 +22,7 @@ import cherrypy
 import girder.events
 from girder import constants
 from girder.utility import plugin_utilities, model_importer
-from girder.utility import config
+from girder.utility import config, notification_broker
 from . import webroot
 
 
@@ -93,6 +93,7 @@ def configureServer(test=False, plugins=None, curConfig=None):
 
     cherrypy.engine.subscribe('start', girder.events.daemon.start)
     cherrypy.engine.subscribe('stop', girder.events.daemon.stop)
+    cherrypy.engine.subscribe('stop', notification_broker.broker.stop)
 
     if plugins is None:
         settings = model_importer.ModelImporter().model('setting')
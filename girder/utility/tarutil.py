@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+"""
+Streaming tar archives. Each entry of a tar archive is a fixed-size header
+followed by the file's data, padded to a whole number of blocks, and there is
+no index at the end, so output can begin as soon as the first file is known.
+As the headers only depend on the names and sizes of the files, the length of
+an uncompressed archive is known before any data is read. Headers are written
+in the POSIX.1-2001 (pax) format, so long names and large files need no
+special handling.
+
+Example of creating and consuming a streaming tar:
+
+    tar = tarutil.TarGenerator('TopLevelFolder')
+
+    for data in tar.addFile(lambda: 'hello world', 'hello.txt', 11):
+        yield data
+
+    yield tar.footer()
+"""
+
+import calendar
+import os
+import tarfile
+import time
+import zlib
+
+from . import assetstore_utilities
+from .model_importer import ModelImporter
+
+__all__ = ['TarGenerator', 'fileEntries', 'download']
+
+BLOCK_SIZE = tarfile.BLOCKSIZE
+# The end of an archive is marked by two empty blocks
+END_OF_ARCHIVE = '\0' * (2 * BLOCK_SIZE)
+
+
+class TarGenerator(object):
+    """
+    This class can be used to create a streaming tar file that consumes from
+    one generator and writes to another.
+    """
+    def __init__(self, rootPath='', compress=False):
+        """
+        :param rootPath: The root path for all files within this archive.
+        :type rootPath: str
+        :param compress: Whether to compress the archive with gzip.
+        :type compress: bool
+        """
+        self.rootPath = rootPath
+        self.offset = 0
+        if compress:
+            # A window size of 16 + 15 bits writes a gzip header and trailer
+            self.compressor = zlib.compressobj(
+                zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 31)
+        else:
+            self.compressor = None
+
+    def _output(self, data):
+        """
+        Call this for all data added to the archive, to keep track of the
+        offset of the data and compress it if needed.
+        """
+        self.offset += len(data)
+        if self.compressor:
+            return self.compressor.compress(data)
+        return data
+
+    def fileHeader(self, path, size, mtime=None):
+        """
+        Return the header of an entry as a string.
+        :param path: The path within the archive for this entry.
+        :type path: str
+        :param size: The size of the file in bytes.
+        :type size: int
+        :param mtime: The modification time of the file, as seconds since the
+            epoch. Defaults to the current time.
+        :type mtime: int
+        """
+        info = tarfile.TarInfo(os.path.join(self.rootPath, path))
+        info.size = size
+        info.mtime = int(time.time() if mtime is None else mtime)
+        info.mode = 0644
+        info.type = tarfile.REGTYPE
+        return info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'strict')
+
+    def entrySize(self, path, size):
+        """
+        Return the number of bytes an entry takes in an uncompressed archive.
+        """
+        padding = -size % BLOCK_SIZE
+        return len(self.fileHeader(path, size, 0)) + size + padding
+
+    def addFile(self, generator, path, size, mtime=None):
+        """
+        Generates data to add a file at the given path in the archive.
+        :param generator: Generator function that will yield the file contents.
+        :type generator: function
+        :param path: The path within the archive for this entry.
+        :type path: str
+        :param size: The size of the file in bytes, which the header records
+            before the contents are read.
+        :type size: int
+        :param mtime: The modification time of the file, as seconds since the
+            epoch. Defaults to the current time.
+        :type mtime: int
+        """
+        yield self._output(self.fileHeader(path, size, mtime))
+        written = 0
+        for buf in generator():
+            if not buf:
+                break
+            written += len(buf)
+            if written > size:
+                break
+            yield self._output(buf)
+        if written != size:
+            raise Exception('Expected {} bytes of data for {}, got {}.'.format(
+                size, path, written))
+        yield self._output('\0' * (-size % BLOCK_SIZE))
+
+    def footer(self):
+        """
+        Once all files have been added with addFile, you must call this to get
+        the end of the archive.
+        """
+        data = self._output(END_OF_ARCHIVE)
+        if self.compressor:
+            data += self.compressor.flush()
+        return data
+
+
+def fileEntries(fileList):
+    """
+    Get what is needed to add the files listed by a model's fileList method to
+    a tar archive. Each file's data is read when its generator function is
+    called. Metadata files are generated in memory to find their sizes, and
+    link files hold their URL, as in zip archives.
+
+    :param fileList: The (path, file document or generator function) pairs
+        yielded by fileList called with data=False.
+    :type fileList: iterable
+    :returns: A generator of (path, size, mtime, generator function) tuples.
+    """
+    fileModel = ModelImporter().model('file')
+    for path, file in fileList:
+        if callable(file):
+            data = ''.join(file())
+            yield (path, len(data), None, _dataStream(data))
+        elif file.get('assetstoreId'):
+            created = file.get('created')
+            mtime = created and calendar.timegm(created.utctimetuple())
+            yield (path, file['size'], mtime, _fileStream(file))
+        else:
+            data = ''.join(fileModel.download(file, headers=False)())
+            yield (path, len(data), None, _dataStream(data))
+
+
+def download(fileList, rootPath='', compress=False):
+    """
+    Stream a tar archive of the files listed by a model's fileList method.
+    The length of an uncompressed archive is returned with it, which requires
+    listing all of the files first; a compressed one is streamed as the files
+    are listed, and its length is not known.
+
+    :param fileList: The (path, file document or generator function) pairs
+        yielded by fileList called with data=False.
+    :type fileList: iterable
+    :param rootPath: The root path for all files within the archive.
+    :type rootPath: str
+    :param compress: Whether to compress the archive with gzip.
+    :type compress: bool
+    :returns: A (length, generator function) tuple. The length is None when
+        the archive is compressed.
+    """
+    entries = fileEntries(fileList)
+    length = None
+    if not compress:
+        entries = list(entries)
+        tar = TarGenerator(rootPath)
+        length = sum(
+            tar.entrySize(path, size) for path, size, _, _ in entries
+        ) + len(END_OF_ARCHIVE)
+
+    def stream():
+        tar = TarGenerator(rootPath, compress=compress)
+        for path, size, mtime, generator in entries:
+            for data in tar.addFile(generator, path, size, mtime):
+                if data:
+                    yield data
+        yield tar.footer()
+    return length, stream
+
+
+def _dataStream(data):
+    return lambda: iter((data,))
+
+
+def _fileStream(file):
+    """
+    Get a generator function for a file's data that only starts reading it
+    when it is called. The data is read through the assetstore adapter, as
+    downloads of some assetstores redirect rather than stream the data.
+    """
+    def stream():
+        assetstore = ModelImporter().model('assetstore').load(
+            file['assetstoreId'])
+        adapter = assetstore_utilities.getAssetstoreAdapter(assetstore)
+        for data in adapter.readFile(file)():
+            yield data
+    return stream
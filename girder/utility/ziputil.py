@@ -30,26 +30,43 @@ Example of creating and consuming a streaming zip:
         yield data
 
     yield zip.footer()
+
+When compressing, several entries can be compressed at once on worker threads
+by passing them all to addFiles; zlib releases the GIL while it compresses.
 """
 
 import binascii
+import bisect
+import collections
+import functools
+import hashlib
 import os
+import Queue
 import struct
 import sys
+import threading
 import time
 
+from girder.utility import assetstore_utilities, config
+from .model_importer import ModelImporter
+
 try:
     import zlib
 except ImportError:  # pragma: no cover
     zlib = None
 
-__all__ = ['STORE', 'DEFLATE', 'ZipGenerator']
+__all__ = ['STORE', 'DEFLATE', 'ZipGenerator', 'StoredZip', 'fromConfig',
+           'storedArchive']
 
 
 Z64_LIMIT = (1 << 31) - 1
 Z_FILECOUNT_LIMIT = 1 << 16
 STORE = 0
 DEFLATE = 8
+# Maximum number of compressed blocks of an entry waiting to be emitted
+ENTRY_DEPTH = 16
+# The earliest modification time a zip archive can record
+MIN_TIMESTAMP = (1980, 1, 1, 0, 0, 0)
 
 
 class ZipInfo(object):
@@ -62,6 +79,7 @@ class ZipInfo(object):
         'createVersion',
         'extractVersion',
         'externalAttr',
+        'flagBits',
         'headerOffset',
         'crc',
         'compressSize',
@@ -87,14 +105,17 @@ class ZipInfo(object):
         self.createVersion = 20
         self.extractVersion = 20
         self.externalAttr = 0
+        # The sizes and checksum follow the data in a data descriptor
+        self.flagBits = 0x8
 
     def dataDescriptor(self):
         if self.compressSize > Z64_LIMIT or self.fileSize > Z64_LIMIT:
-            fmt = '<4slQQ'
+            fmt = '<4sLQQ'
         else:
-            fmt = '<4slLL'
+            fmt = '<4sLLL'
         return struct.pack(
-            fmt, 'PK\x07\x08', self.crc, self.compressSize, self.fileSize)
+            fmt, 'PK\x07\x08', self.crc & 0xffffffff, self.compressSize,
+            self.fileSize)
 
     def fileHeader(self):
         """
@@ -109,25 +130,62 @@ class ZipInfo(object):
             self.compressType, dostime, dosdate, 0, 0, 0, len(self.filename), 0)
         return header + self.filename
 
+    def storedFileHeader(self):
+        """
+        Return the per-file header of an entry whose checksum and sizes are
+        set in advance, so that no data descriptor follows its data.
+        """
+        dt = self.timestamp
+        dosdate = (dt[0] - 1980) << 9 | dt[1] << 5 | dt[2]
+        dostime = dt[3] << 11 | dt[4] << 5 | (dt[5] // 2)
+
+        self.flagBits = 0
+        if self.compressSize > Z64_LIMIT or self.fileSize > Z64_LIMIT:
+            extra = struct.pack(
+                '<hhqq', 1, 16, self.fileSize, self.compressSize)
+            extractVersion = max(45, self.extractVersion)
+            fileSize = compressSize = 0xffffffff
+        else:
+            extra = ''
+            extractVersion = self.extractVersion
+            fileSize = self.fileSize
+            compressSize = self.compressSize
+
+        header = struct.pack(
+            '<4s2B4HLLL2H', 'PK\003\004', extractVersion, 0, self.flagBits,
+            self.compressType, dostime, dosdate, self.crc & 0xffffffff,
+            compressSize, fileSize, len(self.filename), len(extra))
+        return header + self.filename + extra
+
 
 class ZipGenerator(object):
     """
     This class can be used to create a streaming zip file that consumes from
     one generator and writes to another.
     """
-    def __init__(self, rootPath='', compression=STORE):
+    def __init__(self, rootPath='', compression=STORE, workers=0,
+                 lookahead=None):
         """
         :param rootPath: The root path for all files within this archive.
         :type rootPath: str
         :param compression: Whether files in this archive should be compressed.
-
-        :type
+        :type compression: STORE or DEFLATE
+        :param workers: The number of threads that compress the entries passed
+            to addFiles ahead of the one being emitted. With 0, each entry is
+            compressed as it is emitted.
+        :type workers: int
+        :param lookahead: The maximum number of entries being compressed
+            ahead, which bounds the memory used. Defaults to twice the number
+            of workers.
+        :type lookahead: int
         """
         if compression == DEFLATE and not zlib:
             raise RuntimeError('Missing zlib module')  # pragma: no cover
 
         self.files = []
         self.compression = compression
+        self.workers = workers
+        self.lookahead = lookahead or 2 * workers
         self.rootPath = str(rootPath)
         self.offset = 0
 
@@ -139,6 +197,14 @@ class ZipGenerator(object):
         self.offset += len(data)
         return data
 
+    def _header(self, path, timestamp=None):
+        header = ZipInfo(os.path.join(self.rootPath, str(path)),
+                         timestamp or time.localtime()[0:6])
+        header.externalAttr = (0100644 & 0xFFFF) << 16L
+        header.compressType = self.compression
+        header.headerOffset = self.offset
+        return header
+
     def addFile(self, generator, path):
         """
         Generates data to add a file at the given path in the archive.
@@ -147,11 +213,7 @@ class ZipGenerator(object):
         :param path: The path within the archive for this entry.
         :type path: str
         """
-        header = ZipInfo(os.path.join(self.rootPath, str(path)),
-                         time.localtime()[0:6])
-        header.externalAttr = (0100644 & 0xFFFF) << 16L
-        header.compressType = self.compression
-        header.headerOffset = self.offset
+        header = self._header(path)
 
         header.crc = crc = 0
         header.compressSize = compressSize = 0
@@ -185,6 +247,71 @@ class ZipGenerator(object):
         yield self._advanceOffset(header.dataDescriptor())
         self.files.append(header)
 
+    def addFiles(self, files):
+        """
+        Generates data to add several files to the archive, in order. If the
+        archive is compressed and has workers, upcoming entries are read and
+        compressed on worker threads while earlier ones are emitted.
+        :param files: The (path, generator function) pairs of the files, as
+            yielded by the fileList methods of the models.
+        :type files: iterable
+        """
+        if self.compression != DEFLATE or self.workers < 1:
+            for path, generator in files:
+                for data in self.addFile(generator, path):
+                    yield data
+            return
+
+        tasks = Queue.Queue()
+        threads = [threading.Thread(target=_compressEntries, args=(tasks,))
+                   for _ in xrange(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        pending = collections.deque()
+        files = iter(files)
+        try:
+            while True:
+                # Workers take entries in order, so the entry at the head of
+                # the queue is always being compressed.
+                for path, generator in files:
+                    entry = _Entry(path, generator)
+                    pending.append(entry)
+                    tasks.put(entry)
+                    if len(pending) >= self.lookahead:
+                        break
+                if not pending:
+                    break
+                # The entry stays pending until it is emitted, so that it is
+                # cancelled if the archive is abandoned partway through it.
+                for data in self._emitEntry(pending[0]):
+                    yield data
+                pending.popleft()
+        finally:
+            for entry in pending:
+                entry.cancel()
+            for _ in threads:
+                tasks.put(None)
+
+    def _emitEntry(self, entry):
+        """
+        Generates the data of an entry compressed by a worker thread.
+        """
+        header = self._header(entry.path)
+        yield self._advanceOffset(header.fileHeader())
+        while True:
+            buf = entry.queue.get()
+            if buf is None:
+                break
+            yield self._advanceOffset(buf)
+        if entry.error is not None:
+            raise entry.error[0], entry.error[1], entry.error[2]
+        header.crc = entry.crc
+        header.fileSize = entry.fileSize
+        header.compressSize = entry.compressSize
+        yield self._advanceOffset(header.dataDescriptor())
+        self.files.append(header)
+
     def footer(self):
         """
         Once all zip files have been added with addFile, you must call this
@@ -224,10 +351,11 @@ class ZipGenerator(object):
                 createVersion = header.createVersion
 
             centdir = struct.pack(
-                '<4s4B4HlLL5HLl', 'PK\001\002', createVersion,
-                header.createSystem, extractVersion, 0, 0x8,
-                header.compressType, dostime, dosdate, header.crc, compressSize,
-                fileSize, len(header.filename), len(extraData), 0, 0, 0,
+                '<4s4B4HLLL5HLl', 'PK\001\002', createVersion,
+                header.createSystem, extractVersion, 0, header.flagBits,
+                header.compressType, dostime, dosdate,
+                header.crc & 0xffffffff, compressSize, fileSize,
+                len(header.filename), len(extraData), 0, 0, 0,
                 header.externalAttr, headerOffset)
 
             data.append(self._advanceOffset(centdir))
@@ -256,3 +384,242 @@ class ZipGenerator(object):
         data.append(self._advanceOffset(endrec))
 
         return ''.join(data)
+
+
+class StoredZip(object):
+    """
+    A zip archive of uncompressed files whose sizes and CRC-32 checksums are
+    known before their data is read. The layout of such an archive is fixed
+    by its entries, so its length and the offset of each of its bytes are
+    known in advance, and any byte range of it can be generated. The same
+    entries always produce the same archive.
+
+    Add every entry with addFile before reading the archive's size, etag, or
+    data.
+
+    :param rootPath: The root path for all files within this archive.
+    :type rootPath: str
+    """
+    def __init__(self, rootPath=''):
+        self._zip = ZipGenerator(rootPath)
+        self._offsets = []
+        self._parts = []
+        self._checksum = hashlib.sha1()
+        self._finished = False
+
+    def _addPart(self, length, data=None, read=None):
+        if length:
+            self._offsets.append(self._zip.offset)
+            self._parts.append((length, data, read))
+            self._zip.offset += length
+
+    def addFile(self, path, size, crc, read, timestamp=None):
+        """
+        Add an entry to the archive.
+        :param path: The path within the archive for this entry.
+        :type path: str
+        :param size: The size of the file's data.
+        :type size: int
+        :param crc: The CRC-32 of the file's data, as an unsigned int.
+        :type crc: int
+        :param read: A function taking the start and end of a byte range of
+            the file's data and returning a generator function yielding it.
+        :type read: function
+        :param timestamp: The modification time of the file. If this is not
+            given, the earliest time an archive can record is used.
+        :type timestamp: datetime.datetime
+        """
+        if self._finished:
+            raise RuntimeError('Files cannot be added once the archive has '
+                               'been read.')
+        if timestamp is not None:
+            timestamp = max(MIN_TIMESTAMP, timestamp.timetuple()[0:6])
+        header = self._zip._header(path, timestamp or MIN_TIMESTAMP)
+        header.crc = crc
+        header.compressSize = header.fileSize = size
+        data = header.storedFileHeader()
+        self._checksum.update(data)
+        self._addPart(len(data), data=data)
+        self._addPart(size, read=read)
+        self._zip.files.append(header)
+
+    def _finish(self):
+        if not self._finished:
+            self._finished = True
+            data = self._zip.footer()
+            # footer() already advanced the offset past the central directory
+            self._zip.offset -= len(data)
+            self._checksum.update(data)
+            self._addPart(len(data), data=data)
+
+    @property
+    def size(self):
+        """
+        The total length of the archive in bytes.
+        """
+        self._finish()
+        return self._zip.offset
+
+    @property
+    def etag(self):
+        """
+        An entity tag, including quotes, that identifies the archive's
+        layout, which covers the names, sizes and checksums of its files.
+        """
+        self._finish()
+        return '"%s"' % self._checksum.hexdigest()
+
+    def stream(self, start=0, end=None):
+        """
+        Generate a byte range of the archive.
+        :param start: The offset of the first byte to generate.
+        :type start: int
+        :param end: The offset after the last byte to generate, or None for
+            the end of the archive.
+        :type end: int or None
+        :returns: A generator function yielding the range.
+        """
+        self._finish()
+        if end is None or end > self.size:
+            end = self.size
+
+        def stream():
+            index = max(0, bisect.bisect_right(self._offsets, start) - 1)
+            position = start
+            while position < end and index < len(self._parts):
+                offset = self._offsets[index]
+                length, data, read = self._parts[index]
+                partEnd = min(end, offset + length)
+                if data is not None:
+                    yield data[position - offset:partEnd - offset]
+                else:
+                    for buf in read(position - offset, partEnd - offset)():
+                        yield buf
+                position = partEnd
+                index += 1
+        return stream
+
+
+def _readFileRange(file, start, end):
+    # Read through the adapter, as downloads of some assetstores redirect
+    assetstore = ModelImporter().model('assetstore').load(file['assetstoreId'])
+    adapter = assetstore_utilities.getAssetstoreAdapter(assetstore)
+    return adapter.readFile(file, offset=start, endByte=end)
+
+
+def _readDataRange(data, start, end):
+    return lambda: iter((data[start:end],))
+
+
+class _Entry(object):
+    """
+    An entry of an archive being compressed on a worker thread. Its compressed
+    data is passed back through a bounded queue, ending with None.
+    """
+    def __init__(self, path, generator):
+        self.path = path
+        self.generator = generator
+        self.queue = Queue.Queue(ENTRY_DEPTH)
+        self.cancelled = False
+        self.error = None
+        self.crc = 0
+        self.fileSize = 0
+        self.compressSize = 0
+
+    def put(self, buf):
+        """
+        Pass compressed data back, unless the archive has been abandoned.
+        :returns: Whether compression should continue.
+        """
+        if self.cancelled:
+            return False
+        self.compressSize += len(buf)
+        self.queue.put(buf)
+        return True
+
+    def compress(self):
+        try:
+            compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                          zlib.DEFLATED, -15)
+            for buf in self.generator():
+                if not buf:
+                    break
+                self.fileSize += len(buf)
+                self.crc = binascii.crc32(buf, self.crc)
+                buf = compressor.compress(buf)
+                if buf and not self.put(buf):
+                    return
+            self.put(compressor.flush())
+        except Exception:
+            self.error = sys.exc_info()
+        finally:
+            self.queue.put(None)
+
+    def cancel(self):
+        """
+        Stop compressing this entry. A worker blocked on the full queue is
+        released, and stops before its next block.
+        """
+        self.cancelled = True
+        try:
+            while True:
+                self.queue.get_nowait()
+        except Queue.Empty:
+            pass
+
+
+def _compressEntries(tasks):
+    while True:
+        entry = tasks.get()
+        if entry is None:
+            return
+        if not entry.cancelled:
+            entry.compress()
+
+
+def fromConfig(rootPath=''):
+    """
+    Create a ZipGenerator for a download, using the compression and number of
+    workers set by the "zip_compression" and "zip_workers" values of the
+    "downloads" config section.
+
+    :param rootPath: The root path for all files within the archive.
+    :type rootPath: str
+    """
+    conf = config.getConfig().get('downloads', {})
+    compression = DEFLATE if conf.get('zip_compression') == 'deflate' \
+        else STORE
+    return ZipGenerator(rootPath, compression=compression,
+                        workers=int(conf.get('zip_workers') or 0))
+
+
+def storedArchive(fileList, rootPath=''):
+    """
+    Lay out a StoredZip of the files listed by a model's fileList method
+    called with data=False, if every file has a recorded CRC-32 checksum and
+    downloads are not configured to compress archives. Metadata files are
+    generated in memory to compute their checksums.
+
+    :param fileList: The (path, file document or generator function) pairs.
+    :type fileList: iterable
+    :param rootPath: The root path for all files within the archive.
+    :type rootPath: str
+    :returns: A StoredZip, or None if the archive must be streamed with a
+        ZipGenerator instead.
+    """
+    conf = config.getConfig().get('downloads', {})
+    if conf.get('zip_compression') == 'deflate':
+        return None
+    archive = StoredZip(rootPath)
+    for path, file in fileList:
+        if callable(file):
+            data = ''.join(file())
+            archive.addFile(path, len(data), binascii.crc32(data) & 0xffffffff,
+                            functools.partial(_readDataRange, data))
+        elif file.get('crc32') and file.get('assetstoreId'):
+            archive.addFile(path, file['size'], int(file['crc32'], 16),
+                            functools.partial(_readFileRange, file),
+                            file.get('created'))
+        else:
+            return None
+    return archive
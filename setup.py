@@ -118,7 +118,7 @@ setup(
     },
     install_requires=reqs,
     zip_safe=False,
-    scripts=['girder-install'],
+    scripts=['girder-install', 'girder-admin'],
     cmdclass={
         'install': InstallWithOptions
     }
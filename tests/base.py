@@ -32,7 +32,7 @@ import urllib
 import uuid
 
 from StringIO import StringIO
-from girder.utility import model_importer
+from girder.utility import assetstore_utilities, model_importer
 from girder.utility.server import setup as setupServer
 from girder.constants import AccessType, ROOT_DIR, SettingKey
 from girder.models import getDbConnection
@@ -92,6 +92,7 @@ def dropTestDatabase():
     """
     db_connection = getDbConnection()
     model_importer.clearModels()  # Must clear the models to rebuild indices
+    assetstore_utilities.clearAdapterCache()
     dbName = cherrypy.config['database']['uri'].split('/')[-1]
 
     if 'girder_test_' not in dbName:
@@ -107,6 +108,8 @@ def dropGridFSDatabase(dbName):
     """
     db_connection = getDbConnection()
     db_connection.drop_database(dbName)
+    # Adapters for this database would no longer recreate its indices
+    assetstore_utilities.clearAdapterCache()
 
 
 def dropFsAssetstore(path):
@@ -308,7 +311,8 @@ class TestCase(unittest.TestCase, model_importer.ModelImporter):
         :type path: str
         :param method: The HTTP method.
         :type method: str
-        :param params: The HTTP parameters.
+        :param params: The HTTP parameters. If a body and its type are given,
+            these are sent in the query string.
         :type params: dict
         :param prefix: The prefix to use before the path.
         :param isJson: Whether the response is a JSON object.
@@ -337,12 +341,12 @@ class TestCase(unittest.TestCase, model_importer.ModelImporter):
             if type is None:
                 headers.append(('Content-Type',
                                 'application/x-www-form-urlencoded'))
+                body, qs = qs, None
             else:
+                # The params are sent in the query string
                 headers.append(('Content-Type', type))
-                qs = body
-            headers.append(('Content-Length', '%d' % len(qs)))
-            fd = StringIO(qs)
-            qs = None
+            headers.append(('Content-Length', '%d' % len(body)))
+            fd = StringIO(body)
         elif params:
             qs = urllib.urlencode(params)
 
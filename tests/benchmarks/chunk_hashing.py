@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+"""
+Benchmark of the checksum work done for each chunk of an upload. For a range
+of chunk sizes, a file is hashed one chunk at a time, resuming the hash state
+before each chunk and saving it afterward, as the assetstore adapters do. This
+is timed with hash_state, and with a reference implementation of the previous
+approach, which copied the internal state of a sha512 object in and out of
+interpreter memory with ctypes and hex encoded it. The cost of computing extra
+digests in the same pass is also shown, as is the case where the hasher is
+lost before every chunk, as when each chunk reaches a different server; the
+chunks are then only stored, and the whole file is hashed once at the end. No
+database or server is required.
+Run with:
+
+    python -m tests.benchmarks.chunk_hashing
+"""
+
+import argparse
+import binascii
+import ctypes
+import hashlib
+import os
+import time
+
+from girder.utility import hash_state
+
+POFFSET = 6
+STATESIZE = 216
+
+
+def ctypesSerializeHex(checksum):
+    datap = ctypes.cast(
+        ctypes.cast(id(checksum), ctypes.POINTER(ctypes.c_voidp))[POFFSET],
+        ctypes.POINTER(ctypes.c_char))
+    return binascii.b2a_hex(datap[:STATESIZE])
+
+
+def ctypesRestoreHex(state):
+    checksum = hashlib.sha512()
+    datap = ctypes.cast(
+        ctypes.cast(id(checksum), ctypes.POINTER(ctypes.c_voidp))[POFFSET],
+        ctypes.POINTER(ctypes.c_char))
+    for i, byte in enumerate(binascii.a2b_hex(state)):
+        datap[i] = byte
+    return checksum
+
+
+def timeCtypes(chunks):
+    start = time.time()
+    state = ctypesSerializeHex(hashlib.sha512())
+    for chunk in chunks:
+        checksum = ctypesRestoreHex(state)
+        checksum.update(chunk)
+        state = ctypesSerializeHex(checksum)
+    digest = ctypesRestoreHex(state).hexdigest()
+    return time.time() - start, digest
+
+
+def timeHashState(chunks, algorithms, lost=False):
+    start = time.time()
+    state = hash_state.save(hash_state.ResumableHasher(algorithms))
+    for chunk in chunks:
+        if lost:
+            hash_state._live.clear()
+        checksum = hash_state.resume(state)
+        checksum.update(chunk)
+        state = hash_state.save(checksum)
+    checksum = hash_state.resume(state)
+    if checksum.stale:
+        checksum = hash_state.ResumableHasher(algorithms)
+        for chunk in chunks:
+            checksum.update(chunk)
+    digest = checksum.hexdigests()['sha512']
+    return time.time() - start, digest
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Time per-chunk checksum handling for uploads.')
+    parser.add_argument('-s', '--size', type=int, default=256,
+                        help='File size in MB.')
+    parser.add_argument('-c', '--chunk-sizes', type=int, nargs='+',
+                        default=[64, 1024, 5 * 1024, 64 * 1024],
+                        help='Chunk sizes in KB.')
+    args = parser.parse_args()
+
+    data = os.urandom(args.size * 1024 * 1024)
+    expected = hashlib.sha512(data).hexdigest()
+    megabytes = float(len(data)) / (1024 * 1024)
+
+    print '{:>22} {:>10} {:>8} {:>10} {:>10}'.format(
+        'method', 'chunk KB', 'chunks', 'seconds', 'MB/s')
+    for chunkKb in args.chunk_sizes:
+        chunkSize = chunkKb * 1024
+        chunks = [data[i:i + chunkSize]
+                  for i in xrange(0, len(data), chunkSize)]
+        methods = [
+            ('ctypes sha512', lambda: timeCtypes(chunks)),
+            ('hash_state sha512',
+             lambda: timeHashState(chunks, ['sha512'])),
+            ('hash_state +md5,sha256',
+             lambda: timeHashState(chunks, ['sha512', 'md5', 'sha256'])),
+            ('hash_state lost',
+             lambda: timeHashState(chunks, ['sha512'], lost=True))
+        ]
+        for label, func in methods:
+            try:
+                seconds, digest = func()
+            except Exception as exc:
+                print '{:>22} {:>10} failed: {}'.format(label, chunkKb, exc)
+                continue
+            assert digest == expected, label
+            print '{:>22} {:>10} {:>8} {:>10.3f} {:>10.0f}'.format(
+                label, chunkKb, len(chunks), seconds, megabytes / seconds)
+
+
+if __name__ == '__main__':
+    main()
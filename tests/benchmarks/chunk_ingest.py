@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+"""
+Benchmark of chunk ingestion into a filesystem assetstore. A single large
+chunk is read from a spooled temporary file, as CherryPy provides it, and
+passed to uploadChunk, once with hashing pipelined on a worker thread and once
+with hashing done inline on the request thread, as before. The throughput and
+the time spent waiting on the hashing thread are reported from the upload's
+ingest statistics. No database or server is required. Run with:
+
+    python -m tests.benchmarks.chunk_ingest
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+
+from girder.utility import config, ingest
+from girder.utility.filesystem_assetstore_adapter import \
+    FilesystemAssetstoreAdapter
+
+
+def ingestChunk(adapter, path, size):
+    upload = adapter.initUpload({'size': size, 'received': 0})
+    try:
+        # uploadChunk closes the chunk when it is done
+        upload = adapter.uploadChunk(upload, open(path, 'rb'))
+    finally:
+        os.remove(upload['tempFile'])
+    return upload['ingest']
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Time ingesting a large upload chunk.')
+    parser.add_argument('-s', '--size', type=int, default=1024,
+                        help='Chunk size in MB.')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='Chunks ingested per measurement.')
+    parser.add_argument('--extra-hashes', nargs='*', default=[],
+                        help='Extra checksum algorithms, e.g. md5 sha256.')
+    args = parser.parse_args()
+
+    config.getConfig()['uploads'] = {'extra_hashes': args.extra_hashes}
+
+    root = tempfile.mkdtemp()
+    try:
+        adapter = FilesystemAssetstoreAdapter({'_id': None, 'root': root})
+        size = args.size * 1024 * 1024
+        path = os.path.join(root, 'chunk')
+        with open(path, 'wb') as f:
+            for _ in xrange(args.size):
+                f.write(os.urandom(1024 * 1024))
+
+        print '{:>10} {:>10} {:>10} {:>14}'.format(
+            'hashing', 'seconds', 'MB/s', 'hash wait (s)')
+        minSize = ingest.MIN_PIPELINE_SIZE
+        for label, threshold in (('inline', size + 1),
+                                 ('pipelined', minSize)):
+            ingest.MIN_PIPELINE_SIZE = threshold
+            stats = min((ingestChunk(adapter, path, size)
+                         for _ in xrange(args.repeat)),
+                        key=lambda s: s['seconds'])
+            print '{:>10} {:>10.3f} {:>10.0f} {:>14.3f}'.format(
+                label, stats['seconds'],
+                stats['bytesPerSecond'] / (1024 * 1024),
+                stats['hashWaitSeconds'])
+        ingest.MIN_PIPELINE_SIZE = minSize
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
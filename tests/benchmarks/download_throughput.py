@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+"""
+Benchmark of filesystem assetstore download throughput. A whole-file download
+and a byte range download are served in each filesystem_mode: "stream", where
+Girder reads the file and yields its contents, which are written to /dev/null
+as a stand-in for the client socket, and "x-sendfile", where Girder only sets
+the headers for the front-end server. For reference, the time for the kernel
+to copy the same bytes with sendfile(2) is shown when the pysendfile package
+is installed. No database or server is required. Run with:
+
+    python -m tests.benchmarks.download_throughput
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from girder.utility import config
+from girder.utility.filesystem_assetstore_adapter import \
+    FilesystemAssetstoreAdapter
+
+try:
+    from sendfile import sendfile
+except ImportError:
+    sendfile = None
+
+
+def timeStream(adapter, file, sink, offset, endByte):
+    start = time.time()
+    for data in adapter.downloadFile(file, offset=offset, endByte=endByte)():
+        sink.write(data)
+    return time.time() - start
+
+
+def timeOffload(adapter, file):
+    start = time.time()
+    adapter.offloadDownload(file)
+    return time.time() - start
+
+
+def timeSendfile(path, sink, offset, endByte):
+    start = time.time()
+    with open(path, 'rb') as f:
+        while offset < endByte:
+            sent = sendfile(sink.fileno(), f.fileno(), offset,
+                            endByte - offset)
+            if not sent:
+                break
+            offset += sent
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Time filesystem assetstore downloads.')
+    parser.add_argument('-s', '--size', type=int, default=256,
+                        help='File size in MB.')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='Downloads per measurement.')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp()
+    try:
+        size = args.size * 1024 * 1024
+        file = {'name': 'bench.bin', 'path': 'bench.bin', 'size': size,
+                'mimeType': 'application/octet-stream'}
+        path = os.path.join(root, file['path'])
+        with open(path, 'wb') as f:
+            for _ in xrange(args.size):
+                f.write(os.urandom(1024 * 1024))
+        adapter = FilesystemAssetstoreAdapter({'_id': None, 'root': root})
+        cfg = config.getConfig()
+
+        print '{:>12} {:>8} {:>12} {:>10}'.format(
+            'mode', 'range', 'seconds', 'MB/s')
+        with open(os.devnull, 'wb') as sink:
+            for label, offset, endByte in (('whole', 0, size),
+                                           ('half', size // 4,
+                                            size * 3 // 4)):
+                megabytes = float(endByte - offset) / (1024 * 1024)
+                cfg['downloads'] = {'filesystem_mode': 'stream'}
+                rows = [('stream', min(
+                    timeStream(adapter, file, sink, offset, endByte)
+                    for _ in xrange(args.repeat)))]
+                cfg['downloads'] = {'filesystem_mode': 'x-sendfile'}
+                rows.append(('x-sendfile', min(
+                    timeOffload(adapter, file)
+                    for _ in xrange(args.repeat))))
+                if sendfile is not None:
+                    rows.append(('sendfile(2)', min(
+                        timeSendfile(path, sink, offset, endByte)
+                        for _ in xrange(args.repeat))))
+                for mode, seconds in rows:
+                    print '{:>12} {:>8} {:>12.6f} {:>10.0f}'.format(
+                        mode, label, seconds,
+                        megabytes / seconds if seconds else float('inf'))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
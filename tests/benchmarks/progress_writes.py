@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+"""
+Benchmark of progress reporting during a large recursive delete. A folder with
+many items is deleted with progress enabled, once using ProgressContext and
+once using a reference implementation of the previous behavior, which saved
+the whole progress record from the calling thread whenever the interval had
+elapsed. For each, the duration, the number of progress record writes, and
+the MongoDB write operations per second (from serverStatus) are reported.
+This requires a running MongoDB; the given database is dropped before and
+after the run. Run with:
+
+    python -m tests.benchmarks.progress_writes
+"""
+
+import argparse
+import datetime
+import time
+
+from girder.models import getDbConnection
+from girder.utility import config
+from girder.utility.model_importer import ModelImporter
+from girder.utility.progress import ProgressContext
+
+
+class SaveProgressContext(ProgressContext):
+    """
+    Reference implementation of the previous update policy.
+    """
+    def update(self, force=False, **kwargs):
+        save = (time.time() - self._lastSave > self.interval) or force
+        self.progress = self.model('notification').updateProgress(
+            self.progress, save, **kwargs)
+        if save:
+            self._lastSave = time.time()
+
+
+def mongoWrites(db):
+    counters = db.command('serverStatus')['opcounters']
+    return counters['insert'] + counters['update'] + counters['delete']
+
+
+def countCalls(obj, name, counter):
+    func = getattr(obj, name)
+
+    def wrapper(*args, **kwargs):
+        counter[0] += 1
+        return func(*args, **kwargs)
+    setattr(obj, name, wrapper)
+
+
+def createFolder(models, user, nItems, batchSize=1000):
+    folder = models.model('folder').createFolder(
+        user, 'Benchmark %s' % datetime.datetime.utcnow().isoformat(),
+        parentType='user', public=False, creator=user)
+    now = datetime.datetime.utcnow()
+    for start in xrange(0, nItems, batchSize):
+        models.model('item').collection.insert([{
+            'name': 'item %d' % i,
+            'lowerName': 'item %d' % i,
+            'description': '',
+            'folderId': folder['_id'],
+            'ancestors': folder['ancestors'] + [folder['_id']],
+            'creatorId': user['_id'],
+            'baseParentType': folder['baseParentType'],
+            'baseParentId': folder['baseParentId'],
+            'created': now,
+            'updated': now,
+            'size': 0
+        } for i in xrange(start, min(start + batchSize, nItems))])
+    return folder
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Time deleting a large folder with progress reporting.')
+    parser.add_argument('-n', '--items', type=int, default=100000,
+                        help='Number of items in the deleted folder.')
+    parser.add_argument('-i', '--interval', type=float, default=0.5,
+                        help='Progress interval in seconds.')
+    parser.add_argument('--uri', default='mongodb://localhost:27017/'
+                        'girder_benchmark_progress',
+                        help='MongoDB URI of a scratch database.')
+    args = parser.parse_args()
+
+    config.getConfig()['database'] = {'uri': args.uri}
+    connection = getDbConnection()
+    db = connection.get_default_database()
+    connection.drop_database(db.name)
+    models = ModelImporter()
+
+    try:
+        user = models.model('user').createUser(
+            login='benchmark', password='password', firstName='Bench',
+            lastName='Mark', email='benchmark@example.com')
+        flushes = [0]
+        saves = [0]
+        notification = models.model('notification')
+        countCalls(notification, 'flushProgress', flushes)
+        countCalls(notification, 'save', saves)
+
+        print '{:>14} {:>8} {:>10} {:>16} {:>14}'.format(
+            'policy', 'items', 'seconds', 'progress writes', 'writes/sec')
+        for label, cls in (('write-behind', ProgressContext),
+                           ('save', SaveProgressContext)):
+            folder = createFolder(models, user, args.items)
+            flushes[0] = saves[0] = 0
+            writes = mongoWrites(db)
+            start = time.time()
+            with cls(True, interval=args.interval, user=user,
+                     title='Deleting folder', total=args.items + 1) as ctx:
+                models.model('folder').remove(folder, progress=ctx)
+            elapsed = time.time() - start
+            writes = mongoWrites(db) - writes
+            print '{:>14} {:>8} {:>10.2f} {:>16} {:>14.0f}'.format(
+                label, args.items, elapsed, flushes[0] + saves[0],
+                writes / elapsed)
+    finally:
+        connection.drop_database(db.name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+"""
+Benchmark of streaming zip archives of a folder of many mid-size files, as
+served by folder downloads. The archive is written to /dev/null uncompressed,
+compressed on the request thread, and compressed with upcoming files read and
+compressed by a range of worker thread counts. The files are read from a
+filesystem assetstore and hold partly compressible data. No database or
+server is required. Run with:
+
+    python -m tests.benchmarks.zip_compression
+"""
+
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from girder.utility import ziputil
+from girder.utility.filesystem_assetstore_adapter import \
+    FilesystemAssetstoreAdapter
+
+
+def makeFile(path, size):
+    """
+    Write a file of text lines, a quarter of them random bytes, which deflates
+    to roughly half its size.
+    """
+    words = ['girder', 'folder', 'item', 'file', 'assetstore', 'upload']
+    with open(path, 'wb') as f:
+        written = 0
+        while written < size:
+            if random.random() < 0.25:
+                line = os.urandom(64).encode('hex') + '\n'
+            else:
+                line = ' '.join(random.choice(words) for _ in xrange(12)) + \
+                    ' {}\n'.format(random.randint(0, 1 << 30))
+            f.write(line)
+            written += len(line)
+
+
+def timeArchive(adapter, files, sink, compression, workers):
+    start = time.time()
+    zip = ziputil.ZipGenerator('bench', compression=compression,
+                               workers=workers)
+    fileList = ((file['name'], adapter.downloadFile(file, headers=False))
+                for file in files)
+    for data in zip.addFiles(fileList):
+        sink.write(data)
+    sink.write(zip.footer())
+    return time.time() - start, zip.offset
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Time streaming zip archives of a folder.')
+    parser.add_argument('-n', '--count', type=int, default=200,
+                        help='Number of files.')
+    parser.add_argument('-s', '--size', type=int, default=2048,
+                        help='File size in KB.')
+    parser.add_argument('-w', '--workers', type=int, nargs='+',
+                        default=[1, 2, 4, 8],
+                        help='Worker thread counts to compress with.')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='Archives per measurement.')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp()
+    try:
+        adapter = FilesystemAssetstoreAdapter({'_id': None, 'root': root})
+        files = []
+        for i in xrange(args.count):
+            name = 'file{:05d}.txt'.format(i)
+            makeFile(os.path.join(root, name), args.size * 1024)
+            files.append({'name': name, 'path': name,
+                          'size': os.path.getsize(os.path.join(root, name))})
+        megabytes = float(sum(f['size'] for f in files)) / (1024 * 1024)
+
+        rows = [('store', ziputil.STORE, 0), ('deflate', ziputil.DEFLATE, 0)]
+        rows.extend(('deflate x{}'.format(workers), ziputil.DEFLATE, workers)
+                    for workers in args.workers)
+        print '{:>12} {:>10} {:>10} {:>12}'.format(
+            'archive', 'seconds', 'MB/s', 'size MB')
+        with open(os.devnull, 'wb') as sink:
+            for label, compression, workers in rows:
+                seconds, size = min(
+                    timeArchive(adapter, files, sink, compression, workers)
+                    for _ in xrange(args.repeat))
+                print '{:>12} {:>10.3f} {:>10.0f} {:>12.1f}'.format(
+                    label, seconds, megabytes / seconds,
+                    float(size) / (1024 * 1024))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -17,14 +17,18 @@
 #  limitations under the License.
 ###############################################################################
 
+import hashlib
 import json
 import moto
 import os
+import shutil
+import tempfile
 import time
 
 from .. import base
 from .. import mock_s3
 from girder.constants import AssetstoreType, ROOT_DIR
+from girder.utility import assetstore_utilities
 from girder.utility.s3_assetstore_adapter import makeBotoConnectParams
 
 
@@ -185,6 +189,199 @@ class AssetstoreTestCase(base.TestCase):
         current = self.model('assetstore').getCurrent()
         self.assertEqual(current['_id'], secondStore['_id'])
 
+    def testAdapterCache(self):
+        store = self.model('assetstore').createFilesystemAssetstore(
+            'Cached Store', os.path.join(ROOT_DIR, 'tests', 'assetstore',
+                                         'cached'))
+        adapter = assetstore_utilities.getAssetstoreAdapter(store)
+        loaded = self.model('assetstore').load(store['_id'])
+        self.assertIs(
+            assetstore_utilities.getAssetstoreAdapter(loaded), adapter)
+
+        # Saving the assetstore discards its adapter
+        loaded['root'] = os.path.join(ROOT_DIR, 'tests', 'assetstore',
+                                      'cached2')
+        self.model('assetstore').save(loaded)
+        newAdapter = assetstore_utilities.getAssetstoreAdapter(loaded)
+        self.assertIsNot(newAdapter, adapter)
+        self.assertEqual(newAdapter.assetstore['root'], loaded['root'])
+
+        # A copy of the document from before the change doesn't match the
+        # cached adapter either, as happens when another process changed it
+        adapter = assetstore_utilities.getAssetstoreAdapter(store)
+        self.assertIsNot(adapter, newAdapter)
+        self.assertEqual(adapter.assetstore['root'], store['root'])
+
+        self.model('assetstore').remove(loaded)
+        self.assertNotIn(store['_id'], assetstore_utilities._adapterCache)
+
+    def testMigrateAssetstore(self):
+        source = self.model('assetstore').getCurrent()
+        base.dropGridFSDatabase('girder_assetstore_migrate_test')
+        target = self.model('assetstore').createGridFsAssetstore(
+            name='Migration target', db='girder_assetstore_migrate_test')
+        folder = self.model('folder').childFolders(
+            self.admin, 'user', user=self.admin).next()
+        files = {}
+        for name, contents in (('a.txt', 'first file'),
+                               ('b.txt', 'second file'),
+                               ('empty.txt', '')):
+            upload = self.model('upload').createUpload(
+                self.admin, name, 'folder', folder, len(contents),
+                'text/plain')
+            if contents:
+                file = self.model('upload').handleChunk(upload, contents)
+            else:
+                file = self.model('upload').finalizeUpload(upload)
+            files[file['_id']] = contents
+        original = self.model('file').findOne({'name': 'a.txt'})
+        copy = self.model('file').copyFile(original, self.admin)
+        paths = [os.path.join(source['root'], doc['path'])
+                 for doc in self.model('file').find(
+                     {'assetstoreId': source['_id']}, limit=0)]
+
+        # Moving one copy leaves the data that the other still uses
+        self.model('assetstore')._migrateFile(
+            copy, source, target,
+            assetstore_utilities.getAssetstoreAdapter(source),
+            assetstore_utilities.getAssetstoreAdapter(target), True)
+        for path in paths:
+            self.assertTrue(os.path.exists(path))
+        resp = self.request(path='/file/%s/download' % original['_id'],
+                            user=self.admin, isJson=False)
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.collapse_body(), 'first file')
+        files[copy['_id']] = 'first file'
+
+        path = '/assetstore/%s/migrate' % source['_id']
+        resp = self.request(path=path, method='POST', user=self.admin,
+                            params={'targetId': source['_id']})
+        self.assertStatus(resp, 400)
+        self.assertEqual(resp.json['field'], 'targetId')
+
+        resp = self.request(path=path, method='POST', user=self.admin,
+                            params={'targetId': target['_id'], 'workers': 2,
+                                    'removeSource': 'true'})
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json, {
+            'files': 3, 'size': len('first filesecond file'), 'failed': 0})
+        for id, contents in files.iteritems():
+            file = self.model('file').load(id)
+            self.assertEqual(file['assetstoreId'], target['_id'])
+            self.assertNotIn('path', file)
+            self.assertIn('chunkUuid', file)
+            self.assertEqual(file['sha512'], hashlib.sha512(
+                contents).hexdigest())
+            resp = self.request(path='/file/%s/download' % id,
+                                user=self.admin, isJson=False)
+            self.assertStatusOk(resp)
+            self.assertEqual(resp.collapse_body(), contents)
+        for path in paths:
+            self.assertFalse(os.path.exists(path))
+
+        # Running it again finds nothing left to move
+        resp = self.request(path='/assetstore/%s/migrate' % source['_id'],
+                            method='POST', user=self.admin,
+                            params={'targetId': target['_id']})
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['files'], 0)
+
+    def testImportData(self):
+        assetstore = self.model('assetstore').getCurrent()
+        folder = self.model('folder').childFolders(
+            self.admin, 'user', user=self.admin).next()
+        importRoot = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(importRoot, 'sub', 'deeper'))
+            contents = {
+                'top.txt': 'top level',
+                os.path.join('sub', 'a.txt'): 'first file',
+                os.path.join('sub', 'deeper', 'b.txt'): 'second file',
+                os.path.join('sub', 'deeper', 'C.txt'): 'third file'
+            }
+            for relpath, data in contents.iteritems():
+                with open(os.path.join(importRoot, relpath), 'wb') as f:
+                    f.write(data)
+
+            path = '/assetstore/%s/import' % assetstore['_id']
+            params = {
+                'importPath': os.path.join(importRoot, 'missing'),
+                'destinationId': folder['_id']
+            }
+            resp = self.request(path=path, method='POST', user=self.admin,
+                                params=params)
+            self.assertStatus(resp, 400)
+            self.assertEqual(resp.json['field'], 'importPath')
+
+            params['importPath'] = importRoot
+            resp = self.request(path=path, method='POST', user=self.admin,
+                                params=params)
+            self.assertStatusOk(resp)
+            self.assertEqual(resp.json, {
+                'folders': 2, 'files': 4, 'updated': 0, 'unchanged': 0})
+
+            sub = self.model('folder').findOne({
+                'parentId': folder['_id'], 'name': 'sub'})
+            deeper = self.model('folder').findOne({
+                'parentId': sub['_id'], 'name': 'deeper'})
+            item = self.model('item').findOne({
+                'folderId': deeper['_id'], 'name': 'b.txt'})
+            self.assertEqual(item['size'], len('second file'))
+            self.assertEqual(item['ancestors'][-1], deeper['_id'])
+            self.assertEqual(self.model('folder').load(
+                sub['_id'], force=True)['size'], len('first file'))
+
+            # Imported items are listed in the same order as other items
+            resp = self.request(path='/item', user=self.admin, params={
+                'folderId': deeper['_id']})
+            self.assertStatusOk(resp)
+            self.assertEqual([doc['name'] for doc in resp.json],
+                             ['b.txt', 'C.txt'])
+
+            files = list(self.model('file').find({'imported': True}))
+            self.assertEqual(len(files), 4)
+            for file in files:
+                self.assertTrue(os.path.isabs(file['path']))
+                relpath = os.path.relpath(file['path'], importRoot)
+                resp = self.request(path='/file/%s/download' % file['_id'],
+                                    user=self.admin, isJson=False)
+                self.assertStatusOk(resp)
+                self.assertEqual(resp.collapse_body(), contents[relpath])
+
+            # Checksums are computed in the background
+            for _ in xrange(100):
+                files = list(self.model('file').find({
+                    'imported': True, 'sha512': {'$exists': True}}))
+                if len(files) == 4:
+                    break
+                time.sleep(0.1)
+            for file in files:
+                relpath = os.path.relpath(file['path'], importRoot)
+                self.assertEqual(file['sha512'], hashlib.sha512(
+                    contents[relpath]).hexdigest())
+
+            # Importing again only updates the file that changed
+            changed = os.path.join(importRoot, 'sub', 'a.txt')
+            with open(changed, 'wb') as f:
+                f.write('first file, changed')
+            st = os.stat(changed)
+            os.utime(changed, (st.st_atime, st.st_mtime + 10))
+            resp = self.request(path=path, method='POST', user=self.admin,
+                                params=params)
+            self.assertStatusOk(resp)
+            self.assertEqual(resp.json, {
+                'folders': 0, 'files': 0, 'updated': 1, 'unchanged': 3})
+            file = self.model('file').findOne({'path': changed})
+            self.assertEqual(file['size'], len('first file, changed'))
+            self.assertEqual(self.model('folder').load(
+                sub['_id'], force=True)['size'], len('first file, changed'))
+
+            # Deleting an imported file leaves its data on disk
+            self.model('file').remove(file)
+            self.assertTrue(os.path.exists(changed))
+        finally:
+            shutil.rmtree(importRoot)
+
     def testGridFSAssetstoreAdapter(self):
         resp = self.request(path='/assetstore', method='GET', user=self.admin)
         self.assertStatusOk(resp)
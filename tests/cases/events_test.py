@@ -17,6 +17,7 @@
 #  limitations under the License.
 ###############################################################################
 
+import threading
 import time
 import unittest
 
@@ -91,6 +92,38 @@ class EventsTestCase(unittest.TestCase):
         self.assertFalse(event.propagate)
         self.assertEqual(event.responses, [{'foo': 'bar'}])
 
+    def testHandlerOrderAndStats(self):
+        name = '_test.event'
+        calls = []
+        events.bind(name, 'second', lambda e: calls.append('second'))
+        events.bind(name, 'third', lambda e: calls.append('third'))
+        events.bind(name, 'first', lambda e: calls.append('first'),
+                    priority=10)
+        events.bind(name, 'last', lambda e: calls.append('last'), priority=-1)
+
+        events.resetStats()
+        events.trigger(name)
+        self.assertEqual(calls, ['first', 'second', 'third', 'last'])
+
+        events.unbind(name, 'first')
+        events.trigger(name)
+        self.assertEqual(calls[4:], ['second', 'third', 'last'])
+
+        stats = events.getStats()
+        self.assertEqual(stats[name]['count'], 2)
+        self.assertEqual(stats[name]['handlers']['first']['count'], 1)
+        self.assertEqual(stats[name]['handlers']['second']['count'], 2)
+        self.assertTrue(stats[name]['seconds'] >= 0)
+
+        # Events with no listeners share a result and are not counted
+        event = events.trigger('_test.unbound', {'amount': 1})
+        self.assertIs(event, events.trigger('_test.other'))
+        self.assertFalse(event.defaultPrevented)
+        self.assertEqual(len(event.responses), 0)
+        event.preventDefault()
+        self.assertFalse(events.trigger('_test.unbound').defaultPrevented)
+        self.assertNotIn('_test.unbound', events.getStats())
+
     def testAsyncEvents(self):
         name, failname = '_test.event', '_test.failure'
         handlerName = '_test.handler'
@@ -129,3 +162,100 @@ class EventsTestCase(unittest.TestCase):
         self.assertEqual(events.daemon.eventQueue.qsize(), 0)
         self.assertEqual(self.ctr, 3)
         self.assertEqual(self.responses, ['foo'])
+
+    def _waitFor(self, condition):
+        startTime = time.time()
+        while not condition():
+            if time.time() - startTime > 15:
+                self.fail('Timed out waiting for condition.')
+            time.sleep(0.01)
+
+    def testAsyncExecutorPolicies(self):
+        name, waitname = '_test.event', '_test.wait'
+        gate = threading.Event()
+        events.bind(name, '_test.handler', self._increment)
+        events.bind(waitname, '_test.handler', lambda e: gate.wait())
+        executor = events.AsyncEventsExecutor(
+            workers=1, queueSize=1, fullPolicy=events.AsyncEventsExecutor.DROP)
+
+        # Until the workers start, a full queue is handled inline
+        executor.trigger(name, {'amount': 1})
+        executor.trigger(name, {'amount': 2})
+        self.assertEqual(self.ctr, 2)
+        self.assertEqual(executor.getStats()['queued'], 1)
+        self.assertEqual(executor.getStats()['inline'], 1)
+
+        # Occupy the only worker, fill the queue, and overflow it
+        executor.start()
+        self._waitFor(lambda: self.ctr == 3)
+        executor.trigger(waitname)
+        self._waitFor(lambda: executor.getStats()['running'] == 1 and
+                      executor.getStats()['queued'] == 0)
+        executor.trigger(name, {'amount': 10})
+        executor.trigger(name, {'amount': 100})
+        self.assertEqual(executor.getStats()['dropped'], 1)
+
+        # Stopping drains the queue before the workers exit
+        gate.set()
+        executor.stop()
+        self.assertEqual(self.ctr, 13)
+        stats = executor.getStats()
+        self.assertEqual(stats['workers'], 0)
+        self.assertEqual(stats['handled'], 4)
+        self.assertEqual(stats['events'][name]['count'], 3)
+
+    def testAsyncExecutorConcurrency(self):
+        name = '_test.wait'
+        gate = threading.Event()
+        events.bind(name, '_test.handler', lambda e: gate.wait())
+        executor = events.AsyncEventsExecutor(
+            workers=3, queueSize=10, concurrency={name: 1})
+        executor.start()
+
+        executor.trigger(name)
+        executor.trigger(name)
+        self._waitFor(lambda: executor.getStats()['deferred'] == 1)
+        self.assertEqual(executor.getStats()['running'], 1)
+
+        gate.set()
+        executor.stop()
+        self.assertEqual(executor.getStats()['handled'], 2)
+
+    def testAsyncExecutorStopTimeout(self):
+        name, waitname = '_test.event', '_test.wait'
+        gate = threading.Event()
+        events.bind(name, '_test.handler', self._increment)
+        events.bind(waitname, '_test.handler', lambda e: gate.wait())
+        executor = events.AsyncEventsExecutor(
+            workers=1, queueSize=4, drainTimeout=0.1)
+        executor.start()
+
+        executor.trigger(waitname)
+        self._waitFor(lambda: executor.getStats()['running'] == 1)
+        for amount in (1, 10, 100):
+            executor.trigger(name, {'amount': amount})
+
+        # Events still pending after the drain timeout are discarded instead
+        # of being handled ahead of the stop sentinel.
+        executor.stop()
+        self.assertEqual(executor.getStats()['dropped'], 3)
+
+        # The worker exits as soon as its current event is done
+        gate.set()
+        self._waitFor(lambda: executor.getStats()['queued'] == 0)
+        self.assertEqual(executor.getStats()['handled'], 1)
+        self.assertEqual(self.ctr, 0)
+
+    def testAsyncUnboundEventCallback(self):
+        name = '_test.unbound'
+        received = []
+        executor = events.AsyncEventsExecutor(workers=1, queueSize=1)
+        executor.start()
+
+        # The callback gets its own event even when nothing is bound
+        executor.trigger(name, {'amount': 1}, lambda e: received.append(e))
+        executor.stop()
+        self.assertEqual(len(received), 1)
+        self.assertEqual(received[0].name, name)
+        self.assertEqual(received[0].info, {'amount': 1})
+        self.assertEqual(received[0].responses, [])
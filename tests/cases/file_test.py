@@ -28,6 +28,7 @@ from .. import base
 
 from girder.constants import SettingKey
 from girder.models import getDbConnection
+from girder.utility import config
 
 
 def setUpModule():
@@ -233,6 +234,132 @@ class FileTestCase(base.TestCase):
                              'text/plain;charset=utf-8')
         self.assertEqual(contents, resp.collapse_body())
 
+        if contents:
+            self._testDownloadRanges(file, contents)
+
+    def _testDownloadRanges(self, file, contents):
+        """
+        Test HTTP range and conditional requests against a downloaded file.
+        """
+        path = '/file/%s/download' % str(file['_id'])
+        size = len(contents)
+
+        def download(*headers):
+            return self.request(path=path, method='GET', user=self.user,
+                                isJson=False, additionalHeaders=headers)
+
+        resp = download()
+        self.assertStatusOk(resp)
+        etag = resp.headers['ETag']
+        self.assertEqual(etag, '"%s"' % sha512(contents).hexdigest())
+        self.assertEqual(resp.headers['Accept-Ranges'], 'bytes')
+        lastModified = resp.headers['Last-Modified']
+
+        # A single range, including one crossing a chunk boundary
+        ranges = [(1, 3)]
+        if size > len(chunk1) + 1:
+            ranges.append((len(chunk1) - 2, len(chunk1) + 1))
+        for start, end in ranges:
+            resp = download(('Range', 'bytes=%d-%d' % (start, end)))
+            self.assertStatus(resp, 206)
+            self.assertEqual(resp.headers['Content-Range'],
+                             'bytes %d-%d/%d' % (start, end, size))
+            self.assertEqual(resp.collapse_body(), contents[start:end + 1])
+
+        # Suffix and open-ended ranges
+        resp = download(('Range', 'bytes=-%d' % (size - 2)))
+        self.assertStatus(resp, 206)
+        self.assertEqual(resp.collapse_body(), contents[2:])
+        resp = download(('Range', 'bytes=-%d' % (size + 5)))
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.collapse_body(), contents)
+        resp = download(('Range', 'bytes=2-'))
+        self.assertStatus(resp, 206)
+        self.assertEqual(resp.collapse_body(), contents[2:])
+        self.assertEqual(int(resp.headers['Content-Length']), size - 2)
+
+        # Multiple ranges are sent as multipart/byteranges
+        resp = download(('Range', 'bytes=0-0,2-3'))
+        self.assertStatus(resp, 206)
+        contentType = resp.headers['Content-Type']
+        self.assertTrue(contentType.startswith('multipart/byteranges'))
+        boundary = contentType.split('boundary=')[1]
+        body = resp.collapse_body()
+        self.assertEqual(int(resp.headers['Content-Length']), len(body))
+        parts = body.split('--' + boundary)
+        self.assertEqual(len(parts), 4)
+        self.assertEqual(parts[3], '--\r\n')
+        self.assertTrue(parts[1].endswith('\r\n\r\n%s\r\n' % contents[0]))
+        self.assertIn('Content-Range: bytes 2-3/%d' % size, parts[2])
+        self.assertTrue(parts[2].endswith('\r\n\r\n%s\r\n' % contents[2:4]))
+
+        # Overlapping and adjacent ranges are merged, and too many ranges
+        # cause the whole file to be sent
+        resp = download(('Range', 'bytes=2-3,0-1,1-2'))
+        self.assertStatus(resp, 206)
+        self.assertEqual(resp.headers['Content-Range'],
+                         'bytes 0-3/%d' % size)
+        self.assertEqual(resp.collapse_body(), contents[0:4])
+        resp = download(('Range', 'bytes=' + ','.join(['0-0'] * 17)))
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.collapse_body(), contents)
+
+        # Unsatisfiable and malformed ranges
+        resp = download(('Range', 'bytes=%d-' % size))
+        self.assertStatus(resp, 416)
+        self.assertEqual(resp.headers['Content-Range'], 'bytes */%d' % size)
+        resp = download(('Range', 'bytes=3-1'))
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.collapse_body(), contents)
+
+        # Conditional requests
+        resp = download(('If-None-Match', etag))
+        self.assertStatus(resp, 304)
+        self.assertEqual(resp.collapse_body(), '')
+        resp = download(('If-None-Match', '"other"'))
+        self.assertStatusOk(resp)
+        resp = download(('If-Modified-Since', lastModified))
+        self.assertStatus(resp, 304)
+        resp = download(('Range', 'bytes=1-3'), ('If-Range', etag))
+        self.assertStatus(resp, 206)
+        resp = download(('Range', 'bytes=1-3'), ('If-Range', '"other"'))
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.collapse_body(), contents)
+
+    def _testOffloadDownload(self, file, abspath):
+        """
+        Test handing filesystem downloads off to a front-end web server.
+        """
+        path = '/file/%s/download' % str(file['_id'])
+        cfg = config.getConfig()
+        original = cfg.get('downloads', {})
+        try:
+            cfg['downloads'] = {'filesystem_mode': 'x-sendfile'}
+            resp = self.request(path=path, user=self.user, isJson=False,
+                                additionalHeaders=[('Range', 'bytes=1-3')])
+            self.assertStatusOk(resp)
+            self.assertEqual(resp.headers['X-Sendfile'], abspath)
+            self.assertEqual(resp.headers['Content-Type'],
+                             'text/plain;charset=utf-8')
+            self.assertNotIn('Content-Range', resp.headers)
+            self.assertEqual(resp.collapse_body(), '')
+
+            cfg['downloads'] = {'filesystem_mode': 'x-accel-redirect',
+                                'accel_redirect_prefix': '/internal'}
+            resp = self.request(path=path, user=self.user, isJson=False)
+            self.assertStatusOk(resp)
+            self.assertEqual(resp.headers['X-Accel-Redirect'],
+                             '/internal' + abspath)
+
+            # Downloads from an offset are still streamed
+            resp = self.request(path=path, user=self.user, isJson=False,
+                                params={'offset': 1})
+            self.assertStatusOk(resp)
+            self.assertNotIn('X-Accel-Redirect', resp.headers)
+            self.assertEqual(resp.collapse_body(), (chunk1 + chunk2)[1:])
+        finally:
+            cfg['downloads'] = original
+
     def _testDownloadFolder(self):
         """
         Test downloading an entire folder as a zip file.
@@ -330,6 +457,7 @@ class FileTestCase(base.TestCase):
         self.assertStatus(resp, 401)
 
         self._testDownloadFile(file, chunk1 + chunk2)
+        self._testOffloadDownload(file, os.path.join(root, file['path']))
         self._testDownloadFolder()
 
         # Test updating of the file contents
@@ -384,6 +512,37 @@ class FileTestCase(base.TestCase):
         self._testDeleteFile(empty2)
         self.assertFalse(os.path.isfile(abspath))
 
+        # Each stored blob has a count of the files that refer to it
+        empty1 = self._testEmptyUpload('empty1.txt')
+        empty2 = self._testEmptyUpload('empty2.txt')
+        query = {'assetstoreId': self.assetstore['_id'], 'sha512': hash}
+        self.assertEqual(self.model('blob').findOne(query)['refCount'], 2)
+        copy = self.model('file').copyFile(empty1, creator=self.user)
+        self.assertEqual(self.model('blob').findOne(query)['refCount'], 3)
+        self._testDeleteFile(empty1)
+        self.assertEqual(self.model('blob').findOne(query)['refCount'], 2)
+        self.assertTrue(os.path.isfile(abspath))
+
+        # Reconciling rebuilds the counts from the file collection
+        self.model('blob').update(query, {'$set': {'refCount': 7}})
+        info = self.model('blob').reconcile(self.assetstore)
+        self.assertEqual(self.model('blob').findOne(query)['refCount'], 2)
+        self.assertEqual(info['blobs'], self.model('blob').find(
+            {'assetstoreId': self.assetstore['_id']}).count())
+
+        # Listing assetstores reports the data stored for their blobs
+        storage = [store for store in self.model('assetstore').list()
+                   if store['_id'] == self.assetstore['_id']][0]['storage']
+        self.assertEqual(storage, {'blobs': info['blobs'],
+                                   'storedSize': info['storedSize']})
+
+        # Blobs without a record fall back to counting files
+        self.model('blob').removeWithQuery(query)
+        self._testDeleteFile(copy)
+        self.assertTrue(os.path.isfile(abspath))
+        self._testDeleteFile(empty2)
+        self.assertFalse(os.path.isfile(abspath))
+
     def testGridFsAssetstore(self):
         """
         Test usage of the GridFS assetstore type.
@@ -17,12 +17,16 @@
 #  limitations under the License.
 ###############################################################################
 
+import base64
+import bson.json_util
 import datetime
 import json
 
 from .. import base
 
-from girder.constants import AccessType
+from bson.objectid import ObjectId
+from girder.constants import AccessType, SettingKey
+from girder.models.model_base import AccessException
 from girder.models.notification import ProgressState
 
 
@@ -506,3 +510,228 @@ class FolderTestCase(base.TestCase):
                 'parentType': 'folder',
                 'parentId': str(subFolder['_id'])})
         self.assertStatusOk(resp)
+
+    def testAncestors(self):
+        """
+        Test that the materialized ancestor paths of folders and items are
+        maintained on create and move, and can be rebuilt by the backfill.
+        """
+        folderModel = self.model('folder')
+        itemModel = self.model('item')
+        a = folderModel.createFolder(
+            parent=self.admin, parentType='user', creator=self.admin,
+            name='a')
+        b = folderModel.createFolder(
+            parent=a, parentType='folder', creator=self.admin, name='b')
+        c = folderModel.createFolder(
+            parent=b, parentType='folder', creator=self.admin, name='c')
+        item = itemModel.createItem(
+            name='item', creator=self.admin, folder=c)
+
+        self.assertEqual(a['ancestors'], [self.admin['_id']])
+        self.assertEqual(c['ancestors'],
+                         [self.admin['_id'], a['_id'], b['_id']])
+        self.assertEqual(item['ancestors'],
+                         [self.admin['_id'], a['_id'], b['_id'], c['_id']])
+        self.assertEqual(folderModel.subtreeCount(a), 4)
+
+        # Move b under a collection; its descendants should follow
+        coll = self.model('collection').createCollection(
+            'coll', self.admin)
+        b = folderModel.move(b, coll, 'collection')
+        c = folderModel.load(c['_id'], force=True)
+        item = itemModel.load(item['_id'], force=True)
+        self.assertEqual(b['ancestors'], [coll['_id']])
+        self.assertEqual(c['ancestors'], [coll['_id'], b['_id']])
+        self.assertEqual(item['ancestors'], [coll['_id'], b['_id'], c['_id']])
+        self.assertEqual(c['baseParentId'], coll['_id'])
+        self.assertEqual(item['baseParentType'], 'collection')
+        self.assertEqual(folderModel.subtreeCount(a), 1)
+        self.assertEqual(self.model('collection').subtreeCount(coll), 4)
+
+        # Moving an item picks up the ancestors of its new folder
+        item = itemModel.move(item, a)
+        self.assertEqual(item['ancestors'], [self.admin['_id'], a['_id']])
+
+        # Strip the field from everything, as in a database created before
+        # it existed. Subtrees are walked level by level until the backfill
+        # has rebuilt it.
+        folderModel.update({}, {'$unset': {'ancestors': 1}})
+        itemModel.update({}, {'$unset': {'ancestors': 1}})
+        self.model('setting').unset(SettingKey.ANCESTORS_COMPLETE)
+        self.assertFalse(folderModel.ancestorsComplete())
+        self.assertEqual(folderModel.subtreeCount(a), 2)
+        self.assertEqual(self.model('collection').subtreeCount(coll), 3)
+        folderModel.backfillAncestors(batchSize=1)
+        self.assertTrue(folderModel.ancestorsComplete())
+        self.assertEqual(folderModel.subtreeCount(a), 2)
+        self.assertEqual(self.model('collection').subtreeCount(coll), 3)
+        c = folderModel.find({'_id': c['_id']}).next()
+        item = itemModel.find({'_id': item['_id']}).next()
+        self.assertEqual(c['ancestors'], [coll['_id'], b['_id']])
+        self.assertEqual(item['ancestors'], [self.admin['_id'], a['_id']])
+
+        # Documents without the field get it computed at load() time
+        folderModel.update({'_id': c['_id']}, {'$unset': {'ancestors': 1}})
+        folderModel.load(c['_id'], force=True)
+        c = folderModel.find({'_id': c['_id']}).next()
+        self.assertEqual(c['ancestors'], [coll['_id'], b['_id']])
+
+    def testLoadMany(self):
+        folderModel = self.model('folder')
+        public = folderModel.createFolder(
+            parent=self.admin, parentType='user', creator=self.admin,
+            name='public', public=True)
+        private = folderModel.createFolder(
+            parent=self.admin, parentType='user', creator=self.admin,
+            name='private', public=False)
+        missing = ObjectId()
+
+        # Order is preserved, with None for missing ids
+        docs = folderModel.loadMany(
+            [private['_id'], str(public['_id']), missing, private['_id']],
+            force=True, chunkSize=1)
+        self.assertEqual([d and d['name'] for d in docs],
+                         ['private', 'public', None, 'private'])
+
+        docs = folderModel.loadMany([public['_id']], user=self.user,
+                                    level=AccessType.READ, fields=['name'])
+        self.assertEqual(docs[0]['name'], 'public')
+        self.assertNotHasKeys(docs[0], ('description',))
+
+        self.assertRaises(
+            AccessException, folderModel.loadMany,
+            [public['_id'], private['_id']], user=self.user,
+            level=AccessType.READ)
+
+        # parentsToRoot loads every folder in the path at once
+        child = folderModel.createFolder(
+            parent=private, parentType='folder', creator=self.admin,
+            name='child')
+        grandchild = folderModel.createFolder(
+            parent=child, parentType='folder', creator=self.admin,
+            name='grandchild')
+        path = folderModel.parentsToRoot(grandchild, user=self.admin)
+        self.assertEqual([p['type'] for p in path],
+                         ['user', 'folder', 'folder'])
+        self.assertEqual([p['object']['_id'] for p in path],
+                         [self.admin['_id'], private['_id'], child['_id']])
+        self.assertRaises(AccessException, folderModel.parentsToRoot,
+                          grandchild, user=self.user)
+
+    def testFindWithPermissions(self):
+        folderModel = self.model('folder')
+        group = self.model('group').createGroup('group', self.admin)
+        self.model('group').addUser(group, self.user, level=AccessType.READ)
+        user = self.model('user').load(self.user['_id'], force=True)
+        parent = folderModel.createFolder(
+            parent=self.admin, parentType='user', creator=self.admin,
+            name='parent', public=True)
+
+        folders = [folderModel.createFolder(
+            parent=parent, parentType='folder', creator=self.admin,
+            name='f%d' % i, public=(i == 0)) for i in xrange(4)]
+        folderModel.setUserAccess(folders[1], user, AccessType.WRITE,
+                                  save=True)
+        folderModel.setGroupAccess(folders[2], group, AccessType.READ,
+                                   save=True)
+
+        # The database query must agree with hasAccess in every case
+        for u in (None, user, self.admin):
+            for level in (AccessType.READ, AccessType.WRITE, AccessType.ADMIN):
+                expected = [f['_id'] for f in folderModel.find(
+                    {'parentId': parent['_id']}, limit=0, sort=[('name', 1)])
+                    if folderModel.hasAccess(f, user=u, level=level)]
+                found = [f['_id'] for f in folderModel.findWithPermissions(
+                    {'parentId': parent['_id']}, user=u, level=level,
+                    limit=0, sort=[('name', 1)])]
+                self.assertEqual(found, expected)
+
+        # Offset and limit apply to the visible folders only
+        children = list(folderModel.childFolders(
+            parent, 'folder', user=user, limit=1, offset=1,
+            sort=[('name', 1)]))
+        self.assertEqual([f['name'] for f in children], ['f1'])
+
+        resp = self.request(path='/folder', user=self.user, params={
+            'parentType': 'folder',
+            'parentId': parent['_id'],
+            'sort': 'name',
+            'offset': 2
+        })
+        self.assertStatusOk(resp)
+        self.assertEqual([f['name'] for f in resp.json], ['f2'])
+
+    def testCursorPagination(self):
+        folder = self.model('folder').createFolder(
+            parent=self.admin, parentType='user', creator=self.admin,
+            name='paged')
+        # Duplicate names make sure ties are broken consistently
+        for name in ('c', 'a', 'b', 'a', 'd'):
+            self.model('item').createItem(
+                name=name, creator=self.admin, folder=folder)
+
+        params = {'folderId': folder['_id'], 'limit': 2}
+        resp = self.request(path='/item', user=self.admin, params=dict(
+            params, limit=0))
+        self.assertStatusOk(resp)
+        expected = [item['_id'] for item in resp.json]
+        self.assertEqual(len(expected), 5)
+
+        pages = []
+        cursor = None
+        while True:
+            if cursor:
+                params['cursor'] = cursor
+            resp = self.request(path='/item', user=self.admin, params=params)
+            self.assertStatusOk(resp)
+            pages.append([item['_id'] for item in resp.json])
+            cursor = resp.headers.get('Girder-Next-Cursor')
+            if not cursor:
+                break
+        self.assertEqual([len(page) for page in pages], [2, 2, 1])
+        self.assertEqual(sum(pages, []), expected)
+
+        # Cursors are only valid for the sort order that produced them
+        resp = self.request(path='/item', user=self.admin, params={
+            'folderId': folder['_id'],
+            'cursor': params['cursor'],
+            'sortdir': -1
+        })
+        self.assertStatus(resp, 400)
+        self.assertEqual(
+            resp.json['message'],
+            'The cursor does not match the requested sort order.')
+
+        resp = self.request(path='/item', user=self.admin, params={
+            'folderId': folder['_id'],
+            'cursor': 'bogus'
+        })
+        self.assertStatus(resp, 400)
+        self.assertEqual(resp.json['message'], 'Invalid cursor.')
+
+        # A sparse sort field is paged through with offsets, as documents
+        # missing it would be skipped by a cursor
+        items = list(self.model('item').find(
+            {'folderId': folder['_id']}, sort=[('_id', 1)]))
+        for rank, item in enumerate(items[2:]):
+            self.model('item').setMetadata(item, {'rank': rank})
+        params = {'folderId': folder['_id'], 'limit': 2, 'sort': 'meta.rank',
+                  'sortdir': -1}
+        ids = []
+        for offset in (0, 2, 4):
+            resp = self.request(path='/item', user=self.admin, params=dict(
+                params, offset=offset))
+            self.assertStatusOk(resp)
+            self.assertNotIn('Girder-Next-Cursor', resp.headers)
+            ids.extend(item['_id'] for item in resp.json)
+        self.assertEqual(ids, [str(item['_id']) for item in items[::-1]])
+
+        params['cursor'] = base64.urlsafe_b64encode(bson.json_util.dumps({
+            'sort': [('meta.rank', -1), ('_id', -1)],
+            'after': [None, items[1]['_id']]
+        }))
+        resp = self.request(path='/item', user=self.admin, params=params)
+        self.assertStatus(resp, 400)
+        self.assertEqual(resp.json['message'],
+                         'Keyset pagination values must not be null.')
@@ -17,6 +17,7 @@
 #  limitations under the License.
 ###############################################################################
 
+import datetime
 import json
 import time
 
@@ -139,3 +140,60 @@ class NotificationTestCase(base.TestCase):
         token = resp.json['token']
         tokenDoc = self.model('token').load(token, force=True, objectId=False)
         self._testStream(None, tokenDoc)
+
+    def testBroker(self):
+        from girder.utility.notification_broker import broker
+
+        with broker.subscribe(self.admin) as sub:
+            # Notifications saved in this process are pushed immediately
+            record = self.model('notification').initProgress(
+                self.admin, 'Test', total=10)
+            event = sub.get(timeout=5)
+            self.assertEqual(event['_id'], record['_id'])
+            self.assertEqual(event['data']['current'], 0)
+
+            # Later modifications of the record must not leak into the
+            # published copy
+            self.model('notification').updateProgress(
+                record, save=False, current=5)
+            self.assertEqual(event['data']['current'], 0)
+
+            # Records written by another process are picked up by the watcher
+            doc = dict(record, updated=datetime.datetime.utcnow())
+            del doc['_id']
+            doc['_id'] = self.model('notification').collection.insert(doc)
+            event = sub.get(timeout=5)
+            self.assertIsNotNone(event)
+            self.assertEqual(event['_id'], doc['_id'])
+            self.assertIsNone(sub.get(timeout=broker.interval * 3))
+
+        self.assertNotIn(('user', self.admin['_id']), broker._subscribers)
+
+    def testProgressWriteBehind(self):
+        with ProgressContext(True, user=self.admin, title='Test', total=100,
+                             interval=0.2) as progress:
+            recordId = progress.progress['_id']
+            for i in xrange(1, 11):
+                progress.update(current=i, message='Step %d' % i)
+
+            # The updates are held in memory until the interval elapses
+            record = self.model('notification').load(recordId)
+            self.assertEqual(record['data']['current'], 0)
+
+            # Then only the latest state is written
+            for _ in xrange(50):
+                record = self.model('notification').load(recordId)
+                if record['data']['current'] != 0:
+                    break
+                time.sleep(0.05)
+            self.assertEqual(record['data']['current'], 10)
+            self.assertEqual(record['data']['message'], 'Step 10')
+            self.assertEqual(record['data']['title'], 'Test')
+
+            progress.interval = 1000
+            progress.update(increment=5)
+
+        # Exiting flushes the pending update along with the final state
+        record = self.model('notification').load(recordId)
+        self.assertEqual(record['data']['current'], 15)
+        self.assertEqual(record['data']['state'], ProgressState.SUCCESS)
@@ -21,17 +21,21 @@ import datetime
 import io
 import json
 import os
+import tarfile
 import urllib
 import zipfile
+import zlib
 
 from .. import base
 
 import girder.utility.ziputil
 from girder.models.notification import ProgressState
+from girder.utility import config
+from girder.utility.s3_assetstore_adapter import botoConnectS3
 
 
 def setUpModule():
-    base.startServer()
+    base.startServer(mockS3=True)
 
 
 def tearDownModule():
@@ -186,6 +190,35 @@ class ResourceTestCase(base.TestCase):
             [item['name'], name]))
         return (file, path, contents)
 
+    def _createS3Folder(self):
+        """
+        Create a folder of the admin user holding one file in an S3
+        assetstore, whose downloads redirect to S3. The file has a CRC-32, as
+        it would once the download cache has read it.
+
+        :returns: the folder and the contents of the file.
+        """
+        assetstore = self.model('assetstore').createS3Assetstore(
+            name='S3 Assetstore', bucket='bucketname', prefix='resources',
+            accessKeyId='someKey', secret='someSecret',
+            service=base.mockS3Server.service)
+        contents = os.urandom(8000)
+        conn = botoConnectS3(base.mockS3Server.botoConnect)
+        bucket = conn.lookup(bucket_name='bucketname', validate=True)
+        bucket.new_key('resources/s3file').set_contents_from_string(contents)
+
+        folder = self.model('folder').createFolder(
+            self.admin, 'S3', parentType='user', creator=self.admin)
+        item = self.model('item').createItem('S3 Item', self.admin, folder)
+        file = self.model('file').createFile(
+            creator=self.admin, item=item, name='S3 File',
+            size=len(contents), assetstore=assetstore,
+            mimeType='application/octet-stream', saveFile=False)
+        file['s3Key'] = 'resources/s3file'
+        file['crc32'] = '%08x' % (zlib.crc32(contents) & 0xffffffff)
+        self.model('file').save(file)
+        return folder, contents
+
     def testDownloadResources(self):
         self._createFiles()
         resourceList = {
@@ -298,6 +331,180 @@ class ResourceTestCase(base.TestCase):
         self.assertStatusOk(resp)
         self.assertEqual(len(resp.json), 0)
 
+    def testDownloadCompressedResources(self):
+        self._createFiles()
+        resourceList = {
+            'collection': [str(self.collection['_id'])],
+            'user': [str(self.admin['_id'])]
+            }
+        cfg = config.getConfig()
+        downloads = cfg.get('downloads')
+        for workers in (0, 2):
+            cfg['downloads'] = dict(downloads or {}, zip_workers=workers,
+                                    zip_compression='deflate')
+            try:
+                resp = self.request(
+                    path='/resource/download', method='GET', user=self.admin,
+                    params={
+                        'resources': json.dumps(resourceList),
+                        'includeMetadata': True
+                    }, isJson=False)
+                self.assertStatusOk(resp)
+                zip = zipfile.ZipFile(io.BytesIO(resp.collapse_body()), 'r')
+            finally:
+                if downloads is None:
+                    del cfg['downloads']
+                else:
+                    cfg['downloads'] = downloads
+            self.assertTrue(zip.testzip() is None)
+            self.assertHasKeys(self.expectedZip, zip.namelist())
+            self.assertHasKeys(zip.namelist(), self.expectedZip)
+            for info in zip.infolist():
+                self.assertEqual(info.compress_type, zipfile.ZIP_DEFLATED)
+                self.assertEqual(self.expectedZip[info.filename],
+                                 zip.read(info))
+
+    def testResumableZipDownload(self):
+        self._createFiles()
+        params = {
+            'resources': json.dumps({
+                'collection': [str(self.collection['_id'])],
+                'user': [str(self.admin['_id'])]
+            }),
+            'includeMetadata': True
+        }
+        # Uploaded files have a CRC-32, so the archive's layout is known
+        resp = self.request(path='/resource/download', method='GET',
+                            user=self.admin, params=params, isJson=False)
+        self.assertStatusOk(resp)
+        body = resp.collapse_body()
+        self.assertEqual(int(resp.headers['Content-Length']), len(body))
+        self.assertEqual(resp.headers['Accept-Ranges'], 'bytes')
+        etag = resp.headers['ETag']
+        zip = zipfile.ZipFile(io.BytesIO(body), 'r')
+        self.assertTrue(zip.testzip() is None)
+        self.assertHasKeys(zip.namelist(), self.expectedZip)
+        for info in zip.infolist():
+            self.assertEqual(info.compress_type, zipfile.ZIP_STORED)
+            self.assertEqual(self.expectedZip[info.filename], zip.read(info))
+
+        # Resume the download partway through
+        resp = self.request(
+            path='/resource/download', method='GET', user=self.admin,
+            params=params, isJson=False,
+            additionalHeaders=[('Range', 'bytes=100-'), ('If-Range', etag)])
+        self.assertStatus(resp, 206)
+        self.assertEqual(resp.headers['Content-Range'], 'bytes 100-%d/%d' % (
+            len(body) - 1, len(body)))
+        self.assertEqual(resp.collapse_body(), body[100:])
+
+        # A stale entity tag gets the whole archive
+        resp = self.request(
+            path='/resource/download', method='GET', user=self.admin,
+            params=params, isJson=False,
+            additionalHeaders=[('Range', 'bytes=100-'),
+                               ('If-Range', '"stale"')])
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.collapse_body(), body)
+
+        resp = self.request(
+            path='/folder/%s/download' % self.adminPublicFolder['_id'],
+            method='GET', user=self.admin, isJson=False)
+        self.assertStatusOk(resp)
+        body = resp.collapse_body()
+        self.assertEqual(int(resp.headers['Content-Length']), len(body))
+        resp = self.request(
+            path='/folder/%s/download' % self.adminPublicFolder['_id'],
+            method='GET', user=self.admin, isJson=False,
+            additionalHeaders=[('Range', 'bytes=10-49')])
+        self.assertStatus(resp, 206)
+        self.assertEqual(resp.collapse_body(), body[10:50])
+
+        # Files in S3 are read from S3 rather than redirected to
+        folder, contents = self._createS3Folder()
+        path = '/folder/%s/download' % folder['_id']
+        resp = self.request(path=path, method='GET', user=self.admin,
+                            isJson=False)
+        self.assertStatusOk(resp)
+        body = resp.collapse_body()
+        self.assertEqual(int(resp.headers['Content-Length']), len(body))
+        zip = zipfile.ZipFile(io.BytesIO(body), 'r')
+        self.assertTrue(zip.testzip() is None)
+        self.assertEqual(zip.read('S3/S3 Item/S3 File'), contents)
+        resp = self.request(path=path, method='GET', user=self.admin,
+                            isJson=False,
+                            additionalHeaders=[('Range', 'bytes=100-5099')])
+        self.assertStatus(resp, 206)
+        self.assertEqual(resp.collapse_body(), body[100:5100])
+
+    def testDownloadTarResources(self):
+        self._createFiles()
+        params = {
+            'resources': json.dumps({
+                'collection': [str(self.collection['_id'])],
+                'user': [str(self.admin['_id'])]
+            }),
+            'includeMetadata': True,
+            'format': 'rar'
+        }
+        resp = self.request(path='/resource/download', method='GET',
+                            user=self.admin, params=params, isJson=False)
+        self.assertStatus(resp, 400)
+
+        for format, mode in (('tar', 'r'), ('tar.gz', 'r:gz')):
+            params['format'] = format
+            resp = self.request(path='/resource/download', method='GET',
+                                user=self.admin, params=params, isJson=False)
+            self.assertStatusOk(resp)
+            self.assertEqual(resp.headers['Content-Disposition'],
+                             'attachment; filename="Resources.%s"' % format)
+            body = resp.collapse_body()
+            if format == 'tar':
+                self.assertEqual(resp.headers['Content-Type'],
+                                 'application/x-tar')
+                self.assertEqual(int(resp.headers['Content-Length']),
+                                 len(body))
+            else:
+                self.assertEqual(resp.headers['Content-Type'],
+                                 'application/gzip')
+            tar = tarfile.open(fileobj=io.BytesIO(body), mode=mode)
+            names = tar.getnames()
+            self.assertHasKeys(self.expectedZip, names)
+            self.assertHasKeys(names, self.expectedZip)
+            for name in names:
+                self.assertEqual(self.expectedZip[name],
+                                 tar.extractfile(name).read())
+
+        resp = self.request(
+            path='/folder/%s/download' % self.adminPublicFolder['_id'],
+            method='GET', user=self.admin, isJson=False,
+            params={'format': 'tar'})
+        self.assertStatusOk(resp)
+        tar = tarfile.open(fileobj=io.BytesIO(resp.collapse_body()))
+        self.assertTrue(all(name.startswith('Public/')
+                            for name in tar.getnames()))
+
+        resp = self.request(
+            path='/item/%s/download' % self.items[0]['_id'], method='GET',
+            user=self.admin, isJson=False, params={'format': 'tar.gz'})
+        self.assertStatusOk(resp)
+        tar = tarfile.open(fileobj=io.BytesIO(resp.collapse_body()),
+                           mode='r:gz')
+        self.assertEqual(sorted(tar.getnames()),
+                         ['Item 1/File 1', 'Item 1/File 2'])
+
+        # Files in S3 are read from S3 rather than redirected to
+        folder, contents = self._createS3Folder()
+        resp = self.request(
+            path='/folder/%s/download' % folder['_id'], method='GET',
+            user=self.admin, isJson=False, params={'format': 'tar'})
+        self.assertStatusOk(resp)
+        body = resp.collapse_body()
+        self.assertEqual(int(resp.headers['Content-Length']), len(body))
+        tar = tarfile.open(fileobj=io.BytesIO(body))
+        self.assertEqual(
+            tar.extractfile('S3/S3 Item/S3 File').read(), contents)
+
     def testDeleteResources(self):
         # Some of the deletes were tested with the downloads.
         self._createFiles(user=self.user)
@@ -18,6 +18,7 @@
 ###############################################################################
 
 from .. import base
+from girder import events
 from girder.api import access
 from girder.api.describe import Description
 from girder.api.rest import Resource, RestException
@@ -84,6 +85,26 @@ class RoutesTestCase(base.TestCase):
         r = dummy.handleRoute('PATCH', ('guid', 'patchy'), {})
         self.assertEqual(r, {'id': 'guid', 'params': {}})
 
+        # The literal branch is preferred, but falls back to the wildcard
+        r = dummy.handleRoute('GET', ('foo', 'admin'), {})
+        self.assertEqual(r, {'wc1': 'foo', 'params': {}})
+        r = dummy.handleRoute('GET', ('literal1', 'admin'), {})
+        self.assertEqual(r, {'wc1': 'literal1', 'params': {}})
+
+        # Events are named after the matched route
+        fired = []
+        events.bind('rest.get.routes_test/:wc1/:wc2.before', 'test',
+                    lambda e: fired.append(e.info['wc2']))
+        dummy.handleRoute('GET', ('a', 'b'), {})
+        events.unbind('rest.get.routes_test/:wc1/:wc2.before', 'test')
+        self.assertEqual(fired, ['b'])
+
+        # Removing a literal route exposes the wildcard route behind it
+        dummy.removeRoute('GET', ('literal1', 'literal2'), dummy.handler)
+        r = dummy.handleRoute('GET', ('literal1', 'literal2'), {})
+        self.assertEqual(r, {'wc1': 'literal1', 'wc2': 'literal2',
+                             'params': {}})
+
         # Add a new route with a new method
         dummy.route('DUMMY', (':id', 'dummy'), dummy.handler)
         r = dummy.handleRoute('DUMMY', ('guid', 'dummy'), {})
@@ -25,6 +25,7 @@ from subprocess import check_output, CalledProcessError
 from .. import base
 from girder.api.describe import API_VERSION
 from girder.constants import SettingKey, SettingDefault, ROOT_DIR
+from girder.models.model_base import identityMap
 from girder.utility import config
 
 
@@ -74,6 +75,54 @@ class SystemTestCase(base.TestCase):
             self.assertEqual(resp.json['SHA'], sha)
             self.assertEqual(sha.find(resp.json['shortSHA']), 0)
 
+    def testIdentityMap(self):
+        folder = self.model('folder').createFolder(
+            parent=self.users[0], parentType='user', creator=self.users[0],
+            name='Identity')
+
+        # Outside of a request nothing is cached or counted
+        counts = (identityMap.hits, identityMap.misses)
+        self.model('folder').load(folder['_id'], force=True)
+        self.model('folder').load(folder['_id'], force=True)
+        self.assertEqual((identityMap.hits, identityMap.misses), counts)
+
+        identityMap.begin()
+        try:
+            doc = self.model('folder').load(folder['_id'], force=True)
+            doc['name'] = 'changed'
+            doc = self.model('folder').load(folder['_id'], force=True)
+            self.assertEqual(doc['name'], 'Identity')
+            self.assertEqual((identityMap.hits, identityMap.misses), (1, 1))
+
+            # Saving the document should invalidate it
+            doc['name'] = 'Renamed'
+            self.model('folder').save(doc)
+            doc = self.model('folder').load(folder['_id'], force=True)
+            self.assertEqual(doc['name'], 'Renamed')
+            self.assertEqual((identityMap.hits, identityMap.misses), (1, 2))
+
+            # So should a multi-document update
+            self.model('folder').update({'_id': folder['_id']}, {
+                '$set': {'description': 'updated'}})
+            doc = self.model('folder').load(folder['_id'], force=True)
+            self.assertEqual(doc['description'], 'updated')
+        finally:
+            identityMap.end()
+
+        self.assertFalse(identityMap.enabled)
+
+        resp = self.request(path='/folder/{}'.format(folder['_id']),
+                            user=self.users[0])
+        self.assertStatusOk(resp)
+
+        resp = self.request(path='/system/identity_map', user=self.users[1])
+        self.assertStatus(resp, 403)
+        resp = self.request(path='/system/identity_map', user=self.users[0])
+        self.assertStatusOk(resp)
+        stats = resp.json['rest.get.folder/:id']
+        self.assertEqual(stats['requests'], 1)
+        self.assertHasKeys(stats, ('hits', 'misses'))
+
     def testSettings(self):
         users = self.users
 
@@ -17,13 +17,24 @@
 #  limitations under the License.
 ###############################################################################
 
+import datetime
 import json
 import os
 import re
 import requests
+import shutil
+import tempfile
+import time
+import zlib
 
+from bson.objectid import ObjectId
+from hashlib import md5, sha512
 from .. import base
 from .. import mongo_replicaset
+from girder import events
+from girder.models import upload as upload_model
+from girder.models.model_base import ValidationException
+from girder.utility import config, download_cache, hash_state
 from girder.utility.s3_assetstore_adapter import botoConnectS3
 
 
@@ -244,8 +255,335 @@ class UploadTestCase(base.TestCase):
                             user=self.admin)
         self.assertEqual(resp.json, [])
 
+    def _sendChunk(self, upload, offset, chunk):
+        fields = [('offset', offset), ('uploadId', upload['_id'])]
+        files = [('chunk', 'parallel.txt', chunk)]
+        return self.multipartRequest(
+            path='/file/chunk', user=self.user, fields=fields, files=files)
+
+    def _testParallelUpload(self):
+        """Upload the chunks of a file out of order, including a repeated
+        chunk, and check that the assembled file is correct."""
+        # Chunk offsets must be aligned for GridFS, which uses 2MB pieces
+        chunkSize = 1024 * 1024 * 6
+        chunks = ['a' * chunkSize, 'b' * chunkSize, 'c' * 1000]
+        contents = ''.join(chunks)
+        resp = self.request(
+            path='/file', method='POST', user=self.user, params={
+                'parentType': 'folder',
+                'parentId': self.folder['_id'],
+                'name': 'parallel.txt',
+                'size': len(contents),
+                'mimeType': 'text/plain',
+                'parallel': 'true'
+            })
+        self.assertStatusOk(resp)
+        upload = resp.json
+        self.assertEqual(upload['ranges'], [])
+
+        # Short chunks are still refused unless they end the file
+        resp = self._sendChunk(upload, 0, 'short')
+        self.assertStatus(resp, 400)
+        self.assertEqual(resp.json['message'],
+                         'Chunk is smaller than the minimum size.')
+
+        resp = self._sendChunk(upload, 2 * chunkSize, chunks[2])
+        self.assertStatusOk(resp)
+        resp = self._sendChunk(upload, chunkSize, chunks[1])
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['received'], chunkSize + len(chunks[2]))
+        # Sending a chunk again doesn't count its bytes twice
+        resp = self._sendChunk(upload, chunkSize, chunks[1])
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['received'], chunkSize + len(chunks[2]))
+
+        resp = self.request(path='/file/offset', method='GET', user=self.user,
+                            params={'uploadId': upload['_id']})
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['offset'], 0)
+        self.assertEqual(resp.json['missing'], [[0, chunkSize]])
+
+        # If finalizing fails, the upload can be finalized by a later chunk
+        def failValidation(event):
+            raise ValidationException('Cannot create the item.')
+        events.bind('model.item.validate', '_test.fail', failValidation)
+        try:
+            resp = self._sendChunk(upload, 0, chunks[0])
+        finally:
+            events.unbind('model.item.validate', '_test.fail')
+        self.assertStatus(resp, 400)
+        self.assertEqual(resp.json['message'], 'Cannot create the item.')
+        self.assertNotIn('finalizing',
+                         self.model('upload').load(upload['_id']))
+
+        # A recent claim by another request is respected, but an expired one
+        # is taken over
+        now = datetime.datetime.utcnow()
+        self.model('upload').update(
+            {'_id': ObjectId(upload['_id'])},
+            {'$set': {'finalizing': now}})
+        resp = self._sendChunk(upload, 0, chunks[0])
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['_id'], upload['_id'])
+        self.model('upload').update(
+            {'_id': ObjectId(upload['_id'])},
+            {'$set': {'finalizing': now - datetime.timedelta(
+                seconds=upload_model.FINALIZE_TIMEOUT + 1)}})
+        stale = self.model('upload').load(upload['_id'])
+
+        resp = self._sendChunk(upload, 0, chunks[0])
+        self.assertStatusOk(resp)
+        file = resp.json
+        self.assertEqual(file['size'], len(contents))
+        self.assertEqual(file['sha512'], sha512(contents).hexdigest())
+        self.assertIsNone(self.model('upload').load(upload['_id']))
+
+        # A chunk sent again after the upload is finalized is refused, even
+        # when it races with the request that finalized it
+        resp = self._sendChunk(upload, 2 * chunkSize, chunks[2])
+        self.assertStatus(resp, 400)
+        with self.assertRaises(ValidationException) as cm:
+            self.model('upload').handleChunk(
+                stale, chunks[2], 2 * chunkSize)
+        self.assertEqual(str(cm.exception), 'Upload no longer exists.')
+
+        resp = self.request(path='/file/%s/download' % file['_id'],
+                            method='GET', user=self.user, isJson=False)
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.collapse_body(), contents)
+
+    def _uploadContents(self, user, folder, name, contents):
+        resp = self.request(
+            path='/file', method='POST', user=user, params={
+                'parentType': 'folder',
+                'parentId': folder['_id'],
+                'name': name,
+                'size': len(contents)
+            })
+        self.assertStatusOk(resp)
+        resp = self.multipartRequest(
+            path='/file/chunk', user=user,
+            fields=[('offset', 0), ('uploadId', resp.json['_id'])],
+            files=[('chunk', name, contents)])
+        self.assertStatusOk(resp)
+        return resp.json
+
+    def _testUploadFromHash(self):
+        """Create files from data the server already has, giving only its
+        checksum and size."""
+        contents = 'contents known by their hash'
+        params = {
+            'parentType': 'folder',
+            'parentId': self.folder['_id'],
+            'name': 'from_hash.txt',
+            'size': len(contents),
+            'mimeType': 'text/plain',
+            'sha512': sha512(contents).hexdigest()
+        }
+        # Nothing has this data yet, so an upload is started
+        resp = self.request(path='/file', method='POST', user=self.user,
+                            params=params)
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['received'], 0)
+
+        self._uploadContents(self.user, self.folder, 'original.txt', contents)
+        resp = self.request(path='/file', method='POST', user=self.user,
+                            params=params)
+        self.assertStatusOk(resp)
+        file = resp.json
+        self.assertEqual(file['name'], 'from_hash.txt')
+        self.assertEqual(file['size'], len(contents))
+        resp = self.request(path='/file/%s/download' % file['_id'],
+                            method='GET', user=self.user, isJson=False)
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.collapse_body(), contents)
+
+        # A user who can't read any file with the data must upload it
+        privateFolder = self.model('folder').createFolder(
+            self.admin, 'Private', parentType='user', public=False,
+            creator=self.admin)
+        secret = 'secret data'
+        self._uploadContents(self.admin, privateFolder, 'secret.txt', secret)
+        params['size'] = len(secret)
+        params['sha512'] = sha512(secret).hexdigest()
+        resp = self.request(path='/file', method='POST', user=self.user,
+                            params=params)
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['received'], 0)
+
+        params['sha512'] = '../../etc'
+        resp = self.request(path='/file', method='POST', user=self.user,
+                            params=params)
+        self.assertStatus(resp, 400)
+        self.assertEqual(resp.json['message'], 'Invalid SHA-512 checksum.')
+
+    def _testRawChunkUpload(self):
+        """Upload chunks as the raw request body rather than as a field of a
+        multipart form."""
+        contents = Chunk1 + Chunk2
+        resp = self.request(
+            path='/file', method='POST', user=self.user, params={
+                'parentType': 'folder',
+                'parentId': self.folder['_id'],
+                'name': 'raw.txt',
+                'size': len(contents)
+            })
+        self.assertStatusOk(resp)
+        upload = resp.json
+
+        # The chunk is required, in one form or the other
+        resp = self.request(
+            path='/file/chunk', method='POST', user=self.user,
+            params={'offset': 0, 'uploadId': upload['_id']})
+        self.assertStatus(resp, 400)
+        self.assertEqual(resp.json['message'],
+                         'Parameter "chunk" is required.')
+
+        offset = 0
+        for chunk in (Chunk1, Chunk2):
+            resp = self.request(
+                path='/file/chunk', method='POST', user=self.user,
+                params={'offset': offset, 'uploadId': upload['_id']},
+                body=chunk, type='application/octet-stream')
+            self.assertStatusOk(resp)
+            offset += len(chunk)
+        file = resp.json
+        self.assertEqual(file['size'], len(contents))
+        self.assertEqual(file['sha512'], sha512(contents).hexdigest())
+
+        resp = self.request(path='/file/%s/download' % file['_id'],
+                            method='GET', user=self.user, isJson=False)
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.collapse_body(), contents)
+
+    def _testResumedHashes(self):
+        """Upload a file whose checksum state is lost between chunks, as
+        when chunks reach different server processes, with extra checksums
+        configured."""
+        cfg = config.getConfig()
+        cfg['uploads'] = {'extra_hashes': ['md5']}
+        try:
+            resp = self.request(
+                path='/file', method='POST', user=self.user, params={
+                    'parentType': 'folder',
+                    'parentId': self.folder['_id'],
+                    'name': 'resumed.txt',
+                    'size': 2 * len(Chunk1) + len(Chunk2)
+                })
+            self.assertStatusOk(resp)
+            upload = resp.json
+            resp = self._sendChunk(upload, 0, Chunk1)
+            self.assertStatusOk(resp)
+            self.assertEqual(resp.json['ingest']['chunks'], 1)
+            self.assertEqual(resp.json['ingest']['bytes'], len(Chunk1))
+
+            # Once the hasher is lost, chunks are stored without hashing and
+            # the checksums are computed when the upload is finalized
+            hash_state._live.clear()
+            resp = self._sendChunk(upload, len(Chunk1), Chunk2)
+            self.assertStatusOk(resp)
+            self.assertTrue(resp.json['hashState']['stale'])
+            resp = self._sendChunk(upload, len(Chunk1) + len(Chunk2), Chunk1)
+            self.assertStatusOk(resp)
+            file = resp.json
+            contents = Chunk1 + Chunk2 + Chunk1
+            self.assertEqual(file['sha512'], sha512(contents).hexdigest())
+            self.assertEqual(file['crc32'], '%08x' % (
+                zlib.crc32(contents) & 0xffffffff))
+            self.assertEqual(file['md5'], md5(contents).hexdigest())
+        finally:
+            del cfg['uploads']
+
+    def _testDownloadCache(self):
+        """Download a file from S3 through the local download cache."""
+        cacheRoot = tempfile.mkdtemp()
+        cfg = config.getConfig()
+        downloads = cfg.get('downloads')
+        cfg['downloads'] = dict(downloads or {}, cache_root=cacheRoot,
+                                cache_capacity=1024)
+        try:
+            self._uploadFile('cached.txt')
+            file = self.model('file').findOne({'name': 'cached.txt'})
+            self.assertNotIn('sha512', file)
+            contents = Chunk1 + Chunk2
+            path = '/file/%s/download' % file['_id']
+
+            # The first download is redirected to S3 and fills the cache
+            resp = self.request(path=path, user=self.user, isJson=False)
+            self.assertStatus(resp, 303)
+            cache = download_cache.getCache()
+            for _ in xrange(50):
+                if cache.stats()['fills']:
+                    break
+                time.sleep(0.1)
+            stats = cache.stats()
+            self.assertEqual(stats['fills'], 1)
+            self.assertEqual(stats['misses'], 1)
+            self.assertEqual(stats['size'], len(contents))
+            file = self.model('file').load(file['_id'], force=True)
+            self.assertEqual(file['sha512'], sha512(contents).hexdigest())
+
+            resp = self.request(path=path, user=self.user, isJson=False)
+            self.assertStatusOk(resp)
+            self.assertEqual(resp.collapse_body(), contents)
+            resp = self.request(path=path, user=self.user, isJson=False,
+                                additionalHeaders=[('Range', 'bytes=6-')])
+            self.assertStatus(resp, 206)
+            self.assertEqual(resp.collapse_body(), Chunk2)
+            # Several ranges are read from the same cached data
+            resp = self.request(path=path, user=self.user, isJson=False,
+                                additionalHeaders=[('Range', 'bytes=0-4,6-')])
+            self.assertStatus(resp, 206)
+            body = resp.collapse_body()
+            self.assertIn(Chunk1[:5], body)
+            self.assertIn(Chunk2, body)
+
+            resp = self.request(path='/system/download_cache',
+                                user=self.admin)
+            self.assertStatusOk(resp)
+            self.assertTrue(resp.json['enabled'])
+            self.assertEqual(resp.json['hits'], 3)
+            self.assertEqual(resp.json['misses'], 1)
+
+            # The handle is closed once its stream has been read
+            handle = cache.open(file)
+            stream = download_cache.closeAfter(download_cache.streamFile(
+                handle, None, file, headers=False), handle)
+            self.assertEqual(''.join(stream()), contents)
+            self.assertTrue(handle.closed)
+
+            # Filling beyond the capacity evicts the least recently used data
+            class Adapter(object):
+                def readFile(self, file):
+                    return lambda: [file['data']]
+
+            cache = download_cache.DownloadCache(cacheRoot, 2 * len(contents))
+            self.assertEqual(cache.stats()['entries'], 1)
+            for data in ('x' * len(contents), 'y' * len(contents)):
+                doc = {'_id': data[0], 'data': data, 'size': len(data),
+                       'sha512': sha512(data).hexdigest()}
+                cache._fill(doc['sha512'], doc, Adapter())
+            stats = cache.stats()
+            self.assertEqual(stats['entries'], 2)
+            self.assertEqual(stats['evictions'], 1)
+            self.assertIsNone(cache.open(file))
+            # Data that doesn't match the checksum is not cached
+            doc['data'] = 'z' * len(contents)
+            cache._fill('z', doc, Adapter())
+            self.assertEqual(cache.stats()['fillErrors'], 1)
+        finally:
+            if downloads is None:
+                del cfg['downloads']
+            else:
+                cfg['downloads'] = downloads
+            shutil.rmtree(cacheRoot)
+
     def testFilesystemAssetstoreUpload(self):
         self._testUpload()
+        self._testParallelUpload()
+        self._testUploadFromHash()
+        self._testRawChunkUpload()
+        self._testResumedHashes()
 
     def testGridFSAssetstoreUpload(self):
         # Clear any old DB data
@@ -256,6 +594,10 @@ class UploadTestCase(base.TestCase):
             name='Test', db='girder_assetstore_upload_test')
         self.assetstore = assetstore
         self._testUpload()
+        self._testParallelUpload()
+        self._testUploadFromHash()
+        self._testRawChunkUpload()
+        self._testResumedHashes()
 
     def testGridFSReplicaSetAssetstoreUpload(self):
         verbose = 0
@@ -310,6 +652,7 @@ class UploadTestCase(base.TestCase):
         assetstore = self.model('assetstore').createS3Assetstore(**params)
         self.assetstore = assetstore
         self._testUpload()
+        self._testDownloadCache()
         # make an untracked upload to test that we can find and clear it
         conn = botoConnectS3(base.mockS3Server.botoConnect)
         bucket = conn.lookup(bucket_name='bucketname', validate=True)